@@ -13,6 +13,16 @@ CSV_FOLDER = os.path.join(APP_PATH, 'CSV')
 CSV_DOWNLOAD = CSV_FOLDER
 CSV_FOLDER_TEST = os.path.join(APP_PATH, 'tests/CSV')
 ALLOWED_EXTENSIONS = set(['txt', 'csv', 'zip'])
+# Quantidade de linhas lidas/gravadas por vez ao processar arquivos grandes
+TAMANHO_LOTE = 100000
+# Documentos por chamada de insert_many ao arquivar bases no MongoDB
+TAMANHO_LOTE_MONGO = 10000
+# Resultados de junção (Visao) reutilizados entre aplicações de risco
+CACHE_JUNCOES_FOLDER = os.path.join(APP_PATH, 'cache_juncoes')
+TAMANHO_CACHE_JUNCOES = 2 * 1024 ** 3
+# Processos para converter em paralelo os pares sch/txt de uma importação
+# no worker Celery (importar_base)
+PROCESSOS_IMPORTACAO = os.cpu_count() or 1
 tmpdir = tempfile.mkdtemp()
 
 try:
@@ -283,6 +283,10 @@ class Tabela(Base):
     csvs capturados e permitir junção automática se necessário.
     Utilizado por "GerenteRisco.aplica_juncao()"
     Ver :py:func:`gerente_risco.aplica_juncao`
+
+    chave: campos, separados por vírgula, que identificam uma linha do
+    csv (ex: "Conhecimento" ou "Conhecimento, Item"). Usada para arquivar
+    no MongoDB sem duplicar. Ver :py:func:`gerente_risco.csv_to_mongo`
     """
 
     __tablename__ = 'tabelas'
@@ -291,6 +295,7 @@ class Tabela(Base):
     descricao = Column(String(200))
     primario = Column(Integer)
     estrangeiro = Column(Integer)
+    chave = Column(String(200))
     pai_id = Column(Integer, ForeignKey('tabelas.id'))
     filhos = relationship('Tabela')
     pai = relationship('Tabela', remote_side=[id])
@@ -298,13 +303,23 @@ class Tabela(Base):
     visao = relationship(
         'Visao', back_populates='tabelas')
 
-    def __init__(self, csv, primario, estrangeiro, pai_id, visao_id):
+    def __init__(self, csv, primario, estrangeiro, pai_id, visao_id,
+                 chave=None):
         """Inicializa."""
         self.csv = csv
         self.primario = primario
         self.estrangeiro = estrangeiro
         self.pai_id = pai_id
         self.visao_id = visao_id
+        self.chave = chave
+
+    @property
+    def campos_chave(self):
+        """Lista dos campos da chave (vazia se não definida)."""
+        if not self.chave:
+            return []
+        return [campo.strip() for campo in self.chave.split(',')
+                if campo.strip()]
 
     @property
     def csv_file(self):
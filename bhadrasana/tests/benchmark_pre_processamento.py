@@ -0,0 +1,152 @@
+"""Benchmark do pré-processamento: listas x DataFrame (vetorizado).
+
+Compara o caminho antigo (strip_lines + sanitizar_lista, célula a célula)
+com o caminho vetorizado (strip_df + sanitizar_df, coluna a coluna) sobre
+uma extração sintética no formato do Carga, e o efeito do cache de
+valores sanitizados (CacheSanitizar). Compara também o
+pré-processamento de arquivo completo: load_csv + pre_processa + save_csv
+contra pre_processa_arquivos (leitura e gravação em lotes).
+
+Uso:
+    python bhadrasana/tests/benchmark_pre_processamento.py [linhas]
+
+"""
+import copy
+import gc
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from ajna_commons.utils.sanitiza import ascii_sanitizar, sanitizar_lista
+from bhadrasana.utils.csv_handlers import (CacheSanitizar, sanitizar_df,
+                                           sanitizar_lista_cache)
+from bhadrasana.utils.gerente_risco import GerenteRisco
+
+CONSIGNATARIOS = ['Importadora São João LTDA ', ' AÇÚCAR E CAFÉ S.A.',
+                  'Comércio  de Peças   Ñandú', 'TRANSPORTES ÁGUA AZUL']
+PORTOS = ['BRSSZ', 'BRRIG', 'CNSHA', 'DEHAM ']
+TIPOS = ['22G1', '45G1 ', '42R1']
+
+
+def gera_lista(linhas):
+    """Gera lista de listas com cabeçalho e valores repetitivos."""
+    random.seed(42)
+    lista = [['Conhecimento', 'CPFCNPJConsignatario', 'Consignatário',
+              'Porto de Origem', 'Tipo Contêiner', 'Descrição']]
+    for ind in range(linhas):
+        lista.append([str(ind),
+                      ' %014d' % random.randint(0, 10 ** 12),
+                      random.choice(CONSIGNATARIOS),
+                      random.choice(PORTOS),
+                      random.choice(TIPOS),
+                      'Mercadoria nº %s  peças em aço inoxidável ' % ind])
+    return lista
+
+
+REPETICOES = 3
+
+
+def mede(funcao, prepara):
+    """Retorna resultado e menor tempo de REPETICOES execuções da função.
+
+    Como no timeit: sem GC e o menor tempo. A primeira execução inclui o
+    custo de obter do sistema memória nova para os textos criados, que
+    depende da ordem das medições. prepara é chamada antes de cada
+    execução, fora da medição, e retorna a tupla de argumentos.
+    """
+    tempos = []
+    for _ in range(REPETICOES):
+        args = prepara()
+        gc.collect()
+        gc.disable()
+        try:
+            inicio = time.perf_counter()
+            resultado = funcao(*args)
+            tempos.append(time.perf_counter() - inicio)
+        finally:
+            gc.enable()
+    return resultado, min(tempos)
+
+
+def caminho_lista(lista):
+    """Caminho antigo: listas."""
+    gerente = GerenteRisco()
+    lista = gerente.strip_lines(lista)
+    return sanitizar_lista(lista, norm_function=ascii_sanitizar)
+
+
+def caminho_df(df):
+    """Caminho vetorizado: DataFrame."""
+    gerente = GerenteRisco()
+    df = gerente.strip_df(df)
+    return sanitizar_df(df, norm_function=ascii_sanitizar)
+
+
+def caminho_cache(lista):
+    """Caminho lista, fatorando colunas e sanitizando só valores únicos."""
+    gerente = GerenteRisco()
+    lista = gerente.strip_lines(lista)
+    return sanitizar_lista_cache(lista, norm_function=ascii_sanitizar,
+                                 cache=CacheSanitizar(ascii_sanitizar))
+
+
+def arquivo_lista(filename):
+    """Caminho antigo para arquivo: lista inteira em memória."""
+    gerente = GerenteRisco()
+    gerente.ativa_sanitizacao(ascii_sanitizar)
+    lista = gerente.load_csv(filename)
+    lista = gerente.pre_processa(lista)
+    gerente.save_csv(lista, filename)
+
+
+def arquivo_df(filename):
+    """Caminho vetorizado para arquivo: DataFrame em lotes."""
+    gerente = GerenteRisco()
+    gerente.ativa_sanitizacao(ascii_sanitizar)
+    gerente.pre_processa_arquivos([filename])
+
+
+if __name__ == '__main__':
+    linhas = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lista = gera_lista(linhas)
+    df = pd.DataFrame(lista[1:], columns=lista[0])
+    result_lista, tempo_lista = mede(
+        caminho_lista, lambda: (copy.deepcopy(lista), ))
+    result_df, tempo_df = mede(caminho_df, lambda: (df, ))
+    assert result_df.columns.tolist() == result_lista[0]
+    assert result_df.values.tolist() == result_lista[1:]
+    print('Linhas: %s' % linhas)
+    print('Listas (strip_lines + sanitizar_lista): %.2fs' % tempo_lista)
+    print('DataFrame (strip_df + sanitizar_df): %.2fs' % tempo_df)
+    print('Speedup: %.1fx' % (tempo_lista / tempo_df))
+    result_cache, tempo_cache = mede(
+        caminho_cache, lambda: (copy.deepcopy(lista), ))
+    assert result_cache == result_lista
+    print('Listas com cache (sanitizar_lista_cache): %.2fs' % tempo_cache)
+    print('Speedup: %.1fx' % (tempo_lista / tempo_cache))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        origem = os.path.join(tmpdir, 'origem.csv')
+        GerenteRisco().save_csv(lista, origem)
+        tempos = []
+        for caminho in (arquivo_lista, arquivo_df):
+            filename = os.path.join(tmpdir, caminho.__name__ + '.csv')
+
+            def copia_origem():
+                shutil.copy(origem, filename)
+                return (filename, )
+            tempos.append(mede(caminho, copia_origem)[1])
+        with open(os.path.join(tmpdir, 'arquivo_lista.csv'), 'rb') as f1, \
+                open(os.path.join(tmpdir, 'arquivo_df.csv'), 'rb') as f2:
+            assert f1.read() == f2.read()
+        print('Arquivo (load_csv + pre_processa + save_csv): %.2fs' %
+              tempos[0])
+        print('Arquivo (pre_processa_arquivos): %.2fs' % tempos[1])
+        print('Speedup: %.1fx' % (tempos[0] / tempos[1]))
+    finally:
+        shutil.rmtree(tmpdir)
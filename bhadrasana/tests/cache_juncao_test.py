@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from bhadrasana.tests.juncao_test import CAPITULOS, LIVROS, visao
+from bhadrasana.utils.cache_juncao import CacheJuncao
+from bhadrasana.utils.colunar import para_pandas
+
+JUNCOES = 'bhadrasana/tests/juncoes'
+
+
+class TestCacheJuncao(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'juncoes')
+        shutil.copytree(JUNCOES, self.path)
+        self.cache = CacheJuncao(os.path.join(self.tmpdir, 'cache'),
+                                 tamanho_maximo=10 ** 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_chave(self):
+        chave = self.cache.chave(visao([LIVROS, CAPITULOS]), self.path)
+        assert chave == self.cache.chave(visao([LIVROS, CAPITULOS]),
+                                         self.path)
+        assert chave != self.cache.chave(
+            visao([LIVROS, CAPITULOS], ['titulo']), self.path)
+        arquivo = os.path.join(self.path, 'livros.csv')
+        os.utime(arquivo, (time.time() + 10, time.time() + 10))
+        assert chave != self.cache.chave(visao([LIVROS, CAPITULOS]),
+                                         self.path)
+
+    def test_grava_le(self):
+        df = pd.DataFrame({'livro': ['1', '2'], 'titulo': ['a', np.nan]})
+        assert self.cache.le('visao1-x') is None
+        self.cache.grava('visao1-x', df)
+        pd.testing.assert_frame_equal(para_pandas(self.cache.le('visao1-x')),
+                                      df)
+
+    def test_descarta(self):
+        df = pd.DataFrame({'valor': [str(ind) for ind in range(1000)]})
+        for chave in ('a', 'b', 'c'):
+            self.cache.grava(chave, df)
+        tamanho = os.path.getsize(self.cache.caminho('a'))
+        self.cache.tamanho_maximo = 2 * tamanho
+        # 'a' usado por último: 'b' é o menos usado recentemente
+        os.utime(self.cache.caminho('b'), (1, 1))
+        self.cache.le('a')
+        assert self.cache.descarta() == [self.cache.caminho('b')]
+        assert self.cache.le('a') is not None
+        assert self.cache.le('c') is not None
@@ -1,4 +1,3 @@
-import csv
 import datetime
 import importlib
 import os
@@ -6,7 +5,9 @@ import os
 import pandas as pd
 
 from bhadrasana.app import CSV_FOLDER
+from bhadrasana.conf import ENCODE
 from bhadrasana.models.carga import Base, MySession
+from bhadrasana.utils import colunar
 
 CARGA_BASE = os.path.join(CSV_FOLDER, '1/2017/1221/')
 
@@ -16,20 +17,16 @@ engine = mysession.engine
 Base.metadata.drop_all(engine)
 Base.metadata.create_all(engine)
 
-files = sorted(os.listdir(CARGA_BASE))
+files = sorted(colunar.lista_arquivos_base(CARGA_BASE))
 dfs = {}
+MAX_LINES = 10
 for r in range(len(files)):
-    with open(os.path.join(CARGA_BASE, files[r]), 'r',
-              encoding='latin1', newline='') as arq:
-        reader = csv.reader(arq)
-        MAX_LINES = 10
-        lista = []
-        for ind, linha in enumerate(reader):
-            lista.append(linha)
-            if ind > MAX_LINES:
-                break
-    df = pd.DataFrame(lista[1:], columns=lista[0])
-    dfs[files[r]] = df
+    # Somente as primeiras linhas; datas e números do sch convertidos
+    # para seus tipos, códigos para categorias
+    arquivo = os.path.join(CARGA_BASE, files[r])
+    df = pd.read_csv(arquivo, encoding=ENCODE, dtype=str,
+                     keep_default_na=False, nrows=MAX_LINES + 1)
+    dfs[files[r]] = colunar.converte_dtypes(df, colunar.dtypes_sch(arquivo))
 
 
 dataframes = dfs
@@ -49,9 +46,14 @@ for csvf, df in dataframes.items():
                     if campo in instance.__table__.c:
                         ctype = instance.__table__.c[campo].type
                         if str(ctype) == 'NUMERIC':
-                            val = val.replace(',', '.')
+                            if isinstance(val, str):
+                                val = val.replace(',', '.')
+                            elif pd.isna(val):
+                                val = None
                         elif str(ctype) == 'DATETIME':
-                            if val:
+                            if not isinstance(val, str):
+                                val = None if pd.isna(val) else val.date()
+                            elif val:
                                 val = datetime.datetime.strptime(
                                     val, '%d/%m/%Y').date()
                             else:
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from bhadrasana.conf import ENCODE
+from bhadrasana.tests.juncao_test import (CAPITULOS, LIVROS, SUBCAPITULOS,
+                                          tabela, visao)
+from bhadrasana.utils.chaves import (chave_atualizada, junta,
+                                     junta_posicoes, le_indice)
+from bhadrasana.utils.colunar import grava_colunar, le_tabela
+from bhadrasana.utils.juncao import planeja_juncao
+
+JUNCOES = 'bhadrasana/tests/juncoes'
+
+
+class TestChaves(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'juncoes')
+        shutil.copytree(JUNCOES, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_indice(self):
+        arquivo = os.path.join(self.tmpdir, 'tabela.csv')
+        with open(arquivo, 'w', encoding=ENCODE, newline='') as out:
+            out.write('chave,valor\nb,1\na,2\nNA,3\nb,4\n,5\n')
+        # Sem cópia colunar (base não importada), nada é gravado
+        le_indice(arquivo, 'chave')
+        assert sorted(os.listdir(self.tmpdir)) == ['juncoes', 'tabela.csv']
+        grava_colunar(arquivo)
+        assert not chave_atualizada(arquivo, 'chave')
+        indice = le_indice(arquivo, 'chave')
+        assert chave_atualizada(arquivo, 'chave')
+        for indice in (indice, le_indice(arquivo, 'chave')):
+            valores = [indice.valores[codigo] if codigo >= 0 else None
+                       for codigo in indice.codigos]
+            # Textos lidos como nulo por pd.read_csv têm código -1
+            assert valores == ['b', 'a', None, 'b', None]
+
+    def test_junta_posicoes(self):
+        esquerda = np.array([0, 1, -1, 0, 2])
+        valores_esq = np.array(['b', 'a', 'c'], dtype=object)
+        direita = np.array([1, 0, -1, 0])
+        valores_dir = np.array(['a', 'b'], dtype=object)
+        posicoes = junta_posicoes(esquerda, valores_esq,
+                                  direita, valores_dir)
+        assert [lista.tolist() for lista in posicoes] == \
+            [[0, 1, 1, 2, 3], [0, 1, 3, 2, 0]]
+        posicoes = junta_posicoes(esquerda, valores_esq,
+                                  direita, valores_dir, how='left')
+        assert [lista.tolist() for lista in posicoes] == \
+            [[0, 1, 1, 2, 3, 4], [0, 1, 3, 2, 0, -1]]
+
+    def test_junta(self):
+        autores = tabela('autores.csv', 'autor', 'livroid')
+        for tabelas in ([LIVROS, autores], [LIVROS, CAPITULOS]):
+            plano = planeja_juncao(visao(tabelas), self.path)
+            dfs = [le_tabela(etapa.arquivo) for etapa in plano.etapas]
+            etapa = plano.etapas[1]
+            esperado = dfs[0].merge(dfs[1], how=etapa.how,
+                                    left_on=etapa.left_on,
+                                    right_on=etapa.right_on)
+            pd.testing.assert_frame_equal(junta(plano, dfs), esperado)
+            # Com DataFrame filtrado
+            dfs[1] = dfs[1][1:]
+            esperado = dfs[0].merge(dfs[1], how=etapa.how,
+                                    left_on=etapa.left_on,
+                                    right_on=etapa.right_on)
+            pd.testing.assert_frame_equal(junta(plano, dfs), esperado)
+        # 'outer' é feito por DataFrame.merge
+        capitulos = tabela('capitulos.csv', 'capitulo', 'livroid',
+                           type='outer')
+        plano = planeja_juncao(visao([LIVROS, capitulos, SUBCAPITULOS]),
+                               self.path)
+        dfs = [le_tabela(etapa.arquivo) for etapa in plano.etapas]
+        assert junta(plano, dfs) is None
+
+    def test_junta_falha_gravacao(self):
+        for arquivo in os.listdir(self.path):
+            grava_colunar(os.path.join(self.path, arquivo))
+        plano = planeja_juncao(visao([LIVROS, CAPITULOS]), self.path)
+        dfs = [le_tabela(etapa.arquivo) for etapa in plano.etapas]
+        # Índice não gravado (ex: gravação simultânea): junção por merge
+        with mock.patch('bhadrasana.utils.colunar.grava_tabela',
+                        side_effect=FileNotFoundError('temporário')):
+            assert junta(plano, dfs) is None
+        assert junta(plano, dfs) is not None
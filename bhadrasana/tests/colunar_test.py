@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import pandas as pd
+
+from bhadrasana.conf import ENCODE
+from bhadrasana.utils.colunar import (EscritorColunar, abre_tabela,
+                                      caminho_colunar, colunar_atualizado,
+                                      dtypes_sch, estima_linhas,
+                                      grava_colunar, le_lotes, le_tabela,
+                                      lista_arquivos_base, metadados_colunar,
+                                      renomeia_colunar)
+
+CONTEUDO = 'conhecimento,porto,descricao\n' + \
+    '1,BRSSZ,Café\n' + \
+    '2,NA,\n' + \
+    '3, BRRIG ,null\n' + \
+    '4,CNSHA,peças\n'
+
+
+class TestColunar(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.arquivo = os.path.join(self.tmpdir, 'tabela.csv')
+        with open(self.arquivo, 'w', encoding=ENCODE, newline='') as out:
+            out.write(CONTEUDO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_grava_le(self):
+        assert not colunar_atualizado(self.arquivo)
+        assert estima_linhas(self.arquivo) == 4
+        assert grava_colunar(self.arquivo) == caminho_colunar(self.arquivo)
+        assert colunar_atualizado(self.arquivo)
+        assert estima_linhas(self.arquivo) == 4
+        assert lista_arquivos_base(self.tmpdir) == ['tabela.csv']
+        esperado = pd.read_csv(self.arquivo, encoding=ENCODE, dtype=str)
+        pd.testing.assert_frame_equal(le_tabela(self.arquivo), esperado)
+        esperado = pd.read_csv(self.arquivo, encoding=ENCODE, dtype=str,
+                               keep_default_na=False)
+        pd.testing.assert_frame_equal(le_tabela(self.arquivo, nulos=False),
+                                      esperado)
+        lotes = list(le_lotes(self.arquivo, chunksize=3))
+        assert [len(lote) for lote in lotes] == [3, 1]
+        pd.testing.assert_frame_equal(pd.concat(lotes), esperado)
+
+    def test_desatualizado(self):
+        grava_colunar(self.arquivo)
+        time.sleep(0.01)
+        with open(self.arquivo, 'a', encoding=ENCODE, newline='') as out:
+            out.write('5,DEHAM,aço\n')
+        assert not colunar_atualizado(self.arquivo)
+        assert len(le_tabela(self.arquivo)) == 5
+
+    def test_renomeia(self):
+        grava_colunar(self.arquivo)
+        renomeia_colunar(self.arquivo, ['ce', 'porto', 'descricao'])
+        df = le_tabela(self.arquivo)
+        assert df.columns.tolist() == ['ce', 'porto', 'descricao']
+        assert len(df) == 4
+
+    def test_colunas(self):
+        colunas = ['descricao', 'conhecimento', 'inexistente']
+        esperado = pd.read_csv(self.arquivo, encoding=ENCODE, dtype=str,
+                               usecols=['conhecimento', 'descricao'])
+        pd.testing.assert_frame_equal(
+            le_tabela(self.arquivo, colunas=colunas), esperado)
+        grava_colunar(self.arquivo)
+        pd.testing.assert_frame_equal(
+            le_tabela(self.arquivo, colunas=colunas), esperado)
+        tabela = abre_tabela(self.arquivo, colunas)
+        assert tabela.column_names == ['conhecimento', 'descricao']
+
+    def test_dtypes_sch(self):
+        assert dtypes_sch(self.arquivo) == {}
+        grava_colunar(self.arquivo)
+        assert dtypes_sch(self.arquivo) == {}
+        arquivo = os.path.join(self.tmpdir, 'escala.csv')
+        with open(arquivo, 'w', encoding=ENCODE, newline='') as out:
+            out.write('porto,data,peso,nome\n' +
+                      'BRSSZ,01/10/2015,"10,5",Navio A\n' +
+                      'NA,,,Navio B\n' +
+                      'BRSSZ,02/10/2015,3,Navio C\n')
+        metadados = {'porto': {'tipo_sch': 'Char', 'largura_sch': '5'},
+                     'data': {'tipo_sch': 'Date'},
+                     'peso': {'tipo_sch': 'Double'},
+                     'nome': {'tipo_sch': 'Char', 'largura_sch': '55'}}
+        with EscritorColunar(arquivo, metadados) as escritor:
+            escritor.escreve(pd.read_csv(arquivo, encoding=ENCODE,
+                                         dtype=str, keep_default_na=False))
+        dtypes = dtypes_sch(arquivo)
+        assert dtypes == {'porto': 'category', 'data': 'datetime64[ns]',
+                          'peso': 'float64'}
+        df = le_tabela(arquivo, dtypes=dtypes)
+        assert df.dtypes.astype(str).tolist() == \
+            ['category', 'datetime64[ns]', 'float64', 'object']
+        texto = le_tabela(arquivo)
+        pd.testing.assert_series_equal(df['porto'].astype(object),
+                                       texto['porto'])
+        assert df['data'].tolist()[0] == pd.Timestamp(2015, 10, 1)
+        assert df['data'].isna().tolist() == [False, True, False]
+        assert df['peso'].fillna(0).tolist() == [10.5, 0, 3]
+        # Mesmo resultado lendo do csv
+        os.remove(caminho_colunar(arquivo))
+        pd.testing.assert_frame_equal(le_tabela(arquivo, dtypes=dtypes), df)
+
+    def test_metadados_colunar(self):
+        assert metadados_colunar(self.arquivo) == []
+        # Por posição: mantidos mesmo com outros títulos
+        grava_colunar(self.arquivo, metadados=[{'tipo_sch': 'Long'}, None,
+                                               {'tipo_sch': 'Date'}])
+        metadados = metadados_colunar(self.arquivo)
+        assert metadados == [{b'tipo_sch': b'Long'}, None,
+                             {b'tipo_sch': b'Date'}]
+        assert dtypes_sch(self.arquivo) == {'conhecimento': 'float64',
+                                            'descricao': 'datetime64[ns]'}
+        # Número de colunas diferente: ignorados
+        grava_colunar(self.arquivo, metadados=metadados[:2])
+        assert dtypes_sch(self.arquivo) == {}
+        # Títulos repetidos: cópia regravada do csv, com os metadados
+        grava_colunar(self.arquivo, metadados=metadados)
+        renomeia_colunar(self.arquivo, ['a', 'b', 'a'])
+        assert metadados_colunar(self.arquivo) == metadados
@@ -2,15 +2,26 @@ import copy
 import csv
 import io
 import os
+import shutil
 import tempfile
 import unittest
 from zipfile import ZipFile
 
+import pandas as pd
+
 from ajna_commons.utils.sanitiza import (ascii_sanitizar, sanitizar,
                                          sanitizar_lista, unicode_sanitizar)
-from bhadrasana.utils.csv_handlers import (ENCODE, muda_titulos_csv,
+from bhadrasana.utils.colunar import abre_tabela, colunar_atualizado
+from bhadrasana.utils.csv_handlers import (ENCODE, CacheSanitizar, billiard,
+                                           muda_titulos_arquivo,
+                                           muda_titulos_csv, muda_titulos_df,
                                            muda_titulos_lista,
-                                           retificar_linhas, sch_processing)
+                                           processa_como_texto,
+                                           processo_daemon, retificar_linhas,
+                                           sanitizar_df,
+                                           sanitizar_lista_cache,
+                                           sch_campos, sch_pares,
+                                           sch_processing, sch_tocsv)
 
 tmpdir = tempfile.mkdtemp()
 
@@ -23,6 +34,12 @@ SCH_VIAGENS = os.path.join(SAMPLES_DIR, 'sch', 'viagens')
 SCH_ZIP_VIAGENS = os.path.join(SAMPLES_DIR, 'sch', 'viagens.zip')
 
 
+def converte_em_daemon(path, dest_path, fila):
+    """Converte em paralelo a partir de um processo daemon."""
+    filenames = sch_processing(path, dest_path=dest_path, workers=3)
+    fila.put((processo_daemon(), filenames))
+
+
 class TestCsvHandlers(unittest.TestCase):
     titulos_novos = {'titulo1_old': 'titulo1_new',
                      'titulo2_old': 'titulo2_new'}
@@ -50,10 +67,54 @@ class TestCsvHandlers(unittest.TestCase):
                                         TestCsvHandlers.titulos_novos)
         self.comparalistas(lista_old, self.lista)
 
+    def test_muda_titulos_arquivo(self):
+        destino = os.path.join(self.tmpdir, 'titulos.csv')
+        titulos = muda_titulos_arquivo(CSV_TITLES_TEST,
+                                       TestCsvHandlers.titulos_novos,
+                                       destino)
+        with open(destino, 'r', encoding=ENCODE, newline='') as f:
+            lista_nova = [linha for linha in csv.reader(f)]
+        os.remove(destino)
+        assert lista_nova[0] == titulos
+        assert lista_nova[1:] == self.lista[1:]
+        self.comparalistas(self.lista, lista_nova)
+
+    def test_muda_titulos_df(self):
+        df = pd.DataFrame(self.lista[1:], columns=self.lista[0])
+        df_novo = muda_titulos_df(df, TestCsvHandlers.titulos_novos)
+        lista_nova = [df_novo.columns.tolist()] + df_novo.values.tolist()
+        self.comparalistas(self.lista, lista_nova)
+        assert df.columns.tolist() == self.lista[0]
+
     def test_retificar_linha(self):
         headers = ['cpf', 'cnpj']
         linha = ['1123', '1325', '9513']
         retificar_linhas(linha, headers)
+        lista = [['1', '', '2', '', ''],
+                 ['1', '2'],
+                 ['1', '2', '3'],
+                 ['', '1', '', '']]
+        assert retificar_linhas(lista, headers + ['cep']) == 2
+        assert lista == [['1', '2', ''], ['1', '2'], ['1', '2', '3'],
+                         ['1', '', '']]
+
+    def test_sch_tocsv_iteravel(self):
+        sch = ['["teste.txt"]\n',
+               'Col1="cpf" Char Width 11\n',
+               'Col2="nome" Char Width 30\n']
+        txt = (linha for linha in [['descartada'],
+                                   ['1', 'a'],
+                                   [],
+                                   ['2', '', 'b']])
+        estatisticas = {}
+        tmpdir = tempfile.mkdtemp()
+        filename = sch_tocsv(sch, txt, tmpdir, estatisticas)
+        with open(filename, 'r', encoding=ENCODE, newline='') as csv_file:
+            lista = [linha for linha in csv.reader(csv_file)]
+        os.remove(filename)
+        os.rmdir(tmpdir)
+        assert lista == [['cpf', 'nome'], ['1', 'a'], ['2', 'b']]
+        assert estatisticas == {filename: 1}
 
     def comparalistas(self, lista_old, lista):
         for old, new in TestCsvHandlers.titulos_novos.items():
@@ -94,6 +155,107 @@ class TestCsvHandlers(unittest.TestCase):
         print(lista[0])
         assert lista[1][0][0:5] == lista2[1][0][0:5]
 
+    def test_sch_pares(self):
+        pares = sch_pares(SCH_ZIP_VIAGENS)
+        assert sorted(pares) == [('sch00.sch', 'Viagens000.txt'),
+                                 ('sch01.sch', 'esportes010.txt'),
+                                 ('sch02.sch', 'alimentos020.txt')]
+        assert sorted(pares) == sorted(
+            (os.path.basename(sch), os.path.basename(txt))
+            for sch, txt in sch_pares(SCH_VIAGENS))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'muitos.zip')
+        with ZipFile(path, 'w') as myzip:
+            for ind in range(500):
+                myzip.writestr('sch%03d.sch' % ind, '')
+                myzip.writestr('tabela%03d0.txt' % ind, '')
+        pares = sch_pares(path)
+        assert len(pares) == 500
+        assert pares[123] == ('sch123.sch', 'tabela1230.txt')
+        with ZipFile(path, 'a') as myzip:
+            myzip.writestr('sch500.sch', '')
+        with self.assertRaises(FileNotFoundError):
+            sch_pares(path)
+
+    def test_sch_campos(self):
+        campos = sch_campos([b'[%Escala]\n',
+                             b'Col1="Escala" Char Width 11\n',
+                             b'Col2="Viagem" \n',
+                             b'Col3="DataBloqueio1" Date \n'])
+        assert campos == [('Escala', 'Char', 11),
+                          ('Viagem', None, None),
+                          ('DataBloqueio1', 'Date', None)]
+
+    def test_sch_copia_colunar(self):
+        for path in (SCH_FILE_TEST, SCH_ZIP_VIAGENS):
+            dest_path = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, dest_path)
+            filenames = sch_processing(path, dest_path=dest_path,
+                                       copia_colunar=True)
+            for csv_name, _ in filenames:
+                # Mesmo conteúdo da cópia gravada a partir do csv
+                assert colunar_atualizado(csv_name)
+                pd.testing.assert_frame_equal(
+                    abre_tabela(csv_name).to_pandas(),
+                    pd.read_csv(csv_name, encoding=ENCODE, dtype=str,
+                                keep_default_na=False))
+        csv_name = sch_processing(SCH_FILE_TEST, dest_path=dest_path,
+                                  copia_colunar=True)[0][0]
+        schema = abre_tabela(csv_name).schema
+        assert schema.field('Escala').metadata == {b'tipo_sch': b'Char',
+                                                   b'largura_sch': b'11'}
+        assert schema.field('DataBloqueio1').metadata == \
+            {b'tipo_sch': b'Date'}
+
+    def test_sch_workers(self):
+        for path in (SCH_VIAGENS, SCH_ZIP_VIAGENS):
+            sequencial = tempfile.mkdtemp()
+            paralelo = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, sequencial)
+            self.addCleanup(shutil.rmtree, paralelo)
+            estatisticas = {}
+            filenames = sch_processing(path, dest_path=sequencial)
+            filenames_paralelo = sch_processing(path, dest_path=paralelo,
+                                                estatisticas=estatisticas,
+                                                workers=3)
+            assert len(filenames) == 3
+            assert [(os.path.basename(csv_name), txt_name)
+                    for csv_name, txt_name in filenames_paralelo] == \
+                [(os.path.basename(csv_name), txt_name)
+                 for csv_name, txt_name in filenames]
+            assert sorted(estatisticas) == sorted(
+                csv_name for csv_name, _ in filenames_paralelo)
+            for (csv_name, _), (csv_paralelo, _) in zip(filenames,
+                                                        filenames_paralelo):
+                with open(csv_name, 'rb') as csv_file, \
+                        open(csv_paralelo, 'rb') as csv_file_paralelo:
+                    assert csv_file.read() == csv_file_paralelo.read()
+
+    @unittest.skipIf(billiard is None, 'billiard (Celery) não instalado')
+    def test_sch_workers_daemon(self):
+        # Como no worker Celery prefork: processo billiard daemon
+        for path in (SCH_VIAGENS, SCH_ZIP_VIAGENS):
+            sequencial = tempfile.mkdtemp()
+            paralelo = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, sequencial)
+            self.addCleanup(shutil.rmtree, paralelo)
+            filenames = sch_processing(path, dest_path=sequencial)
+            fila = billiard.Queue()
+            processo = billiard.Process(target=converte_em_daemon,
+                                        args=(path, paralelo, fila),
+                                        daemon=True)
+            processo.start()
+            daemon, filenames_paralelo = fila.get(timeout=60)
+            processo.join()
+            assert daemon
+            assert len(filenames_paralelo) == 3
+            for (csv_name, _), (csv_paralelo, _) in zip(filenames,
+                                                        filenames_paralelo):
+                with open(csv_name, 'rb') as csv_file, \
+                        open(csv_paralelo, 'rb') as csv_file_paralelo:
+                    assert csv_file.read() == csv_file_paralelo.read()
+
     def test_sch_zip(self):
         filenames = sch_processing(SCH_ZIP_TEST)
         with ZipFile(SCH_ZIP_TEST) as myzip:
@@ -172,3 +334,55 @@ class TestCsvHandlers(unittest.TestCase):
                         ['cha', 'torrada']]
             sanitizado = sanitizar_lista(teste, norm_function=norm_function)
             assert sanitizado == esperado
+
+    def test_sanitizar_df(self):
+        for norm_function in {ascii_sanitizar,
+                              unicode_sanitizar}:
+            teste = [['Bebidas', 'Comidas', 'Frases'],
+                     ['café', 'BOLO', ' LOUCO     dos  espAçõs'],
+                     ['Chá', 'TorraDa', None]]
+            df = pd.DataFrame(teste[1:], columns=teste[0])
+            sanitizado = sanitizar_df(df, norm_function=norm_function)
+            esperado = sanitizar_lista(teste, norm_function=norm_function)
+            assert sanitizado.columns.tolist() == esperado[0]
+            assert sanitizado.values.tolist() == esperado[1:]
+
+    def test_processa_como_texto(self):
+        serie = pd.Series(['a', None, 'b', 'c', 'd'])
+        for tamanho_bloco in (1, 2, 10):
+            result = processa_como_texto(serie, str.upper,
+                                         tamanho_bloco=tamanho_bloco)
+            assert result.tolist() == ['A', None, 'B', 'C', 'D']
+        # Separador nos dados: não pode ser processada como texto
+        serie = pd.Series(['a', 'b\x00c'])
+        assert processa_como_texto(serie, str.upper, tamanho_bloco=1) is None
+
+    def test_sanitizar_cache(self):
+        for norm_function in {ascii_sanitizar,
+                              unicode_sanitizar}:
+            teste = [['Porto', 'Consignatário']] + \
+                [['BRSSZ ', 'Café  LTDA'],
+                 ['brssz', 'CAFÉ LTDA'],
+                 [' BRSSZ', None],
+                 ['BRRIG', 'Chá S.A.']] * 3
+            esperado = sanitizar_lista(copy.deepcopy(teste),
+                                       norm_function=norm_function)
+            cache = CacheSanitizar(norm_function, tamanho=4)
+            sanitizado = sanitizar_lista_cache(copy.deepcopy(teste),
+                                               norm_function=norm_function,
+                                               cache=cache)
+            assert sanitizado == esperado
+            # Cinco valores distintos: o menos usado é descartado
+            assert len(cache) == 4
+            df = pd.DataFrame(teste[1:], columns=teste[0])
+            sanitizado = sanitizar_df(df, norm_function=norm_function,
+                                      cache=cache)
+            assert sanitizado.values.tolist() == esperado[1:]
+            # Linhas com largura diferente do cabeçalho
+            teste.append(['Abóbora'])
+            esperado = sanitizar_lista(copy.deepcopy(teste),
+                                       norm_function=norm_function)
+            sanitizado = sanitizar_lista_cache(copy.deepcopy(teste),
+                                               norm_function=norm_function,
+                                               cache=cache)
+            assert sanitizado == esperado
@@ -7,6 +7,7 @@ Chamar python virasana/tests/integracao_test.py criará o Banco de Dados
 SEM apagar tudo no final. Para inspeção visual do BD criado para testes.
 
 """
+import datetime
 import unittest
 
 # import pprint
@@ -21,22 +22,24 @@ class TestCase(unittest.TestCase):
         db = MongoClient()['unit_test']
         self.db = db
         # Cria documentos simulando registros importados do CARGA
-        db['CARGA.Container'].insert(
+        db['CARGA.Container'].insert_one(
             {'container': 'cheio',
              'conhecimento': '1',
              'pesobrutoitem': '10,00',
              'volumeitem': '1,00'})
-        db['CARGA.Container'].insert(
+        db['CARGA.Container'].insert_one(
             {'container': 'cheio2',
              'conhecimento': '2',
              'item': 1,
              'pesobrutoitem': '10,00',
              'volumeitem': '1,00'})
-        db['CARGA.Conhecimento'].insert({'conhecimento': '1', 'tipo': 'mbl'})
-        db['CARGA.Conhecimento'].insert({'conhecimento': '2', 'tipo': 'bl'})
-        db['CARGA.NCM'].insert({'conhecimento': '1', 'item': '1', 'ncm': '1'})
-        db['CARGA.NCM'].insert({'conhecimento': '2', 'item': '1', 'ncm': '2'})
-        db['CARGA.NCM'].insert({'conhecimento': '2', 'item': '2', 'ncm': '3'})
+        db['CARGA.Conhecimento'].insert_many(
+            [{'conhecimento': '1', 'tipo': 'mbl'},
+             {'conhecimento': '2', 'tipo': 'bl'}])
+        db['CARGA.NCM'].insert_many(
+            [{'conhecimento': '1', 'item': '1', 'ncm': '1'},
+             {'conhecimento': '2', 'item': '1', 'ncm': '2'},
+             {'conhecimento': '2', 'item': '2', 'ncm': '3'}])
         self.gerente = GerenteRisco()
         self.carga = type('Base', (object, ),
                           {'nome': 'CARGA'})
@@ -75,7 +78,7 @@ class TestCase(unittest.TestCase):
     def test_gerente_load_mongo(self):
         lista = self.gerente.load_mongo(
             self.db, collection_name='CARGA.Container')
-        assert len(lista) == 2
+        assert len(lista) == 3
 
     def test_gerente_juncao1(self):
         # Teste com 1 tabela
@@ -200,6 +203,42 @@ class TestCase(unittest.TestCase):
         print('LISTA', lista)
         assert len(lista) == 2
 
+    def test_gerente_juncao_filtro_tipos(self):
+        # csv_to_mongo grava datas do sch como datetime e números como número
+        self.db['CARGA.Container'].update_one(
+            {'container': 'cheio'},
+            {'$set': {'dataentrada': datetime.datetime(2017, 12, 21)}})
+        containers_visao = type('Visao', (object, ),
+                                {'nome': 'containers',
+                                 'base': self.carga,
+                                 'tabelas': [self.containers],
+                                 'colunas': []
+                                 })
+
+        def risco(nome_campo, valor):
+            return type('ParametroRisco', (object, ), {
+                'nome_campo': nome_campo,
+                'valores': [type('ValorParametro', (object, ),
+                                 {'tipo_filtro': Filtro.igual,
+                                  'valor': valor})]})
+        self.gerente.add_risco(risco('dataentrada', '21/12/2017'))
+        lista = self.gerente.aplica_juncao_mongo(
+            self.db, containers_visao, filtrar=True)
+        assert len(lista) == 2
+        assert lista[1][lista[0].index('container')] == 'cheio'
+        # item é inteiro em CARGA.Container
+        self.gerente.clear_risco()
+        self.gerente.add_risco(risco('item', '1'))
+        lista = self.gerente.aplica_juncao_mongo(
+            self.db, containers_visao, filtrar=True)
+        assert len(lista) == 2
+        assert lista[1][lista[0].index('container')] == 'cheio2'
+        # Nenhum valor aplicável: nenhuma linha, e não a coleção inteira
+        self.gerente.clear_risco()
+        self.gerente.add_risco(risco('dataentrada', 'inválida'))
+        assert self.gerente.aplica_juncao_mongo(
+            self.db, containers_visao, filtrar=True) is None
+
 
 # Chamar python bhadrasana/tests/gerente_risco_mongo_test.py criará o Banco
 # SEM apagar tudo no final. Para inspeção visual do BD criado para testes.
@@ -1,17 +1,27 @@
 """Testes para o módulo gerente_risco"""
 import csv
 import datetime
+import itertools
 import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
 import mongomock
+import pandas as pd
+import pymongo
 
+from ajna_commons.utils.sanitiza import ascii_sanitizar
 # from pymongo import MongoClient
 from bhadrasana.conf import APP_PATH
-from bhadrasana.models.models import Filtro
-from bhadrasana.utils.gerente_risco import GerenteRisco
+from bhadrasana.models.models import Filtro, Tabela
+from bhadrasana.utils.colunar import (abre_tabela, colunar_atualizado,
+                                      dtypes_sch, grava_colunar,
+                                      lista_arquivos_base)
+from bhadrasana.utils.gerente_risco import (COLUNA_RISCOS, DUPLICATE_KEY,
+                                            AhoCorasick, FiltroContem,
+                                            FiltroPrefixo, GerenteRisco)
 
 CSV_RISCO_TEST = 'bhadrasana/tests/sample/csv_risco_example.csv'
 CSV_NAMEDRISCO_TEST = 'bhadrasana/tests/sample/csv_namedrisco_example.csv'
@@ -35,6 +45,47 @@ SAMPLES_DIR = os.path.join('bhadrasana', 'tests', 'sample')
 SCH_VIAGENS = os.path.join(SAMPLES_DIR, 'viagens')
 
 
+def mongomock_bulk_update():
+    """Algumas combinações de mongomock e pymongo não aceitam UpdateOne."""
+    try:
+        mongomock.MongoClient().teste.teste.bulk_write(
+            [pymongo.UpdateOne({}, {'$set': {'a': 1}}, upsert=True)])
+    except TypeError:
+        return False
+    return True
+
+
+class ColecaoFalsa():
+    """Coleção que registra índices e gravações, sem banco de dados."""
+
+    def __init__(self, name, erro_indice=None):
+        self.name = name
+        self.erro_indice = erro_indice
+        self.indices = []
+        self.operacoes = []
+        self.inseridos = []
+
+    def create_index(self, chaves, unique=False):
+        if self.erro_indice:
+            raise self.erro_indice
+        self.indices.append((chaves, unique))
+
+    def bulk_write(self, operacoes, ordered=True):
+        self.operacoes.extend(operacoes)
+        return type('BulkWriteResult', (object, ),
+                    {'upserted_count': len(operacoes), 'matched_count': 0})
+
+    def insert_many(self, documentos, ordered=True):
+        self.inseridos.extend(documentos)
+
+
+class BancoFalso(dict):
+    """Banco com coleções ColecaoFalsa já existentes."""
+
+    def list_collection_names(self):
+        return list(self.keys())
+
+
 class TestGerenteRisco(unittest.TestCase):
     def setUp(self):
         with open(CSV_RISCO_TEST, 'r', newline='') as f:
@@ -182,6 +233,145 @@ class TestGerenteRisco(unittest.TestCase):
         lista_risco = gerente.aplica_risco(lista)
         assert len(lista_risco) == 3
 
+    def test_aplica_risco_dataframe(self):
+        gerente = self.gerente
+        gerente.import_named_csv(CSV_NAMEDRISCO_TEST)
+        lista_risco = gerente.aplica_risco(self.lista)
+        df = pd.DataFrame(self.lista[1:], columns=self.lista[0])
+        df_risco = gerente.aplica_risco(df=df)
+        assert df_risco == lista_risco
+        assert df_risco[0] == ['alimento', 'esporte', 'horario']
+        assert len(df_risco) == 6
+
+    def test_aplica_risco_deduplicado(self):
+        gerente = self.gerente
+        gerente.import_named_csv(CSV_NAMEDRISCO_TEST)
+        lista_risco = gerente.aplica_risco(self.lista, deduplicar=True)
+        assert lista_risco[0] == ['alimento', 'esporte', 'horario',
+                                  COLUNA_RISCOS]
+        assert len(lista_risco) == 5
+        coxinha = [linha for linha in lista_risco if linha[0] == 'coxinha']
+        assert coxinha[0][3] == 'alimento: coxinha; esporte: surf'
+        gerente.clear_risco()
+        lista_risco = gerente.aplica_risco(self.lista, deduplicar=True)
+        assert len(lista_risco) == 1
+
+    def test_aplica_risco_arquivo(self):
+        gerente = self.gerente
+        gerente.import_named_csv(CSV_NAMEDRISCO_TEST)
+        destino = os.path.join(self.tmpdir, 'risco.csv')
+        total = gerente.aplica_risco_arquivo(CSV_RISCO_TEST, destino,
+                                             deduplicar=True, chunksize=2)
+        assert total == 4
+        lista_arquivo = gerente.load_csv(destino)
+        lista_risco = gerente.aplica_risco(self.lista, deduplicar=True)
+        assert lista_arquivo == lista_risco
+        total = gerente.aplica_risco_arquivo(CSV_RISCO_TEST, destino,
+                                             chunksize=2)
+        assert total == 5
+        lista_arquivo = gerente.load_csv(destino)
+        assert len(lista_arquivo) == 6
+        # Lendo da cópia colunar (mapeada em memória), mesmo resultado
+        arquivo = os.path.join(self.tmpdir, 'csv_risco_example.csv')
+        shutil.copyfile(CSV_RISCO_TEST, arquivo)
+        grava_colunar(arquivo)
+        total = gerente.aplica_risco_arquivo(arquivo, destino, chunksize=2)
+        assert total == 5
+        assert gerente.load_csv(destino) == lista_arquivo
+        total = gerente.aplica_risco_arquivo(arquivo, destino,
+                                             deduplicar=True, chunksize=2)
+        assert total == 4
+        assert gerente.load_csv(destino) == lista_risco
+        for deduplicar in (False, True):
+            tabela_risco = gerente.aplica_risco(df=abre_tabela(arquivo),
+                                                deduplicar=deduplicar)
+            assert tabela_risco == gerente.aplica_risco(
+                self.lista, deduplicar=deduplicar)
+
+    def test_aplica_risco_por_parametros_destino(self):
+        gerente = self.gerente
+        base_csv = os.path.join(self.tmpdir, 'base')
+        os.mkdir(base_csv)
+        shutil.copy(CSV_RISCO_TEST, base_csv)
+        destino = os.path.join(self.tmpdir, 'resultado.csv')
+
+        def sessao(valor):
+            parametro = type('ParametroRisco', (object, ), {
+                'nome_campo': 'alimento',
+                'valores': [type('ValorParametro', (object, ),
+                                 {'valor': valor,
+                                  'tipo_filtro': Filtro.igual})]})
+            padrao = type('PadraoRisco', (object, ),
+                          {'parametros': [parametro]})
+            consulta = mock.MagicMock()
+            consulta.filter.return_value.first.return_value = padrao
+            return mock.MagicMock(**{'query.return_value': consulta})
+        total = gerente.aplica_risco_por_parametros(
+            sessao('bacon'), visaoid='0', base_csv=base_csv,
+            destino=destino)
+        assert total == 1
+        assert gerente.load_csv(destino)[1][0] == 'bacon'
+        # Nenhuma linha selecionada: arquivo não é criado
+        os.remove(destino)
+        total = gerente.aplica_risco_por_parametros(
+            sessao('inexistente'), visaoid='0', base_csv=base_csv,
+            destino=destino)
+        assert total == 0
+        assert not os.path.exists(destino)
+
+    def test_pre_processa_arquivos(self):
+        gerente = self.gerente
+        arquivo = os.path.join(self.tmpdir, 'alimentoseesportes.csv')
+        shutil.copyfile(CSV_ALIMENTOS, arquivo)
+        depara = type('DePara', (object, ),
+                      {'titulo_ant': 'alimento',
+                       'titulo_novo': 'comida'})
+        base = type('BaseOrigem', (object, ), {'deparas': [depara]})
+        gerente.ativa_sanitizacao()
+        gerente.checa_depara(base)
+        esperado = gerente.pre_processa(gerente.load_csv(arquivo))
+        gerente.pre_processa_arquivos([(arquivo, 'single csv')])
+        lista = gerente.load_csv(arquivo)
+        assert lista == esperado
+        assert 'comida' in lista[0]
+
+    def test_pre_processa_titulos(self):
+        gerente = self.gerente
+        arquivo = os.path.join(self.tmpdir, 'alimentoseesportes.csv')
+        shutil.copyfile(CSV_ALIMENTOS, arquivo)
+        depara = type('DePara', (object, ),
+                      {'titulo_ant': 'alimento',
+                       'titulo_novo': 'comida'})
+        base = type('BaseOrigem', (object, ), {'deparas': [depara]})
+        gerente.checa_depara(base)
+        gerente.pre_processa_arquivos([arquivo])
+        with open(CSV_ALIMENTOS, 'rb') as original, \
+                open(arquivo, 'rb') as processado:
+            original.readline()
+            assert b'comida' in processado.readline()
+            # Somente a linha de títulos é reescrita
+            assert original.read() == processado.read()
+
+    def test_filtros_compilados(self):
+        automato = AhoCorasick(['he', 'she', 'his', 'hers'])
+        assert automato.busca('ushers') == 'she'
+        assert automato.busca('ahis') == 'his'
+        assert automato.busca('xyz') is None
+        prefixo = FiltroPrefixo(['0123', '01', '456', '4567'])
+        assert prefixo.encontra('0199') == '01'
+        assert prefixo.encontra('4567000') == '456'
+        assert prefixo.encontra('0') is None
+        lista = [['cnpj', 'nome'],
+                 ['01234', 'bacon defumado'],
+                 ['45600', 'coxinha'],
+                 ['99999', 'sem bacon'],
+                 ['', 'surf']]
+        result = prefixo.filtra(lista, 'cnpj')
+        assert result == [['01234', 'bacon defumado'], ['45600', 'coxinha']]
+        contem = FiltroContem(['bacon', 'xinh', 'bac'])
+        result = contem.filtra(lista, 'nome')
+        assert len(result) == 3
+
     def test_aplica_namedcsv(self):
         lista = self.lista
         gerente = self.gerente
@@ -261,6 +451,42 @@ class TestGerenteRisco(unittest.TestCase):
         print(result)
         assert len(result) == 7
         gerente.aplica_juncao(capitulos_livro, path=path, filtrar=True)
+        # Mesmo resultado lendo das cópias colunares
+        path_colunar = os.path.join(self.tmpdir, 'juncoes')
+        shutil.copytree(path, path_colunar)
+        for arquivo in lista_arquivos_base(path_colunar):
+            grava_colunar(os.path.join(path_colunar, arquivo))
+        result_colunar = gerente.aplica_juncao(capitulos_livro,
+                                               path=path_colunar)
+        assert str(result_colunar) == str(result)
+        # Filtro em campo de uma só tabela, aplicado antes da junção
+        livro2 = type('ValorParametro', (object, ),
+                      {'tipo_filtro': Filtro.igual,
+                       'valor': '2'
+                       })
+        livros = type('ParametroRisco', (object, ),
+                      {'nome_campo': 'livro',
+                       'valores': [livro2]}
+                      )
+        gerente.add_risco(livros)
+        result = gerente.aplica_juncao(autores_livro, path=path)
+        esperado = gerente.aplica_risco(result)
+        result = gerente.aplica_juncao(autores_livro, path=path,
+                                       filtrar=True)
+        assert len(result) == 2
+        assert result == esperado
+        # Com cache: junção gravada na primeira chamada e reutilizada
+        parametros = [{'filtrar': True, 'deduplicar': False},
+                      {'filtrar': True, 'deduplicar': True},
+                      {'filtrar': False}]
+        esperados = [str(gerente.aplica_juncao(autores_livro, path=path,
+                                               **kwargs))
+                     for kwargs in parametros]
+        gerente.ativa_cache_juncao(os.path.join(self.tmpdir, 'cache'))
+        for _ in range(2):
+            for kwargs, esperado in zip(parametros, esperados):
+                assert str(gerente.aplica_juncao(
+                    autores_livro, path=path, **kwargs)) == esperado
         # assert False  # Uncomment to view output
 
     def test_headers(self):
@@ -296,6 +522,9 @@ class TestGerenteRisco(unittest.TestCase):
         assert os.path.isfile(os.path.join(CSV_FOLDER_DEST, '2',
                                            data[:4], data[5:7], data[8:10],
                                            os.path.basename(CSV_ADITIVOS)))
+        assert colunar_atualizado(os.path.join(
+            CSV_FOLDER_DEST, '2', data[:4], data[5:7], data[8:10],
+            os.path.basename(CSV_ADITIVOS)))
         with self.assertRaises(FileExistsError):
             gerente.importa_base(CSV_FOLDER_DEST,
                                  '2',
@@ -309,6 +538,23 @@ class TestGerenteRisco(unittest.TestCase):
                                  CSV_ADITIVOS)
         shutil.rmtree(CSV_FOLDER_DEST)
 
+    def test_importa_base_sanitiza(self):
+        # Como o worker importar_base: importa o sch e depois sanitiza
+        gerente = self.gerente
+        lista_arquivos = gerente.importa_base(
+            self.tmpdir, '1', '2017-12-21',
+            os.path.join(SAMPLES_DIR, 'sch', '1.zip'))
+        escala = [arquivo for arquivo, _ in lista_arquivos
+                  if arquivo.endswith('Escala.csv')][0]
+        dtypes = dtypes_sch(escala)
+        assert dtypes['DataBloqueio1'] == 'datetime64[ns]'
+        gerente.ativa_sanitizacao(ascii_sanitizar)
+        gerente.pre_processa_arquivos(lista_arquivos)
+        assert colunar_atualizado(escala)
+        # Tipos do sch mantidos, com os títulos sanitizados
+        assert dtypes_sch(escala) == {coluna.lower(): dtype
+                                      for coluna, dtype in dtypes.items()}
+
     def test_loadmongo(self):
         gerente = self.gerente
         db = self.mongodb
@@ -339,6 +585,180 @@ class TestGerenteRisco(unittest.TestCase):
         gerente.csv_to_mongo(db, base, arquivo=CSV_ALIMENTOS)
         # assert False
 
+    def test_tomongo_lotes(self):
+        db = self.mongodb
+        base = type('BaseOrigem', (object, ), {'nome': 'baseteste'})
+        inseridos = GerenteRisco.csv_to_mongo(db, base,
+                                              arquivo=CSV_ALIMENTOS,
+                                              tamanho_lote=2)
+        collection = db['baseteste.alimentoseesportes']
+        assert inseridos == {'baseteste.alimentoseesportes': 5}
+        assert collection.count_documents({}) == 5
+        assert collection.find_one({'alimento': 'alface'},
+                                   {'_id': 0}) == {'alimento': 'alface',
+                                                   ' esporte': ' golfe'}
+        # Duplicados não interrompem o lote
+        collection.delete_many({'alimento': {'$ne': 'alface'}})
+        collection.create_index('alimento', unique=True)
+        inseridos = GerenteRisco.csv_to_mongo(db, base,
+                                              arquivo=CSV_ALIMENTOS,
+                                              tamanho_lote=3)
+        assert inseridos == {'baseteste.alimentoseesportes': 4}
+        assert collection.count_documents({}) == 5
+
+    @unittest.skipUnless(mongomock_bulk_update(),
+                         'mongomock não suporta bulk_write com UpdateOne')
+    def test_tomongo_chave(self):
+        db = self.mongodb
+        tabela = Tabela('alimentoseesportes', None, None, None, None,
+                        chave='Alimento')
+        visao = type('Visao', (object, ), {'tabelas': [tabela]})
+        base = type('BaseOrigem', (object, ), {'nome': 'basechave',
+                                               'visoes': [visao]})
+        collection = db['basechave.alimentoseesportes']
+        for _ in range(2):
+            inseridos = GerenteRisco.csv_to_mongo(db, base,
+                                                  arquivo=CSV_ALIMENTOS,
+                                                  tamanho_lote=2)
+            assert collection.count_documents({}) == 5
+        # Segunda vez, todos já existem
+        assert inseridos == {'basechave.alimentoseesportes': 0}
+        indices = collection.index_information().values()
+        assert [indice['key'] for indice in indices
+                if indice.get('unique')] == [[('alimento', 1)]]
+
+    def test_tomongo_chave_operacoes(self):
+        # Não depende do suporte do mongomock a bulk_write com UpdateOne
+        tabela = Tabela('alimentoseesportes', None, None, None, None,
+                        chave='Alimento')
+        visao = type('Visao', (object, ), {'tabelas': [tabela]})
+        base = type('BaseOrigem', (object, ), {'nome': 'basechave',
+                                               'visoes': [visao]})
+        nome = 'basechave.alimentoseesportes'
+        collection = ColecaoFalsa(nome)
+        inseridos = GerenteRisco.csv_to_mongo(BancoFalso({nome: collection}),
+                                              base, arquivo=CSV_ALIMENTOS,
+                                              tamanho_lote=2)
+        assert inseridos == {nome: 5}
+        assert collection.indices == [([('alimento', pymongo.ASCENDING)],
+                                       True)]
+        assert collection.inseridos == []
+        assert len(collection.operacoes) == 5
+        assert collection.operacoes[0] == pymongo.UpdateOne(
+            {'alimento': 'alface'},
+            {'$set': {'alimento': 'alface', ' esporte': ' golfe'}},
+            upsert=True)
+        # Coleção com duplicados: índice único falha, grava sem chave
+        collection = ColecaoFalsa(nome, pymongo.errors.DuplicateKeyError(
+            'E11000 duplicate key error', DUPLICATE_KEY))
+        inseridos = GerenteRisco.csv_to_mongo(BancoFalso({nome: collection}),
+                                              base, arquivo=CSV_ALIMENTOS)
+        assert inseridos == {nome: 5}
+        assert collection.operacoes == []
+        assert [documento['alimento'] for documento in
+                collection.inseridos][:2] == ['alface', 'aspargos']
+
+    def test_filtro_mongo(self):
+        gerente = self.gerente
+        collection = self.mongodb['baseteste.alimentos']
+        collection.insert_many([{'alimento': alimento} for alimento in
+                                ('bacon', 'coxinha', 'arroz', 'a.c', 'abc',
+                                 'pão de queijo')])
+        assert gerente.filtro_mongo() == {}
+        valores = [('bacon', Filtro.igual), ('cox', Filtro.comeca_com),
+                   ('a.', Filtro.comeca_com), ('queijo', Filtro.contem),
+                   ('ro', Filtro.contem)]
+        alimentos = type('ParametroRisco', (object, ), {
+            'nome_campo': 'alimento',
+            'valores': [type('ValorParametro', (object, ),
+                             {'valor': valor, 'tipo_filtro': tipo})
+                        for valor, tipo in valores]})
+        gerente.add_risco(alimentos)
+        filtro = gerente.filtro_mongo()
+        assert len(filtro['$or']) == 3
+        encontrados = [documento['alimento'] for documento in
+                       collection.find(filtro).sort('alimento')]
+        # 'a.' é prefixo literal: não encontra 'abc'
+        assert encontrados == ['a.c', 'arroz', 'bacon', 'coxinha',
+                               'pão de queijo']
+        # Sem documentos que atendam, não retorna a coleção inteira
+        collection.delete_many(filtro)
+        assert gerente.load_mongo(self.mongodb,
+                                  collection_name='baseteste.alimentos') == []
+
+    def test_filtro_mongo_tipos(self):
+        # csv_to_mongo grava datas do sch como datetime e números como float
+        gerente = self.gerente
+        collection = self.mongodb['baseteste.bloqueios']
+        collection.insert_many([
+            {'conteiner': 'abcu1234567', 'quantidade': 2.0,
+             'datasituacao': datetime.datetime(2019, 2, 1)},
+            {'conteiner': 'defu7654321', 'quantidade': 1.0,
+             'datasituacao': None},
+            {'conteiner': 'ghiu0000000', 'quantidade': None,
+             'datasituacao': datetime.datetime(2019, 3, 1)}])
+
+        def parametro(nome_campo, valores):
+            return type('ParametroRisco', (object, ), {
+                'nome_campo': nome_campo,
+                'valores': [type('ValorParametro', (object, ),
+                                 {'valor': valor, 'tipo_filtro': tipo})
+                            for valor, tipo in valores]})
+        gerente.add_risco(parametro('datasituacao',
+                                    [('01/02/2019', Filtro.igual),
+                                     ('inválida', Filtro.igual)]))
+        gerente.add_risco(parametro('quantidade', [('2', Filtro.igual),
+                                                   ('1', Filtro.comeca_com)]))
+        filtro = gerente.filtro_mongo(collection=collection)
+        # comeca_com em campo numérico é ignorado, com aviso
+        assert filtro == {'$or': [
+            {'datasituacao': {'$in': [datetime.datetime(2019, 2, 1)]}},
+            {'quantidade': {'$in': [2.0]}}]}
+        lista = gerente.load_mongo(self.mongodb,
+                                   collection_name='baseteste.bloqueios')
+        assert [linha[0] for linha in lista[1:]] == ['abcu1234567']
+        # Nenhum filtro aplicável: nenhum documento, e não a coleção toda
+        assert gerente.filtro_mongo(['quantidade'], collection) == \
+            {'$or': [{'quantidade': {'$in': [2.0]}}]}
+        gerente.clear_risco()
+        gerente.add_risco(parametro('quantidade', [('1', Filtro.contem)]))
+        assert gerente.filtro_mongo(collection=collection) is None
+        assert gerente.load_mongo(self.mongodb,
+                                  collection_name='baseteste.bloqueios') == []
+        # Sem coleção, valores comparados como texto
+        assert gerente.filtro_mongo() == \
+            {'$or': [{'quantidade': {'$regex': '1'}}]}
+
+    def test_itera_mongo(self):
+        gerente = self.gerente
+        base = type('BaseOrigem', (object, ), {'nome': 'baseteste'})
+        GerenteRisco.csv_to_mongo(self.mongodb, base, arquivo=CSV_ALIMENTOS)
+        linhas = gerente.itera_mongo(
+            self.mongodb, collection_name='baseteste.alimentoseesportes',
+            batch_size=2)
+        assert next(linhas) == ['alimento', ' esporte']
+        assert next(linhas) == ['alface', ' golfe']
+        # Todas as linhas, sem _id: títulos e os 5 documentos
+        lista = gerente.load_mongo(self.mongodb, base=base)
+        assert len(lista) == 6
+        assert lista[-1] == ['coxinha', ' surf']
+        assert gerente.load_mongo(self.mongodb, base=base,
+                                  limit=2, skip=1)[1:] == \
+            [['aspargos', ' basejump'], ['bacon', ' criquete']]
+        destino = os.path.join(self.tmpdir, 'mongo.csv')
+        assert gerente.load_mongo(self.mongodb, base=base,
+                                  destino=destino) == 5
+        assert gerente.load_csv(destino) == lista
+        # limit é aplicado em cada coleção; para limitar o total das
+        # coleções da base (tela), islice sobre itera_mongo
+        GerenteRisco.csv_to_mongo(self.mongodb, base, arquivo=CSV_ADITIVOS)
+        todas = gerente.load_mongo(self.mongodb, base=base)
+        assert len(todas) == 10
+        assert len(gerente.load_mongo(self.mongodb, base=base,
+                                      limit=4)) == 9
+        assert list(itertools.islice(
+            gerente.itera_mongo(self.mongodb, base=base), 8)) == todas[:8]
+
     """def test_juntamongo(self):
         gerente = self.gerente
         db = self.mongodb
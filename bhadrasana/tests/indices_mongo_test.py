@@ -0,0 +1,50 @@
+import unittest
+
+import mongomock
+
+from bhadrasana.tests.juncao_test import tabela
+from bhadrasana.utils.indices_mongo import garante_indices
+
+
+def base():
+    parametros = [type('ParametroRisco', (object, ), {'nome_campo': nome})
+                  for nome in ('Conteiner', 'ncm')]
+    padrao = type('PadraoRisco', (object, ), {'parametros': parametros})
+    visao = type('Visao', (object, ), {
+        'tabelas': [tabela('Conhecimento.csv', 'conhecimento'),
+                    tabela('Container.csv', 'conhecimento', 'Conhecimento')]})
+    return type('BaseOrigem', (object, ), {'nome': 'CARGA',
+                                           'padroes': [padrao],
+                                           'visoes': [visao]})
+
+
+class TestIndicesMongo(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient()['unit_test']
+        self.db['CARGA.Conhecimento'].insert_one(
+            {'conhecimento': '1', 'tipo': 'mbl'})
+        self.db['CARGA.Container'].insert_one(
+            {'conhecimento': '1', 'conteiner': 'cheio'})
+        self.db['CARGA.Container'].create_index('tipo', name='idxtipo')
+        self.db['OUTRA.Container'].insert_one({'conteiner': 'vazio'})
+
+    def test_garante_indices(self):
+        relatorio = garante_indices(self.db, base(), criar=False)
+        assert sorted(relatorio) == ['CARGA.Conhecimento', 'CARGA.Container']
+        container = relatorio['CARGA.Container']
+        assert container['criados'] == []
+        assert container['faltantes'] == ['conhecimento', 'conteiner']
+        assert container['nao_previstos'] == ['idxtipo']
+        assert relatorio['CARGA.Conhecimento']['faltantes'] == []
+        relatorio = garante_indices(self.db, base())
+        assert relatorio['CARGA.Container']['criados'] == \
+            ['conhecimento', 'conteiner']
+        campos = [info['key'][0][0] for info in
+                  self.db['CARGA.Container'].index_information().values()]
+        assert 'conteiner' in campos
+        # Já existentes não são criados de novo
+        relatorio = garante_indices(self.db, base())
+        assert relatorio['CARGA.Container']['criados'] == []
+        assert self.db['OUTRA.Container'].index_information().keys() == \
+            {'_id_'}
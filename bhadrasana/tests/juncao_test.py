@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from bhadrasana.utils.gerente_risco import GerenteRisco
+from bhadrasana.utils.juncao import planeja_juncao, semi_juncao
+
+JUNCOES = 'bhadrasana/tests/juncoes'
+
+
+def tabela(csv_file, primario, estrangeiro=None, **kwargs):
+    atributos = {'csv_table': csv_file[:-4],
+                 'csv_file': csv_file,
+                 'primario': primario,
+                 'estrangeiro': estrangeiro}
+    atributos.update(kwargs)
+    return type('Tabela', (object, ), atributos)
+
+
+def visao(tabelas, colunas=()):
+    colunas = [type('Coluna', (object, ), {'nome': nome})
+               for nome in colunas]
+    return type('Visao', (object, ), {'nome': 'teste',
+                                      'tabelas': tabelas,
+                                      'colunas': colunas})
+
+
+LIVROS = tabela('livros.csv', 'livro')
+CAPITULOS = tabela('capitulos.csv', 'capitulo', 'livroid')
+SUBCAPITULOS = tabela('subcapitulos.csv', 'subcapitulo', 'capituloid',
+                      type='outer')
+
+
+CONTEINERES = tabela('conteineres.csv', 'conhecimento_c')
+CONHECIMENTOS = tabela('conhecimentos.csv', 'manifesto_c', 'conhecimento')
+MANIFESTOS = tabela('manifestos.csv', 'manifesto', 'manifesto')
+
+
+class TestJuncao(unittest.TestCase):
+
+    def test_plano_sem_colunas(self):
+        plano = planeja_juncao(visao([LIVROS, CAPITULOS]), JUNCOES)
+        assert plano.colunas is None
+        assert [etapa.colunas for etapa in plano.etapas] == [None, None]
+        etapa = plano.etapas[1]
+        assert (etapa.how, etapa.left_on, etapa.right_on) == \
+            ('inner', 'livro', 'livroid')
+
+    def test_projecao(self):
+        plano = planeja_juncao(
+            visao([LIVROS, CAPITULOS, SUBCAPITULOS], ['titulo']), JUNCOES)
+        assert plano.colunas == ['titulo']
+        colunas = [etapa.colunas for etapa in plano.etapas]
+        # nome existe em duas tabelas: mantido para o merge gerar os
+        # mesmos nomes (nome_x, nome_y) da leitura completa
+        assert colunas == [['livro', 'titulo'],
+                           ['capitulo', 'nome', 'livroid'],
+                           ['nome', 'capituloid']]
+        # Campos com risco são lidos somente se estão no resultado
+        plano = planeja_juncao(
+            visao([LIVROS, CAPITULOS, SUBCAPITULOS], ['titulo']), JUNCOES,
+            campos_risco=['subcapitulo'])
+        assert plano.etapas[2].colunas == ['nome', 'capituloid']
+        plano = planeja_juncao(
+            visao([LIVROS, CAPITULOS, SUBCAPITULOS],
+                  ['titulo', 'subcapitulo']), JUNCOES,
+            campos_risco=['subcapitulo'])
+        assert plano.campos_risco == ['subcapitulo']
+        assert plano.etapas[2].colunas == ['subcapitulo', 'nome',
+                                           'capituloid']
+
+    def test_planeja_filtro(self):
+        plano = planeja_juncao(visao([LIVROS, CAPITULOS]), JUNCOES,
+                               campos_risco=['titulo', 'inexistente'])
+        assert plano.campos_risco == ['titulo']
+        assert plano.etapa_filtro == 0
+        # Campos de tabelas diferentes
+        plano = planeja_juncao(visao([LIVROS, CAPITULOS]), JUNCOES,
+                               campos_risco=['titulo', 'capitulo'])
+        assert plano.etapa_filtro is None
+        # Junção 'outer'
+        capitulos = tabela('capitulos.csv', 'capitulo', 'livroid',
+                           type='outer')
+        plano = planeja_juncao(visao([LIVROS, capitulos, SUBCAPITULOS]),
+                               JUNCOES, campos_risco=['titulo'])
+        assert plano.etapa_filtro is None
+
+    def test_semi_juncao(self):
+        plano = planeja_juncao(visao([LIVROS, CAPITULOS]), JUNCOES)
+        livros = pd.DataFrame({'livro': ['1', '2', '3'],
+                               'titulo': ['a', 'b', 'c']})
+        capitulos = pd.DataFrame({'capitulo': ['1', '2', '3'],
+                                  'livroid': ['2', '2', '4']})
+        livros, capitulos = semi_juncao(plano, [livros[1:], capitulos])
+        assert livros['livro'].tolist() == ['2']
+        assert capitulos['capitulo'].tolist() == ['1', '2']
+
+    def test_ordena_etapas(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        conteineres = pd.DataFrame(
+            {'conteiner': [str(ind) for ind in range(8)],
+             'conhecimento_c': ['1', '2', '3', '4', '1', '2', '3', '4']})
+        conhecimentos = pd.DataFrame(
+            {'conhecimento': ['1', '2', '3', '4'],
+             'manifesto_c': ['10', '10', '11', '12']})
+        manifestos = pd.DataFrame({'manifesto': ['10', '11'],
+                                   'porto': ['BRSSZ', 'CNSHA']})
+        for nome, df in (('conteineres', conteineres),
+                         ('conhecimentos', conhecimentos),
+                         ('manifestos', manifestos)):
+            df.to_csv(os.path.join(tmpdir, nome + '.csv'), index=False)
+        tabelas = [CONTEINERES, CONHECIMENTOS, MANIFESTOS]
+        plano = planeja_juncao(visao(tabelas), tmpdir, reordenar=False)
+        assert not plano.reordenado
+        plano = planeja_juncao(visao(tabelas), tmpdir)
+        assert plano.reordenado
+        assert [(etapa.tabela.csv_file, etapa.left_on, etapa.right_on)
+                for etapa in plano.etapas] == \
+            [('manifestos.csv', None, None),
+             ('conhecimentos.csv', 'manifesto', 'manifesto_c'),
+             ('conteineres.csv', 'conhecimento', 'conhecimento_c')]
+        # Mesmo resultado da junção na ordem da Visao
+        esperado = conteineres.merge(
+            conhecimentos, left_on='conhecimento_c',
+            right_on='conhecimento').merge(
+            manifestos, left_on='manifesto_c', right_on='manifesto')
+        result = GerenteRisco().aplica_juncao(visao(tabelas), path=tmpdir)
+        assert result[0] == esperado.columns.tolist()
+        assert sorted(result[1:]) == sorted(esperado.values.tolist())
+
+    def test_ordena_etapas_chaves_mesmo_nome(self):
+        # Cadeia do Carga: as chaves têm o mesmo nome nas duas tabelas
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        conteineres = pd.DataFrame(
+            {'conteiner': [str(ind) for ind in range(40)],
+             'conhecimento': [str(ind % 8) for ind in range(40)]})
+        conhecimentos = pd.DataFrame(
+            {'conhecimento': [str(ind) for ind in range(8)],
+             'manifesto': [str(ind % 4) for ind in range(8)]})
+        manifestos = pd.DataFrame({'manifesto': ['0', '1', '2', '3'],
+                                   'escala': ['a', 'a', 'b', 'c']})
+        escalas = pd.DataFrame({'escala': ['a'], 'porto': ['BRSSZ']})
+        for nome, df in (('conteineres', conteineres),
+                         ('conhecimentos', conhecimentos),
+                         ('manifestos', manifestos), ('escalas', escalas)):
+            df.to_csv(os.path.join(tmpdir, nome + '.csv'), index=False)
+        tabelas = [tabela('conteineres.csv', 'conhecimento'),
+                   tabela('conhecimentos.csv', 'manifesto', 'conhecimento'),
+                   tabela('manifestos.csv', 'escala', 'manifesto'),
+                   tabela('escalas.csv', None, 'escala')]
+        plano = planeja_juncao(visao(tabelas), tmpdir)
+        assert plano.reordenado
+        assert [etapa.tabela.csv_file for etapa in plano.etapas] == \
+            ['escalas.csv', 'manifestos.csv', 'conhecimentos.csv',
+             'conteineres.csv']
+        assert plano.colunas == ['conteiner', 'conhecimento', 'manifesto',
+                                 'escala', 'porto']
+        esperado = conteineres.merge(conhecimentos, on='conhecimento').merge(
+            manifestos, on='manifesto').merge(escalas, on='escala')
+        result = GerenteRisco().aplica_juncao(visao(tabelas), path=tmpdir)
+        assert result[0] == esperado.columns.tolist()
+        assert sorted(result[1:]) == sorted(esperado.values.tolist())
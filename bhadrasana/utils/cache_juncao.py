@@ -0,0 +1,147 @@
+"""Cache em disco dos resultados de junção (Visao) das bases em csv.
+
+A mesma Visao costuma ser aplicada várias vezes sobre a mesma base
+(CSV/<baseid>/AAAA/MM/DD), mudando apenas os parâmetros de risco. O
+resultado da junção, antes dos filtros, é gravado em formato colunar
+(Arrow IPC, o mesmo das cópias de :mod:`bhadrasana.utils.colunar`) e
+reutilizado enquanto a definição da Visao e os arquivos não mudarem:
+somente os filtros são aplicados de novo.
+
+A chave de cada resultado combina o id da Visao, um hash da sua definição
+(tabelas, chaves e colunas) e os caminhos e datas de modificação dos
+arquivos da base. Os resultados menos usados recentemente são excluídos
+quando o diretório do cache passa de tamanho_maximo bytes.
+"""
+import hashlib
+import json
+import os
+
+from ajna_commons.flask.log import logger
+from bhadrasana.utils import colunar
+
+EXTENSAO_CACHE = colunar.EXTENSAO_COLUNAR
+
+
+def definicao_visao(visao):
+    """Retorna dict com o que define o resultado da junção da visao."""
+    return {
+        'tabelas': [[tabela.csv_file,
+                     getattr(tabela, 'primario', None),
+                     getattr(tabela, 'estrangeiro', None),
+                     getattr(tabela, 'type', None)]
+                    for tabela in visao.tabelas],
+        'colunas': [coluna.nome for coluna in visao.colunas]
+    }
+
+
+class CacheJuncao():
+    """Resultados de junção gravados em diretorio, com descarte LRU.
+
+    Args:
+        diretorio: onde gravar os resultados. É criado se não existir
+
+        tamanho_maximo: tamanho total máximo, em bytes, dos resultados
+
+    """
+
+    def __init__(self, diretorio, tamanho_maximo):
+        """Guarda configurações. Nada é gravado antes de :func:`grava`."""
+        self.diretorio = diretorio
+        self.tamanho_maximo = tamanho_maximo
+
+    def chave(self, visao, path):
+        """Retorna a chave do resultado da junção da visao sobre path.
+
+        Muda se a definição da visao ou algum dos arquivos mudar.
+        """
+        arquivos = []
+        for tabela in visao.tabelas:
+            arquivo = os.path.abspath(os.path.join(path, tabela.csv_file))
+            try:
+                modificacao = os.stat(arquivo).st_mtime_ns
+            except OSError:
+                modificacao = None
+            arquivos.append([arquivo, modificacao])
+        conteudo = definicao_visao(visao)
+        conteudo['arquivos'] = arquivos
+        resumo = hashlib.sha1(json.dumps(conteudo, sort_keys=True).encode(
+            'utf-8')).hexdigest()
+        return 'visao%s-%s' % (getattr(visao, 'id', ''), resumo)
+
+    def caminho(self, chave):
+        """Retorna o caminho do arquivo do resultado da chave."""
+        return os.path.join(self.diretorio, chave + EXTENSAO_CACHE)
+
+    def le(self, chave):
+        """Retorna o resultado da chave como Table pyarrow, ou None.
+
+        O arquivo é mapeado em memória: somente as colunas acessadas são
+        carregadas (ver :func:`bhadrasana.utils.colunar.abre_tabela`).
+        """
+        if colunar.pa is None:
+            return None
+        caminho = self.caminho(chave)
+        try:
+            origem = colunar.pa.memory_map(caminho)
+        except (FileNotFoundError, OSError):
+            return None
+        tabela = colunar.pa.ipc.open_file(origem).read_all()
+        os.utime(caminho)  # Último uso, para o descarte LRU
+        return tabela
+
+    def grava(self, chave, df):
+        """Grava o resultado df (DataFrame de textos) na chave.
+
+        Depois da gravação, descarta os resultados menos usados até que o
+        cache caiba em tamanho_maximo.
+
+        Returns:
+            Caminho do arquivo gravado, ou None se não foi gravado
+
+        """
+        pa = colunar.pa
+        if pa is None:
+            return None
+        nomes = [str(coluna) for coluna in df.columns]
+        if len(set(nomes)) != len(nomes):
+            return None
+        destino = self.caminho(chave)
+        schema = pa.schema([(nome, pa.string()) for nome in nomes])
+        tabela = pa.Table.from_pandas(df.astype(object), schema=schema,
+                                      preserve_index=False)
+        colunar.grava_tabela(destino, tabela)
+        self.descarta()
+        return destino
+
+    def descarta(self):
+        """Exclui os resultados menos usados além de tamanho_maximo.
+
+        Returns:
+            lista dos arquivos excluídos
+
+        """
+        arquivos = []
+        for nome in os.listdir(self.diretorio):
+            if not nome.endswith(EXTENSAO_CACHE):
+                continue
+            caminho = os.path.join(self.diretorio, nome)
+            try:
+                info = os.stat(caminho)
+            except OSError:
+                continue
+            arquivos.append((info.st_mtime, info.st_size, caminho))
+        total = sum(tamanho for _, tamanho, _ in arquivos)
+        excluidos = []
+        for _, tamanho, caminho in sorted(arquivos):
+            if total <= self.tamanho_maximo:
+                break
+            try:
+                os.remove(caminho)
+            except OSError:
+                continue
+            total -= tamanho
+            excluidos.append(caminho)
+        if excluidos:
+            logger.debug('Cache de junções: %s arquivos descartados' %
+                         len(excluidos))
+        return excluidos
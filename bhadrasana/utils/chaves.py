@@ -0,0 +1,345 @@
+"""Índice das colunas chave das bases, para junções por posição.
+
+Para cada coluna usada como chave de junção (primario/estrangeiro de uma
+Tabela) em um csv de base importada, :func:`le_indice` monta um
+:class:`IndiceChave`: os valores distintos da coluna e, para cada linha, o
+código (posição) do seu valor. O índice é gravado no diretório da cópia
+colunar (ver :mod:`bhadrasana.utils.colunar`) como coluna Arrow
+dictionary-encoded, e reutilizado enquanto for mais novo que o csv: a
+coluna é lida e fatorada uma única vez por dia importado. Arquivos sem
+cópia colunar (não importados pela aplicação) têm o índice montado em
+memória a cada junção, sem gravar nada no seu diretório.
+
+Com os índices, :func:`junta` executa a junção de um
+:class:`bhadrasana.utils.juncao.PlanoJuncao` como operações sobre arrays
+de inteiros: só os valores distintos das chaves são comparados, e as
+colunas do resultado são copiadas uma única vez, ao final.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from ajna_commons.flask.log import logger
+from bhadrasana.utils import colunar
+from bhadrasana.utils.juncao import SUFIXOS_MERGE
+
+EXTENSAO_CHAVE = '.chave' + colunar.EXTENSAO_COLUNAR
+
+# Tipos de junção executados por junta. Os demais usam DataFrame.merge
+JUNCOES_INDICE = ('inner', 'left')
+
+# Traduções entre índices mantidas em memória (ver traducao)
+TAMANHO_CACHE_TRADUCOES = 32
+_traducoes = OrderedDict()
+
+
+class IndiceChave():
+    """Valores distintos de uma coluna e código de cada linha.
+
+    Attributes:
+        codigos: array numpy, para cada linha a posição do valor em
+        valores, ou -1 para nulo
+
+        valores: array numpy com os valores distintos da coluna
+
+    """
+
+    def __init__(self, codigos, valores):
+        """Guarda codigos e valores."""
+        self.codigos = codigos
+        self.valores = valores
+
+    def __len__(self):
+        """Quantidade de linhas."""
+        return len(self.codigos)
+
+
+def caminho_chave(arquivo_csv, coluna):
+    """Retorna o caminho do índice da coluna do arquivo csv."""
+    diretorio, nome = os.path.split(arquivo_csv)
+    nome = os.path.splitext(nome)[0] + '.' + coluna + EXTENSAO_CHAVE
+    return os.path.join(diretorio, colunar.DIR_COLUNAR, nome)
+
+
+def chave_atualizada(arquivo_csv, coluna):
+    """Retorna True se existe índice da coluna mais novo que o csv."""
+    if colunar.pa is None:
+        return False
+    try:
+        return (os.path.getmtime(caminho_chave(arquivo_csv, coluna)) >=
+                os.path.getmtime(arquivo_csv))
+    except OSError:
+        return False
+
+
+def _sem_nulos(codigos, valores):
+    """Troca por -1 os códigos dos textos que pd.read_csv lê como nulos."""
+    nulos = np.flatnonzero(pd.Index(valores).isin(colunar.VALORES_NULOS))
+    if len(nulos) == 0:
+        return codigos
+    troca = np.arange(len(valores))
+    troca[nulos] = -1
+    return np.where(codigos < 0, -1, troca[codigos])
+
+
+def monta_indice(arquivo_csv, coluna):
+    """Lê a coluna do csv (ou da cópia colunar) e monta o índice.
+
+    Os textos são fatorados como estão no arquivo. Os tratados como nulo
+    por pd.read_csv têm código -1, como em
+    :func:`bhadrasana.utils.colunar.le_tabela`.
+
+    Raises:
+        KeyError: se a coluna não existe no arquivo
+
+    """
+    df = colunar.le_tabela(arquivo_csv, nulos=False, colunas=[coluna])
+    codigos, valores = pd.factorize(df[coluna].values)
+    return IndiceChave(_sem_nulos(codigos, valores),
+                       np.asarray(valores, dtype=object))
+
+
+def grava_indice(arquivo_csv, coluna, indice):
+    """Grava o índice da coluna, se pyarrow estiver disponível.
+
+    Raises:
+        OSError: se não foi possível gravar
+
+    """
+    if colunar.pa is None:
+        return None
+    pa = colunar.pa
+    codigos = pa.array(indice.codigos.astype(np.int32),
+                       mask=indice.codigos < 0)
+    array = pa.DictionaryArray.from_arrays(
+        codigos, pa.array(indice.valores, type=pa.string()))
+    tabela = pa.table([array], names=[coluna])
+    return colunar.grava_tabela(caminho_chave(arquivo_csv, coluna), tabela)
+
+
+def _abre_indice(arquivo_csv, coluna):
+    """Lê o índice gravado por :func:`grava_indice`."""
+    pa = colunar.pa
+    with pa.memory_map(caminho_chave(arquivo_csv, coluna)) as origem:
+        tabela = pa.ipc.open_file(origem).read_all()
+    array = tabela.column(0).combine_chunks()
+    codigos = array.indices.fill_null(-1).to_numpy(zero_copy_only=False)
+    valores = array.dictionary.to_numpy(zero_copy_only=False)
+    return IndiceChave(codigos.astype(np.intp), valores.astype(object))
+
+
+def le_indice(arquivo_csv, coluna):
+    """Retorna o índice da coluna do csv, montando se preciso.
+
+    O índice montado (ver :func:`monta_indice`) é gravado somente se o
+    csv tem cópia colunar atualizada, isto é, pertence a uma base
+    importada. Erros de gravação são propagados (ver :func:`junta`).
+    """
+    if chave_atualizada(arquivo_csv, coluna):
+        return _abre_indice(arquivo_csv, coluna)
+    indice = monta_indice(arquivo_csv, coluna)
+    if colunar.colunar_atualizado(arquivo_csv):
+        grava_indice(arquivo_csv, coluna, indice)
+        logger.debug('Índice da chave %s de %s gravado. %s valores' %
+                     (coluna, arquivo_csv, len(indice.valores)))
+    return indice
+
+
+def traducao(valores_esq, valores_dir, chave=None):
+    """Posição de cada valor da esquerda entre os da direita (-1 se não há).
+
+    Se informada a chave (ex: caminhos e datas dos índices), o resultado
+    é guardado em memória e reutilizado nas próximas junções.
+    """
+    if chave is not None and chave in _traducoes:
+        _traducoes.move_to_end(chave)
+        return _traducoes[chave]
+    result = pd.Index(valores_dir).get_indexer(valores_esq)
+    if chave is not None:
+        _traducoes[chave] = result
+        if len(_traducoes) > TAMANHO_CACHE_TRADUCOES:
+            _traducoes.popitem(last=False)
+    return result
+
+
+def junta_posicoes(codigos_esq, valores_esq, codigos_dir, valores_dir,
+                   how='inner', traducao_esq=None):
+    """Junção de duas colunas chave fatoradas, somente com inteiros.
+
+    Como em DataFrame.merge, nulos se juntam a nulos. As linhas do
+    resultado seguem a ordem da esquerda e, para cada linha, a ordem das
+    correspondentes da direita.
+
+    Args:
+        codigos_esq, codigos_dir: códigos de cada linha (-1 para nulo)
+
+        valores_esq, valores_dir: valores distintos correspondentes
+
+        how: 'inner' ou 'left'
+
+        traducao_esq: resultado de :func:`traducao`, se já calculado
+
+    Returns:
+        tupla (posicoes_esq, posicoes_dir) de arrays numpy com as posições
+        das linhas juntadas; em 'left', -1 nas posições da direita sem
+        correspondência
+
+    """
+    nulo = len(valores_dir)
+    # Traduz os códigos da esquerda para os valores da direita
+    if traducao_esq is None:
+        traducao_esq = traducao(valores_esq, valores_dir)
+    chave_esq = np.full(len(codigos_esq), nulo, dtype=np.intp)
+    validos = codigos_esq >= 0
+    chave_esq[validos] = traducao_esq[codigos_esq[validos]]
+    chave_dir = np.where(codigos_dir < 0, nulo, codigos_dir)
+    # Linhas da direita agrupadas por código
+    ordem = np.argsort(chave_dir, kind='stable')
+    contagem = np.bincount(chave_dir, minlength=nulo + 1)
+    inicio = np.cumsum(contagem) - contagem
+    encontrados = np.zeros(len(chave_esq), dtype=np.intp)
+    existe = chave_esq >= 0
+    encontrados[existe] = contagem[chave_esq[existe]]
+    if how == 'inner':
+        linhas = np.flatnonzero(encontrados)
+        repeticoes = encontrados[linhas]
+    else:
+        linhas = np.arange(len(chave_esq))
+        repeticoes = np.maximum(encontrados, 1)
+    posicoes_esq = np.repeat(linhas, repeticoes)
+    deslocamento = np.arange(len(posicoes_esq)) - \
+        np.repeat(np.cumsum(repeticoes) - repeticoes, repeticoes)
+    com_par = np.repeat(encontrados[linhas] > 0, repeticoes)
+    posicoes_dir = np.full(len(posicoes_esq), -1, dtype=np.intp)
+    if com_par.any():
+        primeiro = np.repeat(inicio[np.maximum(chave_esq[linhas], 0)],
+                             repeticoes)
+        posicoes_dir[com_par] = ordem[primeiro[com_par] +
+                                      deslocamento[com_par]]
+    return posicoes_esq, posicoes_dir
+
+
+def _nomes_merge(nomes_esq, nomes_dir, left_on, right_on):
+    """Nomes das colunas de DataFrame.merge(left_on, right_on).
+
+    Returns:
+        tupla (nomes da esquerda, nomes da direita), sem a chave da
+        direita quando tem o mesmo nome da chave da esquerda
+
+    """
+    if left_on == right_on:
+        nomes_dir = [nome for nome in nomes_dir if nome != right_on]
+    comuns = set(nomes_esq) & set(nomes_dir)
+    return ([nome + SUFIXOS_MERGE[0] if nome in comuns else nome
+             for nome in nomes_esq],
+            [nome + SUFIXOS_MERGE[1] if nome in comuns else nome
+             for nome in nomes_dir])
+
+
+def _versao_indice(arquivo_csv, coluna):
+    """Identifica o índice gravado (caminho e data), ou None."""
+    caminho = caminho_chave(arquivo_csv, coluna)
+    try:
+        return caminho, os.path.getmtime(caminho)
+    except OSError:
+        return None
+
+
+def _codigos_df(etapa, df, coluna):
+    """Códigos e valores da coluna para as linhas de df.
+
+    df deve ter sido lido do arquivo da etapa (pode estar filtrado): seu
+    index são as posições das linhas no arquivo.
+    """
+    indice = le_indice(etapa.arquivo, coluna)
+    if len(df) == 0:
+        return np.array([], dtype=np.intp), indice.valores
+    if df.index.dtype.kind not in 'iu' or df.index.max() >= len(indice):
+        raise ValueError('DataFrame não corresponde ao índice de %s' %
+                         etapa.arquivo)
+    return indice.codigos[df.index.values], indice.valores
+
+
+def junta(plano, dfs):
+    """Executa as junções do plano sobre os DataFrames lidos.
+
+    Usa os índices das colunas chave (:func:`le_indice`): cada junção
+    apenas combina arrays de posições, e as colunas do resultado são
+    copiadas uma vez, ao final. As colunas resultantes são as mesmas de
+    DataFrame.merge.
+
+    Args:
+        plano: :class:`bhadrasana.utils.juncao.PlanoJuncao`
+
+        dfs: lista de DataFrames, um por etapa, lidos com
+        :func:`bhadrasana.utils.colunar.le_tabela` (podem estar filtrados,
+        mantendo o index original)
+
+    Returns:
+        DataFrame com o resultado, ou None se o plano tem junções que não
+        são executadas aqui (ver JUNCOES_INDICE), colunas que
+        DataFrame.merge nomearia de outra forma, ou se um índice não pôde
+        ser lido ou gravado: nestes casos, usar DataFrame.merge
+
+    """
+    if any(etapa.how not in JUNCOES_INDICE for etapa in plano.etapas[1:]):
+        return None
+    # Colunas do resultado: (nome, etapa de origem, coluna na origem)
+    colunas = [(nome, 0, nome) for nome in dfs[0].columns]
+    # Posições, em cada DataFrame, das linhas do resultado (-1: sem linha)
+    posicoes = [np.arange(len(dfs[0]))]
+    for ind, etapa in enumerate(plano.etapas[1:], 1):
+        nomes = [nome for nome, _, _ in colunas]
+        nomes_dir = list(dfs[ind].columns)
+        if nomes.count(etapa.left_on) != 1 or \
+                nomes_dir.count(etapa.right_on) != 1:
+            return None
+        _, ind_esq, coluna_esq = colunas[nomes.index(etapa.left_on)]
+        novos_esq, novos_dir = _nomes_merge(nomes, nomes_dir,
+                                            etapa.left_on, etapa.right_on)
+        try:
+            esperado = pd.DataFrame(columns=nomes).merge(
+                pd.DataFrame(columns=nomes_dir), how=etapa.how,
+                left_on=etapa.left_on, right_on=etapa.right_on)
+        except (KeyError, ValueError):
+            return None
+        if esperado.columns.tolist() != novos_esq + novos_dir or \
+                len(set(novos_esq + novos_dir)) != len(esperado.columns):
+            return None
+        etapa_esq = plano.etapas[ind_esq]
+        try:
+            codigos_tabela, valores_esq = _codigos_df(
+                etapa_esq, dfs[ind_esq], coluna_esq)
+            codigos_dir, valores_dir = _codigos_df(
+                etapa, dfs[ind], etapa.right_on)
+        except (KeyError, ValueError, OSError) as err:
+            # Ex: falha ao gravar o índice. A junção é feita por merge
+            logger.warning('Índice de chaves não utilizado: %s' % err)
+            return None
+        chave = (_versao_indice(etapa_esq.arquivo, coluna_esq),
+                 _versao_indice(etapa.arquivo, etapa.right_on))
+        if None in chave:
+            chave = None
+        traducao_esq = traducao(valores_esq, valores_dir, chave)
+        linhas_esq = posicoes[ind_esq]
+        codigos_esq = np.full(len(linhas_esq), -1, dtype=np.intp)
+        validas = linhas_esq >= 0
+        codigos_esq[validas] = codigos_tabela[linhas_esq[validas]]
+        pos_esq, pos_dir = junta_posicoes(codigos_esq, valores_esq,
+                                          codigos_dir, valores_dir,
+                                          etapa.how, traducao_esq)
+        posicoes = [posicao[pos_esq] for posicao in posicoes]
+        posicoes.append(pos_dir)
+        colunas = [(nome, origem, coluna) for nome, (_, origem, coluna)
+                   in zip(novos_esq, colunas)]
+        if etapa.left_on == etapa.right_on:
+            nomes_dir.remove(etapa.right_on)
+        colunas.extend((nome, ind, coluna) for nome, coluna
+                       in zip(novos_dir, nomes_dir))
+    dados = {}
+    for nome, origem, coluna in colunas:
+        dados[nome] = pd.api.extensions.take(
+            dfs[origem][coluna].values, posicoes[origem], allow_fill=True)
+    return pd.DataFrame(dados, columns=[nome for nome, _, _ in colunas])
@@ -0,0 +1,502 @@
+"""Cópia colunar (Feather/Arrow IPC) dos csv das bases importadas.
+
+Cada arquivo csv de uma base importada (CSV/<baseid>/AAAA/MM/DD) pode ter
+uma cópia em formato colunar, gravada no subdiretório oculto DIR_COLUNAR
+do mesmo diretório, com o mesmo nome e extensão .feather. A cópia guarda
+os textos exatamente como estão no csv (todas as colunas como texto) e
+só é usada enquanto for mais nova que o csv. Assim, ler de novo uma base
+já importada não exige interpretar o csv novamente.
+
+pyarrow é opcional: se não estiver instalado, nenhuma cópia é gravada e
+todas as leituras são feitas diretamente dos csv.
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from ajna_commons.flask.log import logger
+from bhadrasana.conf import ENCODE, TAMANHO_LOTE
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc  # noqa: F401
+except ImportError:  # pragma: no cover
+    pa = None
+
+try:
+    from pandas._libs.parsers import STR_NA_VALUES as VALORES_NULOS
+except ImportError:  # pragma: no cover
+    VALORES_NULOS = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN',
+                     '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA',
+                     'NULL', 'NaN', 'n/a', 'nan', 'null'}
+
+DIR_COLUNAR = '.colunar'
+EXTENSAO_COLUNAR = '.feather'
+
+# Tipos de coluna dos arquivos sch (ver csv_handlers.sch_campos) que podem
+# ser lidos como datetime64 e float, e formato das datas nos txt
+TIPOS_SCH_DATA = {'Date', 'DateTime'}
+TIPOS_SCH_NUMERO = {'Bit', 'Byte', 'Short', 'Long', 'Integer', 'Single',
+                    'Double', 'Float', 'Currency', 'Decimal'}
+FORMATO_DATA_SCH = '%d/%m/%Y'
+# Colunas Char do sch até esta largura são códigos: lidas como categorias
+LARGURA_MAXIMA_CATEGORIA = 20
+DTYPE_CATEGORIA = 'category'
+DTYPE_DATA = 'datetime64[ns]'
+DTYPE_NUMERO = 'float64'
+
+
+def caminho_colunar(arquivo_csv):
+    """Retorna o caminho da cópia colunar do arquivo csv."""
+    diretorio, nome = os.path.split(arquivo_csv)
+    nome = os.path.splitext(nome)[0] + EXTENSAO_COLUNAR
+    return os.path.join(diretorio, DIR_COLUNAR, nome)
+
+
+def temporario_unico(destino):
+    """Cria, no diretório de destino, arquivo temporário de nome único.
+
+    Gravações simultâneas do mesmo destino (ex: dois workers) usam cada
+    uma o seu temporário; a última a chamar os.replace prevalece.
+
+    Returns:
+        Caminho do arquivo temporário criado (vazio)
+
+    """
+    diretorio, nome = os.path.split(destino)
+    os.makedirs(diretorio, exist_ok=True)
+    descritor, temporario = tempfile.mkstemp(prefix=nome + '.',
+                                             suffix='.tmp', dir=diretorio)
+    os.close(descritor)
+    return temporario
+
+
+def grava_tabela(destino, tabela):
+    """Grava a Table pyarrow em destino (Arrow IPC), substituindo-o.
+
+    A gravação é feita em temporário de nome único (ver
+    :func:`temporario_unico`), que então substitui destino.
+    """
+    temporario = temporario_unico(destino)
+    try:
+        with pa.ipc.new_file(temporario, tabela.schema) as writer:
+            writer.write_table(tabela)
+        os.replace(temporario, destino)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+    return destino
+
+
+def colunar_atualizado(arquivo_csv):
+    """Retorna True se existe cópia colunar mais nova que o arquivo csv."""
+    if pa is None:
+        return False
+    try:
+        return (os.path.getmtime(caminho_colunar(arquivo_csv)) >=
+                os.path.getmtime(arquivo_csv))
+    except OSError:
+        return False
+
+
+def lista_arquivos_base(path):
+    """Lista os arquivos de um diretório de base, sem os ocultos.
+
+    O diretório DIR_COLUNAR (e demais entradas iniciadas por '.') não
+    fazem parte da base.
+    """
+    return [nome for nome in os.listdir(path) if not nome.startswith('.')]
+
+
+class EscritorColunar():
+    """Grava a cópia colunar de um csv, um lote (DataFrame) por vez.
+
+    A gravação é feita em arquivo temporário, que só substitui a cópia
+    colunar em :func:`fecha`. Deve ser fechado somente depois que o csv
+    estiver gravado, para que a cópia fique mais nova que ele.
+
+    Uso:
+        with EscritorColunar(arquivo_csv) as escritor:
+            for lote in lotes:
+                escritor.escreve(lote)
+
+    Args:
+        arquivo_csv: caminho do arquivo csv
+
+        metadados: dict opcional coluna: dict de textos, gravado nos
+        metadados de cada campo do schema (ex: tipo informado no sch).
+        Ou lista com os metadados de cada coluna, por posição (ver
+        :func:`metadados_colunar`), ignorada se o número de colunas
+        for diferente
+
+    """
+
+    def __init__(self, arquivo_csv, metadados=None):
+        """Prepara caminhos. Nada é gravado antes do primeiro lote."""
+        self.destino = caminho_colunar(arquivo_csv)
+        self.metadados = metadados or {}
+        self._temporario = None
+        self._schema = None
+        self._writer = None
+
+    def _abre(self, colunas):
+        """Cria o arquivo temporário com schema de textos para colunas."""
+        if isinstance(self.metadados, dict):
+            metadados = [self.metadados.get(str(coluna))
+                         for coluna in colunas]
+        elif len(self.metadados) == len(colunas):
+            metadados = list(self.metadados)
+        else:
+            metadados = [None] * len(colunas)
+        self._temporario = temporario_unico(self.destino)
+        self._schema = pa.schema([
+            pa.field(str(coluna), pa.string(), metadata=metadados_coluna)
+            for coluna, metadados_coluna in zip(colunas, metadados)])
+        self._writer = pa.ipc.new_file(self._temporario, self._schema)
+
+    def escreve(self, df):
+        """Acrescenta df (colunas texto, sem nulos) à cópia colunar."""
+        if pa is None:
+            return
+        if self._writer is None:
+            self._abre(df.columns)
+        lote = pa.RecordBatch.from_pandas(df, schema=self._schema,
+                                          preserve_index=False)
+        self._writer.write_batch(lote)
+
+    def escreve_linhas(self, colunas, linhas):
+        """Acrescenta linhas (listas de textos) à cópia colunar.
+
+        Para gravar a cópia ao mesmo tempo que o csv, sem interpretá-lo
+        depois. Cada linha deve ter len(colunas) campos; None é gravado
+        como nulo (campo ausente no csv).
+        """
+        if pa is None or not linhas:
+            return
+        if self._writer is None:
+            self._abre(colunas)
+        lote = pa.RecordBatch.from_arrays(
+            [pa.array(valores, pa.string()) for valores in zip(*linhas)],
+            schema=self._schema)
+        self._writer.write_batch(lote)
+
+    def fecha(self):
+        """Finaliza a gravação, substituindo a cópia colunar anterior."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            os.replace(self._temporario, self.destino)
+
+    def descarta(self):
+        """Interrompe a gravação, mantendo a cópia colunar anterior."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._temporario and os.path.exists(self._temporario):
+            os.remove(self._temporario)
+
+    def __enter__(self):
+        """Suporte a with."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Fecha se não houve erro, senão descarta."""
+        if exc_type is None:
+            self.fecha()
+        else:
+            self.descarta()
+
+
+def grava_colunar(arquivo_csv, chunksize=TAMANHO_LOTE, metadados=None):
+    """Grava (ou regrava) a cópia colunar de um arquivo csv.
+
+    Falhas ao ler o csv (ex: linhas com mais colunas que o cabeçalho)
+    não são propagadas: o arquivo fica sem cópia colunar e continua
+    sendo lido como csv.
+
+    metadados: metadados dos campos, como em :class:`EscritorColunar`.
+    Para regravar a cópia sem perder os tipos do sch, passar os
+    metadados lidos (:func:`metadados_colunar`) antes de alterar o csv.
+
+    Returns:
+        Caminho da cópia colunar, ou None se não foi gravada
+
+    """
+    if pa is None:
+        return None
+    try:
+        lotes = pd.read_csv(arquivo_csv, encoding=ENCODE, dtype=str,
+                            keep_default_na=False, chunksize=chunksize)
+        with EscritorColunar(arquivo_csv, metadados) as escritor:
+            for lote in lotes:
+                escritor.escreve(lote)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError) as err:
+        logger.warning('Cópia colunar de %s não gravada: %s' %
+                       (arquivo_csv, err))
+        return None
+    return escritor.destino
+
+
+def renomeia_colunar(arquivo_csv, titulos):
+    """Troca os nomes das colunas da cópia colunar, sem ler o csv.
+
+    Para usar quando somente a linha de títulos do csv foi reescrita. Se
+    houver títulos repetidos (que pd.read_csv renomearia), regrava a cópia
+    a partir do csv.
+
+    Returns:
+        Caminho da cópia colunar, ou None se não foi gravada
+
+    """
+    if pa is None:
+        return None
+    destino = caminho_colunar(arquivo_csv)
+    with pa.OSFile(destino) as arquivo:
+        leitor = pa.ipc.open_file(arquivo)
+        if len(set(titulos)) != len(titulos):
+            # Mantém os metadados dos campos (tipos do sch), por posição
+            metadados = [campo.metadata for campo in leitor.schema]
+            tabela = None
+        else:
+            tabela = leitor.read_all()
+    if tabela is None:
+        return grava_colunar(arquivo_csv, metadados=metadados)
+    # rename_columns mantém os metadados dos campos
+    tabela = tabela.rename_columns([str(titulo) for titulo in titulos])
+    return grava_tabela(destino, tabela)
+
+
+def remove_colunar(arquivo_csv):
+    """Exclui a cópia colunar do arquivo csv, se houver."""
+    try:
+        os.remove(caminho_colunar(arquivo_csv))
+    except FileNotFoundError:
+        pass
+
+
+def _nulos_padrao(df):
+    """Troca por NaN os textos que pd.read_csv lê como nulos por padrão."""
+    categorias = [coluna for coluna, dtype in df.dtypes.items()
+                  if dtype.name == DTYPE_CATEGORIA]
+    if not categorias:
+        return df.mask(df.isin(VALORES_NULOS), np.nan)
+    df = df.copy()
+    for coluna in df.columns:
+        serie = df[coluna]
+        if coluna in categorias:
+            # Basta excluir as categorias nulas: linhas passam a NaN
+            nulas = serie.cat.categories.intersection(VALORES_NULOS)
+            df[coluna] = serie.cat.remove_categories(nulas)
+        else:
+            df[coluna] = serie.mask(serie.isin(VALORES_NULOS), np.nan)
+    return df
+
+
+def dtypes_sch(arquivo_csv):
+    """Retorna dict coluna: dtype compacto, pelos tipos do sch.
+
+    Os tipos e larguras informados no sch ficam nos metadados da cópia
+    colunar (ver :func:`bhadrasana.utils.csv_handlers.sch_tocsv`). Datas
+    podem ser lidas como DTYPE_DATA, números como DTYPE_NUMERO e códigos
+    (Char de até LARGURA_MAXIMA_CATEGORIA) como DTYPE_CATEGORIA. Sem
+    cópia colunar atualizada ou sem metadados, retorna dict vazio.
+    """
+    if not colunar_atualizado(arquivo_csv):
+        return {}
+    with pa.memory_map(caminho_colunar(arquivo_csv)) as origem:
+        schema = pa.ipc.open_file(origem).schema
+    dtypes = {}
+    for campo in schema:
+        metadados = campo.metadata or {}
+        tipo = metadados.get(b'tipo_sch', b'').decode()
+        largura = int(metadados.get(b'largura_sch', 0))
+        if tipo in TIPOS_SCH_DATA:
+            dtypes[campo.name] = DTYPE_DATA
+        elif tipo in TIPOS_SCH_NUMERO:
+            dtypes[campo.name] = DTYPE_NUMERO
+        elif tipo == 'Char' and 0 < largura <= LARGURA_MAXIMA_CATEGORIA:
+            dtypes[campo.name] = DTYPE_CATEGORIA
+    return dtypes
+
+
+def converte_dtypes(df, dtypes):
+    """Converte colunas texto de df para os dtypes (ver :func:`dtypes_sch`).
+
+    Datas no FORMATO_DATA_SCH e números com vírgula decimal; valores
+    inválidos viram NaT/NaN. Colunas já convertidas são mantidas.
+    """
+    for coluna, dtype in dtypes.items():
+        if coluna not in df.columns or df[coluna].dtype.name == dtype:
+            continue
+        serie = df[coluna]
+        if dtype == DTYPE_DATA:
+            df[coluna] = pd.to_datetime(serie, format=FORMATO_DATA_SCH,
+                                        errors='coerce')
+        elif dtype == DTYPE_NUMERO:
+            df[coluna] = pd.to_numeric(serie.str.replace(',', '.'),
+                                       errors='coerce')
+        else:
+            df[coluna] = serie.astype(dtype)
+    return df
+
+
+def para_pandas(tabela):
+    """Converte Table pyarrow em DataFrame, com nulos como NaN.
+
+    Table.to_pandas converte nulos de colunas texto em None; pd.read_csv
+    e DataFrame.merge usam NaN.
+    """
+    df = tabela.to_pandas()
+    if any(coluna.null_count for coluna in tabela.columns):
+        df = df.where(df.notna(), np.nan)
+    return df
+
+
+def metadados_colunar(arquivo_csv):
+    """Retorna lista com os metadados de cada campo da cópia colunar.
+
+    Na ordem das colunas, para regravar a cópia sem perder os tipos do
+    sch (ver :func:`dtypes_sch`) mesmo que os títulos mudem (ex:
+    sanitizados). Lista vazia se não houver cópia colunar atualizada.
+    """
+    if not colunar_atualizado(arquivo_csv):
+        return []
+    with pa.memory_map(caminho_colunar(arquivo_csv)) as origem:
+        schema = pa.ipc.open_file(origem).schema
+    return [campo.metadata for campo in schema]
+
+
+def le_cabecalho(arquivo_csv):
+    """Retorna a lista de nomes de coluna, como lidos por pd.read_csv.
+
+    Usa o schema da cópia colunar, se estiver atualizada: nenhuma linha
+    de dados é lida.
+    """
+    if colunar_atualizado(arquivo_csv):
+        with pa.memory_map(caminho_colunar(arquivo_csv)) as origem:
+            return pa.ipc.open_file(origem).schema.names
+    return pd.read_csv(arquivo_csv, encoding=ENCODE, dtype=str,
+                       nrows=0).columns.tolist()
+
+
+def estima_linhas(arquivo_csv, amostra=64 * 1024):
+    """Retorna a quantidade de linhas de dados do csv, sem lê-lo todo.
+
+    Com cópia colunar atualizada a quantidade é exata, lida dos metadados
+    dos lotes. Senão, é estimada pelo tamanho do arquivo e o tamanho médio
+    das linhas nos primeiros amostra bytes.
+    """
+    if colunar_atualizado(arquivo_csv):
+        with pa.memory_map(caminho_colunar(arquivo_csv)) as origem:
+            leitor = pa.ipc.open_file(origem)
+            return sum(leitor.get_batch(ind).num_rows
+                       for ind in range(leitor.num_record_batches))
+    tamanho = os.path.getsize(arquivo_csv)
+    with open(arquivo_csv, 'rb') as arquivo:
+        inicio = arquivo.read(amostra)
+    linhas = inicio.count(b'\n')
+    if len(inicio) == tamanho:  # arquivo inteiro lido
+        return max(linhas - 1 + (not inicio.endswith(b'\n')), 0)
+    if linhas == 0:
+        return 1
+    return int(tamanho * linhas / len(inicio)) - 1
+
+
+def abre_tabela(arquivo_csv, colunas=None):
+    """Abre a cópia colunar do csv como Table pyarrow, mapeada em memória.
+
+    O arquivo é mapeado (mmap), não lido: as colunas só ocupam memória ao
+    serem acessadas, e processos diferentes que abrem a mesma base
+    compartilham as mesmas páginas do cache do sistema operacional.
+
+    Args:
+        arquivo_csv: caminho do arquivo csv (a cópia colunar deve estar
+        atualizada, ver :func:`colunar_atualizado`)
+
+        colunas: se informado, somente estas colunas (as inexistentes são
+        ignoradas), na ordem do arquivo
+
+    """
+    origem = pa.memory_map(caminho_colunar(arquivo_csv))
+    tabela = pa.ipc.open_file(origem).read_all()
+    if colunas is not None:
+        colunas = set(colunas)
+        tabela = tabela.select([coluna for coluna in tabela.column_names
+                                if coluna in colunas])
+    return tabela
+
+
+def le_tabela(arquivo_csv, nulos=True, colunas=None, dtypes=None):
+    """Lê um csv de base como DataFrame de textos.
+
+    Usa a cópia colunar, se estiver atualizada. O resultado é o mesmo de
+    pd.read_csv(arquivo_csv, dtype=str).
+
+    Args:
+        arquivo_csv: caminho do arquivo csv
+
+        nulos: se False, mantém os textos como estão, equivalente a
+        pd.read_csv(..., keep_default_na=False)
+
+        colunas: se informado, lê somente estas colunas (as inexistentes
+        são ignoradas), na ordem do arquivo
+
+        dtypes: dict opcional coluna: dtype compacto (ver
+        :func:`dtypes_sch`), para ler estas colunas como categorias,
+        datas ou números em vez de textos. Ver :func:`converte_dtypes`
+
+    """
+    dtypes = dtypes or {}
+    if colunar_atualizado(arquivo_csv):
+        tabela = abre_tabela(arquivo_csv, colunas)
+        # Categorias montadas direto do Arrow, sem criar os textos
+        categorias = [coluna for coluna in tabela.column_names
+                      if dtypes.get(coluna) == DTYPE_CATEGORIA]
+        df = tabela.to_pandas(categories=categorias)
+        if nulos:
+            df = _nulos_padrao(df)
+        return converte_dtypes(df, dtypes)
+    usecols = None
+    if colunas is not None:
+        usecols = set(colunas).__contains__
+    df = pd.read_csv(arquivo_csv, encoding=ENCODE, dtype=str,
+                     keep_default_na=nulos, usecols=usecols)
+    return converte_dtypes(df, dtypes)
+
+
+def le_lotes(arquivo_csv, chunksize=TAMANHO_LOTE, nulos=False,
+             dtypes=None):
+    """Lê um csv de base em lotes (DataFrames) de até chunksize linhas.
+
+    Usa a cópia colunar (mapeada em memória), se estiver atualizada. Os
+    textos são mantidos como estão, equivalente a pd.read_csv(...,
+    dtype=str, keep_default_na=False, chunksize=chunksize).
+
+    Args:
+        nulos, dtypes: como em :func:`le_tabela`, aplicados a cada lote
+
+    """
+    dtypes = dtypes or {}
+    if not colunar_atualizado(arquivo_csv):
+        for lote in pd.read_csv(arquivo_csv, encoding=ENCODE, dtype=str,
+                                keep_default_na=nulos, chunksize=chunksize):
+            yield converte_dtypes(lote, dtypes)
+        return
+    for inicio, fatia in fatias(abre_tabela(arquivo_csv), chunksize):
+        df = fatia.to_pandas()
+        df.index = pd.RangeIndex(inicio, inicio + len(df))
+        if nulos:
+            df = _nulos_padrao(df)
+        yield converte_dtypes(df, dtypes)
+
+
+def fatias(tabela, chunksize=TAMANHO_LOTE):
+    """Divide Table pyarrow em fatias de até chunksize linhas (sem cópia).
+
+    Yields:
+        tuplas (posição da primeira linha, fatia)
+    """
+    for inicio in range(0, tabela.num_rows, chunksize):
+        yield inicio, tabela.slice(inicio, chunksize)
@@ -11,34 +11,166 @@ import csv
 import glob
 import io
 import os
-from copy import deepcopy
+import re
+import shutil
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import current_process
 from zipfile import ZipFile
 
-from ajna_commons.utils.sanitiza import ascii_sanitizar, sanitizar
-from bhadrasana.conf import ENCODE, tmpdir
+import numpy as np
+import pandas as pd
+
+from ajna_commons.flask.log import logger
+from ajna_commons.utils.sanitiza import (ascii_sanitizar, sanitizar,
+                                         unicode_sanitizar)
+from bhadrasana.conf import ENCODE, TAMANHO_LOTE, tmpdir
+from bhadrasana.utils import colunar
+
+try:
+    # Pool do Celery: cria processos mesmo a partir de processo daemon
+    import billiard
+except ImportError:  # pragma: no cover
+    billiard = None
+
+# Separador usado para processar uma coluna inteira como um único texto
+SEPARADOR_VALORES = '\x00'
+# Tamanho do bloco (bytes) ao copiar o corpo de arquivos sem interpretar
+TAMANHO_BLOCO_COPIA = 1024 * 1024
+# Valores unidos em um único texto por vez em processa_como_texto
+TAMANHO_BLOCO_TEXTO = 100000
+# Máximo de valores sanitizados guardados por CacheSanitizar
+TAMANHO_CACHE_SANITIZAR = 200000
+# Coluna usa o cache se tiver ao menos FATOR_REPETICAO valores por valor único
+FATOR_REPETICAO = 2
+# Linha de coluna de arquivo sch: Col1="Nome" Char Width 10
+REGEX_COLUNA_SCH = re.compile(
+    r'Col\d+="([^"]*)"\s*(\w+)?(?:\s+Width\s+(\d+))?')
+_tabelas_sanitizar = {}
+
+
+def tabela_sanitizar(norm_function):
+    """Tabela de tradução (str.translate) equivalente a sanitizar.
+
+    Para textos Latin-1 (ENCODE), sanitizar equivale a trocar cada
+    caractere pelo resultado de sanitizar sobre ele, com espaços em
+    branco trocados por ' ', e depois juntar sequências de espaços
+    (normalizar caractere a caractere é seguro para ascii_sanitizar e
+    unicode_sanitizar, pois nenhum caractere Latin-1 combina com o seguinte).
+    Cada caractere é sanitizado entre dois 'x', para que sanitizar não
+    retire os espaços que ele produz.
+
+    Returns:
+        tupla (tabela, tabela_bytes, apagar, expandem): tabela para
+        str.translate; tabela e caracteres a apagar para bytes.translate,
+        válida apenas se o texto não contiver nenhum dos caracteres de
+        expandem (que viram mais de um caractere, ex: '½' -> '12')
+
+    """
+    tabelas = _tabelas_sanitizar.get(norm_function)
+    if tabelas is None:
+        tabela = {}
+        tabela_bytes = bytearray(range(256))
+        apagar = bytearray()
+        expandem = []
+        for codigo in range(1, 256):
+            caractere = chr(codigo)
+            novo = sanitizar('x' + caractere + 'x',
+                             norm_function=norm_function)[1:-1]
+            tabela[codigo] = novo
+            if not novo:
+                apagar.append(codigo)
+            elif len(novo) == 1 and ord(novo) < 256:
+                tabela_bytes[codigo] = ord(novo)
+            else:
+                expandem.append(caractere)
+        tabelas = (tabela, bytes(tabela_bytes), bytes(apagar), expandem)
+        _tabelas_sanitizar[norm_function] = tabelas
+    return tabelas
 
 
 def muda_titulos_csv(csv_file, de_para_dict):
-    """Apenas abre o arquivo e repassa para muda_titulos_lista."""
+    """Apenas abre o arquivo e repassa para muda_titulos_lista.
+
+    Para somente alterar os títulos de um arquivo em disco, sem carregar
+    todas as linhas, ver :func:`muda_titulos_arquivo`.
+    """
     with open(csv_file, 'r', encoding=ENCODE, newline='') as csvfile:
         reader = csv.reader(csvfile)
         result = [linha for linha in reader]
     # print(result)
-    result = muda_titulos_lista(result, de_para_dict)
+    result = muda_titulos_lista(result, de_para_dict, make_copy=False)
     # print(result)
     return result
 
 
+def novos_titulos(titulos, de_para_dict):
+    """Retorna lista de títulos sanitizados e trocados conforme de_para."""
+    result = []
+    for titulo in titulos:
+        # Se título não está no de_para, retorna ele mesmo
+        titulo = sanitizar(titulo, norm_function=ascii_sanitizar)
+        result.append(de_para_dict.get(titulo, titulo))
+    return result
+
+
+def muda_titulos_arquivo(csv_file, de_para_dict, destino=None):
+    """Muda somente a linha de títulos de um arquivo csv.
+
+    Lê e reescreve apenas a primeira linha. O restante do arquivo é
+    copiado como bytes, sem ser decodificado nem interpretado.
+
+    Args:
+        csv_file: caminho do arquivo csv
+
+        de_para_dict: dicionário titulo_antigo: titulo_novo
+
+        destino: caminho do arquivo a gravar. Se não for passado, o próprio
+        csv_file é substituído (via arquivo temporário)
+
+    Returns:
+        lista com os novos títulos, ou None se a linha de títulos não puder
+        ser tratada isoladamente (ex: título com quebra de linha entre
+        aspas) - neste caso o arquivo não é alterado
+
+    """
+    if destino is None:
+        destino = csv_file
+    temp_filename = destino + '.tmp'
+    try:
+        with open(csv_file, 'rb') as origem:
+            primeira_linha = origem.readline()
+            conteudo = primeira_linha.rstrip(b'\r\n')
+            if not conteudo or conteudo.count(b'"') % 2 != 0:
+                return None
+            fim_linha = primeira_linha[len(conteudo):] or b'\r\n'
+            titulos = next(csv.reader([conteudo.decode(ENCODE)]), [])
+            titulos = novos_titulos(titulos, de_para_dict)
+            linha_titulos = io.StringIO()
+            csv.writer(linha_titulos, lineterminator='').writerow(titulos)
+            with open(temp_filename, 'wb') as saida:
+                saida.write(linha_titulos.getvalue().encode(ENCODE))
+                saida.write(fim_linha)
+                shutil.copyfileobj(origem, saida, TAMANHO_BLOCO_COPIA)
+        os.replace(temp_filename, destino)
+        return titulos
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
 def muda_titulos_lista(lista, de_para_dict, make_copy=True):
     """Muda titulos.
 
     Recebe um dicionário na forma titulo_old:titulo_new
     e muda a linha de titulo da lista.
 
-    Passar copy=False para listas grandes faz a modificação in-line
-    na lista original (muito mais rápido) modificando a lista original
-    e retornando ela mesma. O padrão é copiar a lista e deixar
-    intocada a lista original
+    Somente a linha de títulos é modificada. Com make_copy=True (padrão),
+    é retornada uma nova lista, com nova linha de título, que compartilha
+    as demais linhas (não modificadas) com a lista original, deixando
+    intocada a lista original sem copiar o seu conteúdo.
+    Com make_copy=False, a modificação é feita in-line na lista original,
+    retornando ela mesma.
 
     Args:
         plista: lista de listas representando a planilha a ter
@@ -49,71 +181,599 @@ def muda_titulos_lista(lista, de_para_dict, make_copy=True):
         copy: Se False, modifica original
     """
     if make_copy:
-        lista = deepcopy(lista)
-    for r in range(len(lista[0])):
-        # Se título não está no de_para, retorna ele mesmo
-        titulo = sanitizar(lista[0][r], norm_function=ascii_sanitizar)
-        novo_titulo = de_para_dict.get(titulo, titulo)
-        lista[0][r] = novo_titulo
+        lista = list(lista)
+    lista[0] = novos_titulos(lista[0], de_para_dict)
     return lista
 
 
+def muda_titulos_df(df, de_para_dict, make_copy=True):
+    """Equivalente de muda_titulos_lista para DataFrame.
+
+    Somente os nomes das colunas são alterados. make_copy existe apenas
+    para manter a mesma assinatura: o DataFrame original nunca é alterado.
+    """
+    novos = novos_titulos(df.columns, de_para_dict)
+    return df.rename(columns=dict(zip(df.columns, novos)))
+
+
+def processa_como_texto(serie, funcao, tamanho_bloco=TAMANHO_BLOCO_TEXTO):
+    """Aplica funcao de texto na coluna, muitos valores de cada vez.
+
+    Une os valores (não nulos) da coluna em um único texto, com
+    SEPARADOR_VALORES entre eles, aplica funcao (que deve preservar o
+    separador) e divide o resultado de volta. Operações como translate e
+    replace rodam assim uma vez por bloco de tamanho_bloco valores, em vez
+    de uma vez por célula. Os blocos limitam o tamanho dos textos
+    intermediários: um texto da coluna inteira exige memória nova a cada
+    coluna, e alocá-la custa mais que as próprias operações.
+
+    Returns:
+        Nova Series, ou None se a coluna não puder ser processada desta forma
+        (valores não texto, separador presente nos dados, ou funcao
+        retornou None)
+
+    """
+    validos = serie.notna()
+    todos_validos = validos.all()
+    valores = serie.tolist() if todos_validos else serie[validos].tolist()
+    if not valores:
+        return serie
+    processados = []
+    for inicio in range(0, len(valores), tamanho_bloco):
+        bloco = valores[inicio:inicio + tamanho_bloco]
+        try:
+            texto = SEPARADOR_VALORES.join(bloco)
+        except TypeError:
+            return None
+        if texto.count(SEPARADOR_VALORES) != len(bloco) - 1:
+            return None
+        texto = funcao(texto)
+        if texto is None:
+            return None
+        processados.extend(texto.split(SEPARADOR_VALORES))
+    if todos_validos:
+        return pd.Series(processados, index=serie.index,
+                         name=serie.name, dtype=object)
+    result = serie.copy()
+    result[validos] = processados
+    return result
+
+
+def strip_serie(serie):
+    """Retira espaços antes e depois dos valores texto da Series."""
+    if serie.dtype.name == 'category':
+        # Basta retirar das categorias, se continuarem distintas
+        categorias = [categoria.strip() if isinstance(categoria, str)
+                      else categoria for categoria in serie.cat.categories]
+        if len(set(categorias)) == len(categorias):
+            return serie.cat.rename_categories(categorias)
+        serie = serie.astype(object)
+    if serie.dtype != object:
+        return serie
+    valores = serie.tolist()
+    try:
+        valores = [valor.strip() for valor in valores]
+    except AttributeError:
+        # Há valores nulos ou não texto na coluna
+        valores = [valor.strip() if isinstance(valor, str) else valor
+                   for valor in valores]
+    return pd.Series(valores, index=serie.index, name=serie.name,
+                     dtype=object)
+
+
+def sanitizar_serie(serie, norm_function=unicode_sanitizar):
+    """Aplica sanitizar em toda uma coluna (Series) de forma vetorizada.
+
+    Mesmo resultado de sanitizar aplicado a cada valor: retira espaços
+    antes e depois, passa para minúsculas, normaliza e troca sequências de
+    espaços em branco por um único espaço. Valores não texto são mantidos.
+
+    Para ascii_sanitizar e unicode_sanitizar em textos Latin-1 (ENCODE),
+    usa :func:`tabela_sanitizar` e :func:`processa_como_texto`.
+    Nos demais casos, aplica sanitizar valor a valor.
+    """
+    if serie.dtype != object:
+        return serie
+    result = None
+    if norm_function in (ascii_sanitizar, unicode_sanitizar):
+        tabela, tabela_bytes, apagar, expandem = tabela_sanitizar(
+            norm_function)
+
+        def sanitizar_texto(texto):
+            try:
+                texto_bytes = texto.encode('latin-1')
+            except UnicodeEncodeError:
+                return None
+            if any(caractere in texto for caractere in expandem):
+                texto = texto.translate(tabela)
+            else:
+                texto = texto_bytes.translate(
+                    tabela_bytes, apagar).decode('latin-1')
+            # Após a tradução o único espaço em branco é ' ': basta juntar
+            # as sequências e retirar os espaços em volta dos separadores
+            while '  ' in texto:
+                texto = texto.replace('  ', ' ')
+            return texto.replace(' ' + SEPARADOR_VALORES,
+                                 SEPARADOR_VALORES).replace(
+                SEPARADOR_VALORES + ' ', SEPARADOR_VALORES).strip(' ')
+
+        result = processa_como_texto(serie, sanitizar_texto)
+    if result is None:
+        result = serie.map(lambda valor: sanitizar(
+            valor, norm_function=norm_function))
+    return result
+
+
+def sanitizar_df(df, norm_function=unicode_sanitizar, cache=None):
+    """Equivalente vetorizado de sanitizar_lista para DataFrame.
+
+    Sanitiza, coluna a coluna, os títulos e os valores do DataFrame.
+    Retorna um novo DataFrame.
+
+    Se for passado cache (:class:`CacheSanitizar`), somente os valores
+    únicos de cada coluna são sanitizados (ver :func:`sanitizar_lista_cache`).
+    """
+    colunas = [sanitizar(titulo, norm_function=norm_function)
+               for titulo in df.columns]
+    if df.shape[1] == 0:
+        return df.rename(columns=dict(zip(df.columns, colunas)))
+    if cache is not None and cache.norm_function == norm_function:
+        sanitiza = cache.sanitiza_serie
+    else:
+        def sanitiza(serie):
+            return sanitizar_serie(serie, norm_function)
+    result = pd.concat([sanitiza(df.iloc[:, ind])
+                        for ind in range(df.shape[1])], axis=1)
+    result.columns = colunas
+    return result
+
+
+class CacheSanitizar():
+    """Cache limitado (LRU) de valores já sanitizados.
+
+    Colunas de extrações (portos, NCM, tipos de contêiner, consignatários)
+    têm poucos valores distintos em relação ao número de linhas. Com o
+    cache, cada coluna é fatorada, somente os valores únicos ainda não
+    vistos são sanitizados, e o resultado é mapeado de volta. A mesma
+    instância pode ser reutilizada entre arquivos (ex: todos os arquivos
+    de uma importação).
+
+    Args:
+        norm_function: função de normalização passada para sanitizar
+
+        tamanho: número máximo de valores guardados. Ao ultrapassar,
+        os menos usados recentemente são descartados
+
+    """
+
+    def __init__(self, norm_function=unicode_sanitizar,
+                 tamanho=TAMANHO_CACHE_SANITIZAR):
+        """Cria cache vazio."""
+        self.norm_function = norm_function
+        self.tamanho = tamanho
+        self._valores = OrderedDict()
+
+    def __len__(self):
+        """Quantidade de valores guardados."""
+        return len(self._valores)
+
+    def sanitiza_unicos(self, unicos):
+        """Retorna lista com unicos (valores distintos) sanitizados.
+
+        Somente os valores ausentes do cache são sanitizados, de uma só vez
+        com :func:`sanitizar_serie`.
+        """
+        result = [None] * len(unicos)
+        faltantes = []
+        valores = self._valores
+        for ind, valor in enumerate(unicos):
+            novo = valores.get(valor) if isinstance(valor, str) else None
+            if novo is None:
+                faltantes.append(ind)
+            else:
+                valores.move_to_end(valor)
+                result[ind] = novo
+        if faltantes:
+            serie = pd.Series([unicos[ind] for ind in faltantes],
+                              dtype=object)
+            novos = sanitizar_serie(serie, self.norm_function).tolist()
+            for ind, novo in zip(faltantes, novos):
+                result[ind] = novo
+                if isinstance(unicos[ind], str):
+                    valores[unicos[ind]] = novo
+            while len(valores) > self.tamanho:
+                valores.popitem(last=False)
+        return result
+
+    def repetitiva(self, qtde_unicos, qtde_valores):
+        """Retorna True se vale a pena usar o cache para a coluna.
+
+        Colunas com muitos valores distintos (ex: números de documento)
+        são sanitizadas diretamente, sem passar pelo cache, para não
+        descartar os valores das colunas repetitivas.
+        """
+        return (qtde_unicos * FATOR_REPETICAO <= qtde_valores and
+                qtde_unicos <= self.tamanho)
+
+    def sanitiza_serie(self, serie):
+        """Equivalente a sanitizar_serie, sanitizando só os valores únicos."""
+        if serie.dtype != object:
+            return serie
+        codigos, unicos = pd.factorize(serie)
+        if not self.repetitiva(len(unicos), len(serie)):
+            return sanitizar_serie(serie, self.norm_function)
+        novos = np.empty(len(unicos) + 1, dtype=object)
+        novos[:-1] = self.sanitiza_unicos(unicos.tolist())
+        valores = novos.take(codigos)
+        nulos = codigos == -1
+        if nulos.any():
+            # Nulos (None, NaN) não são fatorados: mantém como estão
+            valores[nulos] = serie.values[nulos]
+        return pd.Series(valores, index=serie.index, name=serie.name)
+
+    def sanitiza_valores(self, valores):
+        """Retorna lista com valores (de uma coluna) sanitizados."""
+        unicos = list(set(valores))
+        if not self.repetitiva(len(unicos), len(valores)):
+            return sanitizar_serie(pd.Series(valores, dtype=object),
+                                   self.norm_function).tolist()
+        mapa = dict(zip(unicos, self.sanitiza_unicos(unicos)))
+        return [mapa[valor] for valor in valores]
+
+
+def sanitizar_lista_cache(lista, norm_function=unicode_sanitizar,
+                          cache=None):
+    """Equivalente a sanitizar_lista, sanitizando só os valores únicos.
+
+    Cada coluna é fatorada (ver :class:`CacheSanitizar`). Como
+    sanitizar_lista, modifica e retorna a própria lista.
+
+    Args:
+        lista: lista de listas, a primeira linha com os títulos
+
+        norm_function: função de normalização passada para sanitizar
+
+        cache: :class:`CacheSanitizar` a reutilizar. Se não for passado,
+        é criado um novo, válido apenas para esta chamada
+
+    """
+    if cache is None or cache.norm_function != norm_function:
+        cache = CacheSanitizar(norm_function)
+    if not lista:
+        return lista
+    lista[0] = [sanitizar(titulo, norm_function=norm_function)
+                for titulo in lista[0]]
+    largura = len(lista[0])
+    if any(len(linha) != largura for linha in lista[1:]):
+        # Linhas com largura diferente do cabeçalho: todas as colunas juntas
+        valores = cache.sanitiza_valores(
+            [valor for linha in lista[1:] for valor in linha])
+        inicio = 0
+        for ind in range(1, len(lista)):
+            fim = inicio + len(lista[ind])
+            lista[ind] = valores[inicio:fim]
+            inicio = fim
+        return lista
+    colunas = [cache.sanitiza_valores(coluna)
+               for coluna in zip(*lista[1:])]
+    for ind, linha in enumerate(zip(*colunas), 1):
+        lista[ind] = list(linha)
+    return lista
+
+
+def retificar_linha(linha, largura):
+    """Retira da linha as colunas vazias que excedem largura.
+
+    Foram detectados arquivos com falha (TABs a mais, ver notebook
+    ExploraCarga). Se a linha tem mais colunas que largura, são retiradas
+    as primeiras colunas vazias, até a quantidade excedente, em uma
+    única passada.
+
+    Returns:
+        nova lista, ou a própria linha se não houve alteração
+
+    """
+    excesso = len(linha) - largura
+    if excesso <= 0 or not isinstance(linha, list):
+        return linha
+    nova = []
+    inicio = 0
+    for _ in range(excesso):
+        try:
+            vazia = linha.index('', inicio)
+        except ValueError:
+            break
+        nova.extend(linha[inicio:vazia])
+        inicio = vazia + 1
+    if inicio == 0:
+        return linha
+    nova.extend(linha[inicio:])
+    return nova
+
+
 def retificar_linhas(lista, cabecalhos):
-    """Retifica as linhas de arquivos com falhas."""
-    # RETIFICAR LINHAS!!!!
-    # Foram detectados arquivos com falha
-    # (TABs a mais, ver notebook ExploraCarga)
-    width_header = len(cabecalhos)
+    """Retifica as linhas de arquivos com falhas.
+
+    Ver :func:`retificar_linha`. As linhas retificadas são substituídas
+    na própria lista.
+
+    Returns:
+        quantidade de linhas retificadas
+
+    """
+    largura = len(cabecalhos)
+    retificadas = 0
     for ind, linha in enumerate(lista):
-        width_linha = len(linha)
-        while width_linha > width_header:
-            # print('Detectado problema linha: ', ind)
-            # print('Largura linha:header', width_linha, ':', width_header)
-            # Caso haja colunas "sobrando" na linha, retirar
-            # uma coluna nula
-            for index, col in enumerate(linha):
-                if isinstance(col, str) and not col:
-                    # print('Eliminando coluna: ', index)
-                    linha.pop(index)
-                    break
-            width_linha -= 1
-
-
-def sch_tocsv(sch, txt, dest_path=tmpdir):
+        nova = retificar_linha(linha, largura)
+        if nova is not linha:
+            lista[ind] = nova
+            retificadas += 1
+    return retificadas
+
+
+class CampoSch(namedtuple('CampoSch', ['nome', 'tipo', 'largura'])):
+    """Coluna descrita em um arquivo sch: Col1="Nome" Tipo Width 10.
+
+    tipo (ex: Char, LongChar, Date) e largura são None se não informados.
+    """
+
+
+def sch_campos(sch):
+    """Retorna a lista de :class:`CampoSch` das linhas de um sch.
+
+    Linhas em bytes são decodificadas (ENCODE) na própria lista.
+    """
+    campos = []
+    for ind, linha in enumerate(sch):
+        if not isinstance(linha, str):
+            linha = sch[ind] = str(linha, ENCODE)
+        encontrado = REGEX_COLUNA_SCH.match(linha)
+        if encontrado:
+            nome, tipo, largura = encontrado.groups()
+            campos.append(CampoSch(nome, tipo,
+                                   int(largura) if largura else None))
+    return campos
+
+
+def sch_tocsv(sch, txt, dest_path=tmpdir, estatisticas=None,
+              copia_colunar=False):
     """Processa padrão sch (CARGA).
 
     Pega um arquivo txt, aplica os cabecalhos e a informação de um sch,
     e o transforma em um csv padrão.
+
+    Args:
+        sch: linhas do arquivo sch
+
+        txt: linhas (listas de campos) do arquivo txt, em qualquer
+        iterável - ex: csv.reader sobre o arquivo aberto. As linhas são
+        retificadas (ver :func:`retificar_linha`) e gravadas uma a uma,
+        sem carregar o txt em memória
+
+        estatisticas: se informado (dict), recebe para o csv gerado a
+        quantidade de linhas retificadas
+
+        copia_colunar: grava também, na mesma passada, a cópia colunar do
+        csv (ver :class:`bhadrasana.utils.colunar.EscritorColunar`), com
+        tipo e largura do sch nos metadados de cada coluna. Assim o csv
+        gerado não precisa ser interpretado de novo para gravá-la
+
     """
-    cabecalhos = []
-    for ind in range(len(sch)):
-        if not isinstance(sch[ind], str):
-            sch[ind] = str(sch[ind], ENCODE)
-        linha = sch[ind]
-        position_equal = linha.find('="')
-        position_quote = linha.find('" ')
-        position_col = linha.find('Col')
-        if position_equal != -1 and position_col == 0:
-            cabecalhos.append(linha[position_equal + 2:position_quote])
+    campos = sch_campos(sch)
+    cabecalhos = [campo.nome for campo in campos]
     campo = str(sch[0])[2:-3]
     filename = os.path.join(dest_path, campo + '.csv')
-    with open(filename, 'w', encoding=ENCODE, newline='') as out:
-        writer = csv.writer(out, quotechar='"', quoting=csv.QUOTE_ALL)
-        # print('txt', txt)
-        del txt[0]
-        # print('txt', txt)
-        writer.writerow(cabecalhos)
-        # RETIFICAR LINHAS!!!!
-        retificar_linhas(txt, cabecalhos)
-        for row in txt:
-            if row:
-                writer.writerow(row)
-
+    escritor = None
+    if copia_colunar and cabecalhos and \
+            len(set(cabecalhos)) == len(cabecalhos):
+        escritor = colunar.EscritorColunar(filename, metadados={
+            campo_sch.nome: metadados_campo_sch(campo_sch)
+            for campo_sch in campos})
+    try:
+        with open(filename, 'w', encoding=ENCODE, newline='') as out:
+            writer = csv.writer(out, quotechar='"', quoting=csv.QUOTE_ALL)
+            linhas = iter(txt)
+            next(linhas, None)  # Primeira linha do txt é descartada
+            writer.writerow(cabecalhos)
+            # RETIFICAR LINHAS!!!!
+            largura = len(cabecalhos)
+            retificadas = 0
+            writerow = writer.writerow
+            lote = []
+            for row in linhas:
+                if row:
+                    retificada = retificar_linha(row, largura)
+                    if retificada is not row:
+                        retificadas += 1
+                    writerow(retificada)
+                    if escritor is not None:
+                        lote.append(retificada)
+                        if len(lote) == TAMANHO_LOTE:
+                            escritor = _escreve_lote(escritor, cabecalhos,
+                                                     lote)
+                            lote = []
+        if escritor is not None:
+            escritor = _escreve_lote(escritor, cabecalhos, lote)
+            if escritor is not None:
+                # Fechada depois do csv, para ficar mais nova que ele
+                escritor.fecha()
+    except Exception:
+        if escritor is not None:
+            escritor.descarta()
+        raise
+    if estatisticas is not None:
+        estatisticas[filename] = retificadas
     return filename
-    # print(sch, txt)
 
 
-def sch_processing(path, mask_txt='0.txt', dest_path=tmpdir):
+def metadados_campo_sch(campo):
+    """Metadados (dict de textos) da cópia colunar para um CampoSch."""
+    metadados = {}
+    if campo.tipo:
+        metadados['tipo_sch'] = campo.tipo
+    if campo.largura:
+        metadados['largura_sch'] = str(campo.largura)
+    return metadados or None
+
+
+def _escreve_lote(escritor, cabecalhos, lote):
+    """Grava lote de linhas do csv na cópia colunar.
+
+    As linhas curtas são completadas com '' (como pd.read_csv com
+    keep_default_na=False). Se alguma linha tem mais campos que
+    cabecalhos, o csv não poderia ser lido por pd.read_csv: a cópia é
+    descartada e retorna None.
+    """
+    largura = len(cabecalhos)
+    linhas = []
+    for linha in lote:
+        if len(linha) > largura:
+            escritor.descarta()
+            return None
+        if len(linha) < largura:
+            linha = linha + [''] * (largura - len(linha))
+        linhas.append(linha)
+    escritor.escreve_linhas(cabecalhos, linhas)
+    return escritor
+
+
+def indice_sufixos(nomes, sufixos):
+    """Indexa nomes pelos sufixos de interesse, em uma passada.
+
+    Args:
+        nomes: lista de nomes (arquivos ou membros de .zip)
+
+        sufixos: sufixos procurados
+
+    Returns:
+        dict sufixo: último nome de nomes terminado por ele
+
+    """
+    tamanhos = set(len(sufixo) for sufixo in sufixos)
+    sufixos = set(sufixos)
+    indice = {}
+    for nome in nomes:
+        for tamanho in tamanhos:
+            sufixo = nome[-tamanho:]
+            if sufixo in sufixos:
+                indice[sufixo] = nome
+    return indice
+
+
+def sch_pares(path, mask_txt='0.txt', myzip=None):
+    """Lista os pares (sch, txt) de um diretório ou arquivo .zip.
+
+    Para cada arquivo schNN.sch, o txt é o terminado em NN + mask_txt.
+    Os nomes são lidos uma vez e os txt encontrados por dict (ver
+    :func:`indice_sufixos`). Ver :func:`sch_processing`. Nomes dos
+    membros, no caso de .zip (myzip: ZipFile de path já aberto, opcional).
+    """
+    if path.find('.zip') == -1:
+        schs = glob.glob(os.path.join(path, '*.sch'))
+        nomes = [os.path.join(path, nome) for nome in os.listdir(path)
+                 if not nome.startswith('.')]
+        sufixos = [os.path.basename(sch_name)[3:-4] + mask_txt
+                   for sch_name in schs]
+    else:
+        if myzip is None:
+            with ZipFile(path) as myzip:
+                nomes = myzip.namelist()
+        else:
+            nomes = myzip.namelist()
+        schs = [nome for nome in nomes if nome.find('.sch') != -1]
+        sufixos = [sch_name[3:-4] + mask_txt for sch_name in schs]
+    indice = indice_sufixos(nomes, sufixos)
+    pares = []
+    for sch_name, sufixo in zip(schs, sufixos):
+        if sufixo not in indice:
+            raise FileNotFoundError('Arquivo txt de %s não encontrado em %s'
+                                    % (sch_name, path))
+        pares.append((sch_name, indice[sufixo]))
+    return pares
+
+
+def sch_converte_par(path, sch_name, txt_name, dest_path=tmpdir,
+                     myzip=None, copia_colunar=False):
+    """Converte um par (sch, txt) de path em csv. Ver :func:`sch_tocsv`.
+
+    Função de módulo, para poder ser executada em outro processo. Se
+    path é .zip, os membros são lidos de myzip (ZipFile de path já
+    aberto) ou de um novo ZipFile.
+
+    Returns:
+        tupla (nome do csv gerado, nome do txt, linhas retificadas)
+
+    """
+    estatisticas = {}
+    if path.find('.zip') == -1:
+        with open(sch_name, encoding=ENCODE,
+                  newline='') as sch_file, \
+                open(txt_name, encoding=ENCODE,
+                     newline='') as txt_file:
+            sch_content = sch_file.readlines()
+            reader = csv.reader(txt_file, delimiter='\t')
+            csv_name = sch_tocsv(sch_content, reader, dest_path,
+                                 estatisticas, copia_colunar)
+    elif myzip is None:
+        with ZipFile(path) as myzip:
+            return sch_converte_par(path, sch_name, txt_name, dest_path,
+                                    myzip, copia_colunar)
+    else:
+        with myzip.open(sch_name) as sch_file:
+            sch_content = io.TextIOWrapper(
+                sch_file,
+                encoding=ENCODE, newline=''
+            ).readlines()
+        # O membro txt é descompactado à medida que é lido
+        with myzip.open(txt_name) as txt_file:
+            txt_io = io.TextIOWrapper(
+                txt_file,
+                encoding=ENCODE, newline=''
+            )
+            reader = csv.reader(txt_io, delimiter='\t')
+            csv_name = sch_tocsv(sch_content, reader, dest_path,
+                                 estatisticas, copia_colunar)
+    return csv_name, txt_name, estatisticas[csv_name]
+
+
+def processo_daemon():
+    """Retorna True se o processo atual é daemon (ex: worker Celery).
+
+    Os workers Celery prefork são processos billiard: a marcação é
+    verificada também em billiard, se disponível.
+    """
+    if current_process().daemon:
+        return True
+    return billiard is not None and billiard.current_process().daemon
+
+
+def _sch_converte_pares(path, mask_txt, dest_path, workers, copia_colunar,
+                        myzip=None):
+    """Converte os pares de path. Ver :func:`sch_processing`."""
+    pares = sch_pares(path, mask_txt, myzip)
+    if workers > 1 and len(pares) > 1:
+        # Cada processo abre o próprio ZipFile
+        argumentos = [(path, sch_name, txt_name, dest_path, None,
+                       copia_colunar) for sch_name, txt_name in pares]
+        processos = min(workers, len(pares))
+        if processo_daemon():
+            # apply_async: com starmap, os processos do billiard podem
+            # esperar até 30s ao terminar, confirmando o envio do resultado
+            with billiard.Pool(processos) as pool:
+                resultados = [pool.apply_async(sch_converte_par, argumento)
+                              for argumento in argumentos]
+                return [resultado.get() for resultado in resultados]
+        with ProcessPoolExecutor(max_workers=processos) as executor:
+            futuros = [executor.submit(sch_converte_par, *argumento)
+                       for argumento in argumentos]
+            return [futuro.result() for futuro in futuros]
+    return [sch_converte_par(path, sch_name, txt_name, dest_path, myzip,
+                             copia_colunar)
+            for sch_name, txt_name in pares]
+
+
+def sch_processing(path, mask_txt='0.txt', dest_path=tmpdir,
+                   estatisticas=None, workers=1, copia_colunar=False):
     """Processa arquivos sch (CARGA).
 
     Processa lotes de extração que gerem arquivos txt csv e arquivos sch
@@ -123,52 +783,42 @@ def sch_processing(path, mask_txt='0.txt', dest_path=tmpdir):
     Args:
         path: diretório ou arquivo .zip onde estão os arquivos .sch
 
+        estatisticas: se informado (dict), recebe para cada csv gerado a
+        quantidade de linhas retificadas. Ver :func:`sch_tocsv`
+
+        workers: quantidade de processos. Se maior que 1, os pares
+        (sch, txt) são convertidos em paralelo, cada um em um processo
+        (ver :func:`sch_converte_par`). Os csv gerados e a ordem do
+        retorno são os mesmos da conversão sequencial. Em processo daemon
+        (ex: worker Celery prefork), os processos são criados por
+        billiard.Pool; sem billiard, a conversão é sequencial
+
+        copia_colunar: grava também a cópia colunar de cada csv, na mesma
+        passada sobre o txt. Ver :func:`sch_tocsv`
+
+    Returns:
+        lista de tuplas (csv gerado, txt de origem), na ordem dos sch
+
     Obs:
         Não há procura recursiva, apenas no raiz do diretório
 
     """
-    filenames = []
+    if workers > 1 and billiard is None and processo_daemon():
+        # Processos daemon só podem ter filhos criados por billiard
+        logger.warning('sch_processing: conversão sequencial, processo '
+                       'atual não pode criar processos')
+        workers = 1
     if path.find('.zip') == -1:
-        for sch in glob.glob(os.path.join(path, '*.sch')):
-            sch_name = sch
-            # print('****', sch_name)
-            txt_name = glob.glob(os.path.join(
-                path, '*' + os.path.basename(sch_name)[3:-4] + mask_txt))[0]
-            with open(sch_name, encoding=ENCODE,
-                      newline='') as sch_file, \
-                    open(txt_name, encoding=ENCODE,
-                         newline='') as txt_file:
-                sch_content = sch_file.readlines()
-                reader = csv.reader(txt_file, delimiter='\t')
-                txt_content = [linha for linha in reader]
-            csv_name = sch_tocsv(sch_content, txt_content, dest_path)
-            filenames.append((csv_name, txt_name))
+        convertidos = _sch_converte_pares(path, mask_txt, dest_path,
+                                          workers, copia_colunar)
     else:
+        # O índice do .zip é lido uma só vez na conversão sequencial
         with ZipFile(path) as myzip:
-            info_list = myzip.infolist()
-            # print('info_list ',info_list)
-            for info in info_list:
-                if info.filename.find('.sch') != -1:
-                    sch_name = info.filename
-                    # print('****', sch_name)
-                    txt_search = sch_name[3:-4] + mask_txt
-                    # print('****', txt_search)
-                    for txtinfo in info_list:
-                        if txtinfo.filename.find(txt_search) != -1:
-                            txt_name = txtinfo.filename
-                            with myzip.open(sch_name) as sch_file:
-                                sch_content = io.TextIOWrapper(
-                                    sch_file,
-                                    encoding=ENCODE, newline=''
-                                ).readlines()
-                            with myzip.open(txt_name) as txt_file:
-                                txt_io = io.TextIOWrapper(
-                                    txt_file,
-                                    encoding=ENCODE, newline=''
-                                )
-                                reader = csv.reader(txt_io, delimiter='\t')
-                                txt_content = [linha for linha in reader]
-                                # print('txt_content', txt_content)
-                    csv_name = sch_tocsv(sch_content, txt_content, dest_path)
-                    filenames.append((csv_name, txt_name))
+            convertidos = _sch_converte_pares(path, mask_txt, dest_path,
+                                              workers, copia_colunar, myzip)
+    filenames = []
+    for csv_name, txt_name, retificadas in convertidos:
+        if estatisticas is not None:
+            estatisticas[csv_name] = retificadas
+        filenames.append((csv_name, txt_name))
     return filenames
@@ -9,21 +9,41 @@ e Mongo agreggation framework para consultas.
 
 """
 import csv
-import json
+import itertools
 import os
+import re
 import shutil
-from collections import OrderedDict, defaultdict
+import time
+from bisect import bisect_right
+from collections import defaultdict, deque
+from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import pymongo
 
 from ajna_commons.flask.log import logger
 from ajna_commons.utils.sanitiza import (sanitizar, sanitizar_lista,
                                          unicode_sanitizar)
-from bhadrasana.conf import ENCODE, tmpdir
+from bhadrasana.conf import (CACHE_JUNCOES_FOLDER, ENCODE,
+                             TAMANHO_CACHE_JUNCOES, TAMANHO_LOTE,
+                             TAMANHO_LOTE_MONGO, tmpdir)
 from bhadrasana.models.models import (BaseOrigem, Filtro, PadraoRisco,
                                       ParametroRisco, ValorParametro, Visao)
-from bhadrasana.utils.csv_handlers import muda_titulos_lista, sch_processing
+from bhadrasana.utils import chaves, colunar
+from bhadrasana.utils.cache_juncao import CacheJuncao
+from bhadrasana.utils.csv_handlers import (CacheSanitizar,
+                                           muda_titulos_arquivo,
+                                           muda_titulos_df,
+                                           muda_titulos_lista, sanitizar_df,
+                                           sanitizar_lista_cache,
+                                           sch_processing, strip_serie)
+from bhadrasana.utils.juncao import planeja_juncao, semi_juncao
+
+# Tipos dos valores gravados por csv_to_mongo (ver tipos_campos_mongo)
+TIPO_TEXTO = 'texto'
+TIPO_DATA = 'data'
+TIPO_NUMERO = 'numero'
 
 
 class SemHeaders(Exception):
@@ -53,9 +73,7 @@ def equality(listaoriginal, nomecampo, listavalores):
         listavalores
 
     """
-    df = pd.DataFrame(listaoriginal[1:], columns=listaoriginal[0])
-    df = df[df[nomecampo].isin(listavalores)]
-    return df.values.tolist()
+    return FiltroIgualdade(listavalores).filtra(listaoriginal, nomecampo)
 
 
 def startswith(listaoriginal, nomecampo, listavalores):
@@ -73,12 +91,7 @@ def startswith(listaoriginal, nomecampo, listavalores):
         da listavalores
 
     """
-    df = pd.DataFrame(listaoriginal[1:], columns=listaoriginal[0])
-    result = []
-    for valor in listavalores:
-        df_filtered = df[df[nomecampo].str.startswith(valor, na=False)]
-        result.extend(df_filtered.values.tolist())
-    return result
+    return FiltroPrefixo(listavalores).filtra(listaoriginal, nomecampo)
 
 
 def contains(listaoriginal, nomecampo, listavalores):
@@ -96,20 +109,413 @@ def contains(listaoriginal, nomecampo, listavalores):
         da listavalores
 
     """
-    df = pd.DataFrame(listaoriginal[1:], columns=listaoriginal[0])
-    result = []
-    for valor in listavalores:
-        df_filtered = df[df[nomecampo].str.contains(valor, na=False)]
-        result.extend(df_filtered.values.tolist())
-    return result
+    return FiltroContem(listavalores).filtra(listaoriginal, nomecampo)
 
 
+class AhoCorasick():
+    """Autômato de Aho-Corasick para busca simultânea de vários termos.
+
+    Monta uma única vez a árvore de prefixos (trie) dos termos, com os
+    links de falha, e depois percorre cada texto uma só vez, independente
+    da quantidade de termos buscados.
+    """
+
+    def __init__(self, termos):
+        """Monta o autômato a partir da lista de termos."""
+        self._transicoes = [{}]
+        self._falhas = [0]
+        self._saidas = [None]
+        for termo in termos:
+            self._adiciona(termo)
+        self._monta_falhas()
+
+    def _adiciona(self, termo):
+        estado = 0
+        for caractere in termo:
+            proximo = self._transicoes[estado].get(caractere)
+            if proximo is None:
+                proximo = len(self._transicoes)
+                self._transicoes.append({})
+                self._falhas.append(0)
+                self._saidas.append(None)
+                self._transicoes[estado][caractere] = proximo
+            estado = proximo
+        if self._saidas[estado] is None:
+            self._saidas[estado] = termo
+
+    def _monta_falhas(self):
+        fila = deque(self._transicoes[0].values())
+        while fila:
+            estado = fila.popleft()
+            for caractere, proximo in self._transicoes[estado].items():
+                fila.append(proximo)
+                falha = self._falhas[estado]
+                while falha and caractere not in self._transicoes[falha]:
+                    falha = self._falhas[falha]
+                falha = self._transicoes[falha].get(caractere, 0)
+                self._falhas[proximo] = falha
+                if self._saidas[proximo] is None:
+                    # Herda a saída do link de falha (termo sufixo)
+                    self._saidas[proximo] = self._saidas[falha]
+
+    def busca(self, texto):
+        """Retorna o primeiro termo encontrado no texto, ou None."""
+        if self._saidas[0] is not None:
+            return self._saidas[0]
+        transicoes = self._transicoes
+        falhas = self._falhas
+        saidas = self._saidas
+        estado = 0
+        for caractere in texto:
+            while estado and caractere not in transicoes[estado]:
+                estado = falhas[estado]
+            estado = transicoes[estado].get(caractere, 0)
+            if saidas[estado] is not None:
+                return saidas[estado]
+        return None
+
+
+class FiltroCompilado():
+    """Filtro de risco compilado uma única vez para uma lista de valores.
+
+    Subclasses implementam :py:func:`encontra`, que recebe um valor do
+    campo e retorna o valor do filtro correspondente (ou None). A máscara
+    é calculada uma só vez sobre os valores únicos da coluna, em
+    passada única, em vez de uma varredura da coluna para cada valor.
+    """
+
+    def __init__(self, listavalores):
+        """Guarda os valores e monta o índice da subclasse."""
+        self.valores = list(listavalores)
+
+    def encontra(self, valor):
+        """Retorna o valor de filtro correspondente a valor, ou None."""
+        raise NotImplementedError()
+
+    def mascara(self, serie):
+        """Retorna Series booleana: True nas linhas que atendem ao filtro."""
+        unicos = serie.dropna().unique()
+        encontrados = [valor for valor in unicos
+                       if self.encontra(valor) is not None]
+        return serie.isin(encontrados)
+
+    def correspondencias(self, serie):
+        """Retorna Series com o valor de filtro encontrado em cada linha."""
+        unicos = serie.dropna().unique()
+        return serie.map({valor: self.encontra(valor) for valor in unicos})
+
+    def filtra(self, listaoriginal, nomecampo):
+        """Aplica o filtro em lista (1ª linha com nomes de campo)."""
+        df = pd.DataFrame(listaoriginal[1:], columns=listaoriginal[0])
+        return df[self.mascara(df[nomecampo])].values.tolist()
+
+    def consulta_mongo(self, campo, tipo=TIPO_TEXTO):
+        """Retorna lista de condições MongoDB equivalentes ao filtro.
+
+        Um documento atende ao filtro se atender a qualquer das condições
+        (para uso em $or). Ver :py:func:`GerenteRisco.filtro_mongo`.
+
+        Args:
+            campo: nome do campo
+
+            tipo: tipo dos valores gravados no campo (ver
+            :func:`tipos_campos_mongo`)
+
+        """
+        raise NotImplementedError()
+
+
+class FiltroIgualdade(FiltroCompilado):
+    """Filtro igual: busca em conjunto (hash)."""
+
+    def __init__(self, listavalores):
+        """Monta o conjunto de valores."""
+        super().__init__(listavalores)
+        self._conjunto = set(self.valores)
+
+    def encontra(self, valor):
+        """Retorna o valor se estiver no conjunto."""
+        return valor if valor in self._conjunto else None
+
+    def mascara(self, serie):
+        """Usa diretamente o isin do pandas."""
+        return serie.isin(self._conjunto)
+
+    def consulta_mongo(self, campo, tipo=TIPO_TEXTO):
+        """Uma condição $in com todos os valores, convertidos para tipo.
+
+        Valores que não podem ser convertidos (ex: texto em campo de data)
+        são descartados com aviso.
+        """
+        valores = []
+        for valor in sorted(self._conjunto):
+            try:
+                valores.append(converte_valor_mongo(valor, tipo))
+            except ValueError:
+                logger.warning('Valor %s do filtro igual ignorado: campo %s '
+                               'é %s' % (valor, campo, tipo))
+        if not valores:
+            return []
+        return [{campo: {'$in': valores}}]
+
+
+class FiltroPrefixo(FiltroCompilado):
+    """Filtro comeca_com: índice de prefixos ordenados.
+
+    Prefixos redundantes (que começam com outro prefixo da lista) são
+    descartados, de forma que no máximo um prefixo pode corresponder
+    a cada valor e a busca é uma bissecção na lista ordenada.
+    A máscara agrupa os prefixos por tamanho: uma passada vetorizada
+    por tamanho distinto de prefixo (normalmente um só, ex. raiz de CNPJ).
+    """
+
+    def __init__(self, listavalores):
+        """Monta lista ordenada e agrupamento por tamanho dos prefixos."""
+        super().__init__(listavalores)
+        self._prefixos = []
+        for prefixo in sorted(set(self.valores)):
+            if not (self._prefixos and
+                    prefixo.startswith(self._prefixos[-1])):
+                self._prefixos.append(prefixo)
+        self._por_tamanho = defaultdict(set)
+        for prefixo in self._prefixos:
+            self._por_tamanho[len(prefixo)].add(prefixo)
+
+    def encontra(self, valor):
+        """Bissecção: candidato é o maior prefixo menor ou igual a valor."""
+        ind = bisect_right(self._prefixos, valor)
+        if ind and valor.startswith(self._prefixos[ind - 1]):
+            return self._prefixos[ind - 1]
+        return None
+
+    def mascara(self, serie):
+        """Uma comparação vetorizada por tamanho de prefixo."""
+        mascara = pd.Series(False, index=serie.index)
+        for tamanho, prefixos in self._por_tamanho.items():
+            mascara |= serie.str[:tamanho].isin(prefixos)
+        return mascara
+
+    def consulta_mongo(self, campo, tipo=TIPO_TEXTO):
+        """Uma condição $in com uma expressão ^prefixo por prefixo.
+
+        Expressões ancoradas no início e sem alternância podem ser
+        resolvidas pelo MongoDB como intervalos do índice do campo.
+        Somente para campos texto (ver :func:`filtro_texto_mongo`).
+        """
+        if not filtro_texto_mongo(campo, tipo, 'comeca_com'):
+            return []
+        return [{campo: {'$in': [re.compile('^' + escapa_regex(prefixo))
+                                 for prefixo in self._prefixos]}}]
+
+
+class FiltroContem(FiltroCompilado):
+    """Filtro contem: autômato de Aho-Corasick com todos os valores."""
+
+    def __init__(self, listavalores):
+        """Monta o autômato."""
+        super().__init__(listavalores)
+        self._automato = AhoCorasick(self.valores)
+
+    def encontra(self, valor):
+        """Retorna o primeiro valor do filtro contido em valor."""
+        return self._automato.busca(valor)
+
+    def consulta_mongo(self, campo, tipo=TIPO_TEXTO):
+        """Condições $regex com alternância dos valores, em lotes.
+
+        Cada expressão tem no máximo TAMANHO_LOTE_REGEX valores, para
+        limitar o tamanho das expressões enviadas ao servidor.
+        Somente para campos texto (ver :func:`filtro_texto_mongo`).
+        """
+        if not filtro_texto_mongo(campo, tipo, 'contem'):
+            return []
+        valores = sorted(set(self.valores))
+        return [{campo: {'$regex': '|'.join(
+            escapa_regex(valor) for valor in
+            valores[inicio:inicio + TAMANHO_LOTE_REGEX])}}
+            for inicio in range(0, len(valores), TAMANHO_LOTE_REGEX)]
+
+
+def escapa_regex(texto):
+    """Escapa os caracteres especiais de expressão regular em texto.
+
+    Somente os metacaracteres são escapados (re.escape, em versões
+    anteriores do Python, escapa também letras acentuadas).
+    """
+    return REGEX_METACARACTERES.sub(r'\\\g<0>', texto)
+
+
+def tipo_valor_mongo(valor):
+    """Retorna o tipo (TIPO_DATA, TIPO_NUMERO ou TIPO_TEXTO) de valor."""
+    if isinstance(valor, datetime):
+        return TIPO_DATA
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return TIPO_NUMERO
+    return TIPO_TEXTO
+
+
+def tipos_campos_mongo(collection, campos):
+    """Retorna dict campo: tipo dos valores gravados na coleção.
+
+    csv_to_mongo grava datas do sch como datetime e números como número
+    (ver :func:`documentos_mongo`). O tipo é o do valor do campo no
+    primeiro documento em que não é nulo. Campos sem valores não entram.
+    """
+    tipos = {}
+    for campo in campos:
+        documento = collection.find_one({campo: {'$ne': None}},
+                                        {campo: 1, '_id': 0})
+        if documento and campo in documento:
+            tipos[campo] = tipo_valor_mongo(documento[campo])
+    return tipos
+
+
+def converte_valor_mongo(valor, tipo):
+    """Converte valor (texto) de parâmetro de risco para o tipo do campo.
+
+    Datas no FORMATO_DATA_SCH ou AAAA-MM-DD; números com vírgula ou
+    ponto decimal, como em :py:func:`bhadrasana.utils.colunar.converte_dtypes`.
+
+    Raises:
+        ValueError: se valor não puder ser convertido
+
+    """
+    if tipo == TIPO_DATA:
+        for formato in (colunar.FORMATO_DATA_SCH, '%Y-%m-%d'):
+            try:
+                return datetime.strptime(valor.strip(), formato)
+            except ValueError:
+                pass
+        raise ValueError('Data inválida: %s' % valor)
+    if tipo == TIPO_NUMERO:
+        return float(valor.strip().replace(',', '.'))
+    return valor
+
+
+def filtro_texto_mongo(campo, tipo, nome_filtro):
+    """Retorna True se campo é texto; se não, avisa que o filtro é ignorado.
+
+    comeca_com e contem são expressões regulares, que o MongoDB somente
+    aplica a textos: em campos de data ou número não encontrariam nada.
+    """
+    if tipo == TIPO_TEXTO:
+        return True
+    logger.warning('Filtro %s ignorado: campo %s é %s' %
+                   (nome_filtro, campo, tipo))
+    return False
+
+
+COLUNA_RISCOS = 'riscos_encontrados'
+# Valores por expressão regular nas consultas MongoDB de filtros contem
+TAMANHO_LOTE_REGEX = 200
+REGEX_METACARACTERES = re.compile(r'[\\.^$|?*+()\[\]{}]')
+# Código de erro do MongoDB para chave duplicada (índice único)
+DUPLICATE_KEY = 11000
+SEPARADOR_RISCOS = '; '
+
+# Equivalentes vetorizados (DataFrame) das funções de pre_processers (lista)
+pre_processers_df = {
+    muda_titulos_lista: muda_titulos_df,
+    sanitizar_lista: sanitizar_df,
+    sanitizar_lista_cache: sanitizar_df
+}
+
 filter_functions = {
     Filtro.igual: equality,
     Filtro.comeca_com: startswith,
     Filtro.contem: contains
 }
 
+filtros_compilados = {
+    Filtro.igual: FiltroIgualdade,
+    Filtro.comeca_com: FiltroPrefixo,
+    Filtro.contem: FiltroContem
+}
+
+
+def compila_filtro(tipo_filtro, listavalores):
+    """Retorna o FiltroCompilado do tipo_filtro para a listavalores."""
+    classe_filtro = filtros_compilados.get(tipo_filtro)
+    if classe_filtro is None:
+        raise NotImplementedError('Função de filtro' +
+                                  tipo_filtro.name +
+                                  ' não implementada.')
+    return classe_filtro(listavalores)
+
+
+def documentos_mongo(df):
+    """Converte DataFrame em lista de dicts para inserção no MongoDB.
+
+    Como json.loads(df.to_json(orient='records')), porém sem passar por
+    texto: números continuam números e datas (datetime64) viram datetime.
+    Nulos (NaN, NaT) viram None.
+    """
+    registros = df.astype(object)
+    for coluna, dtype in df.dtypes.items():
+        if dtype.kind == 'M':
+            registros[coluna] = pd.Series(df[coluna].dt.to_pydatetime(),
+                                          index=df.index, dtype=object)
+    return registros.where(df.notna(), None).to_dict(orient='records')
+
+
+def insere_lote(collection, documentos):
+    """Insere documentos com um único insert_many(ordered=False).
+
+    Erros de chave duplicada (código DUPLICATE_KEY) não interrompem o
+    lote: os demais documentos são inseridos e os duplicados ignorados.
+    Outros erros são propagados.
+
+    Returns:
+        tupla (inseridos, duplicados)
+
+    """
+    if not documentos:
+        return 0, 0
+    try:
+        collection.insert_many(documentos, ordered=False)
+    except pymongo.errors.BulkWriteError as err:
+        erros = err.details.get('writeErrors', [])
+        if any(erro.get('code') != DUPLICATE_KEY for erro in erros) or \
+                err.details.get('writeConcernErrors'):
+            raise
+        return err.details.get('nInserted', 0), len(erros)
+    return len(documentos), 0
+
+
+def atualiza_lote(collection, documentos, campos):
+    """Grava documentos por upsert, identificados pelos campos da chave.
+
+    Um único bulk_write(ordered=False) com um UpdateOne(upsert=True) por
+    documento: documentos já existentes são atualizados, e não
+    duplicados. Assim arquivar de novo a mesma base não altera a coleção.
+
+    Returns:
+        tupla (inseridos, já existentes)
+
+    """
+    if not documentos:
+        return 0, 0
+    operacoes = [pymongo.UpdateOne(
+        {campo: documento.get(campo) for campo in campos},
+        {'$set': documento}, upsert=True) for documento in documentos]
+    result = collection.bulk_write(operacoes, ordered=False)
+    return result.upserted_count, result.matched_count
+
+
+def chaves_tabelas(base):
+    """Retorna dict nome do csv (sem extensão): campos da chave.
+
+    Lido das Tabelas das Visões da base (ver
+    :py:attr:`bhadrasana.models.models.Tabela.chave`).
+    """
+    chaves = {}
+    for visao in getattr(base, 'visoes', None) or []:
+        for tabela in visao.tabelas:
+            campos = getattr(tabela, 'campos_chave', None)
+            if campos:
+                chaves.setdefault(tabela.csv_table, campos)
+    return chaves
+
 # TODO: Estudar refatoração: dividir em classes, utilizar herança
 # GerenteRisco->GerenteRiscoCSV
 # GerenteRisco->GerenteRiscoMongo
@@ -140,6 +546,9 @@ class GerenteRisco():
 
         riscosativos: dict descreve "riscos" (compilado dos ParametrosRisco)
 
+        filtroscompilados: dict campo: {tipo_filtro: FiltroCompilado},
+        montado uma vez por ParametroRisco adicionado
+
         padraorisco: PadraoRisco ativo
     """
 
@@ -148,10 +557,13 @@ class GerenteRisco():
         self.pre_processers = {}
         self.pre_processers_params = {}
         self._riscosativos = {}
+        self._filtroscompilados = {}
+        self._cache_sanitizar = None
+        self._cache_juncao = None
         self._padraorisco = None
 
     def importa_base(self, csv_folder: str, baseid: int, data: str,
-                     filename: str, remove=False):
+                     filename: str, remove=False, workers=1):
         """Copia base para dest_path, processando se necessário.
 
         Aceita arquivos .zip contendo arquivos sch e arquivos csv únicos.
@@ -171,9 +583,21 @@ class GerenteRisco():
 
             remove: excluir o arquivo temporário após processamento
 
+            workers: processos para converter os arquivos sch em paralelo
+            (ver :func:`bhadrasana.utils.csv_handlers.sch_processing`).
+            Padrão sequencial: somente o worker Celery (importar_base)
+            converte em paralelo, não o processo web
+
         Returns:
             Uma tupla ou lista de tuplas. Primeiros itens são CSVs criados
 
+        Obs:
+            Para cada CSV criado é gravada também a cópia colunar (ver
+            :mod:`bhadrasana.utils.colunar`), usada nas leituras seguintes.
+            No caso de sch, a cópia é gravada diretamente do txt, com os
+            tipos informados no sch (ver
+            :func:`bhadrasana.utils.csv_handlers.sch_tocsv`)
+
         """
         dest_path = os.path.join(csv_folder, str(baseid),
                                  data[:4], data[5:7], data[8:10])
@@ -185,8 +609,15 @@ class GerenteRisco():
             os.makedirs(dest_path)
         try:
             if '.zip' in filename or os.path.isdir(filename):
+                estatisticas = {}
                 result = sch_processing(filename,
-                                        dest_path=dest_path)
+                                        dest_path=dest_path,
+                                        estatisticas=estatisticas,
+                                        workers=workers,
+                                        copia_colunar=True)
+                for arquivo, retificadas in estatisticas.items():
+                    logger.info('Importação %s: %s linhas retificadas' %
+                                (arquivo, retificadas))
             else:
                 # No caso de CSV, retornar erro caso títulos não batam
                 # com importação anterior
@@ -213,6 +644,10 @@ class GerenteRisco():
                 # result = csv_processing(tempfile, dest_path=dest_path)
             if not os.path.isdir(filename) and remove:
                 os.remove(filename)
+            for arquivo in result:
+                # Arquivos sch já têm a cópia gravada junto com o csv
+                if not colunar.colunar_atualizado(arquivo[0]):
+                    colunar.grava_colunar(arquivo[0])
         except Exception as err:
             shutil.rmtree(dest_path)
             raise err
@@ -229,6 +664,7 @@ class GerenteRisco():
         """
         self._padraorisco = padraorisco
         self._riscosativos = {}
+        self._filtroscompilados = {}
         if self._padraorisco:
             for parametro in self._padraorisco.parametros:
                 print(parametro)
@@ -260,6 +696,7 @@ class GerenteRisco():
         for valor in parametrorisco.valores:
             dict_filtros[valor.tipo_filtro].append(valor.valor.lower())
         self._riscosativos[parametrorisco.nome_campo.lower()] = dict_filtros
+        self._compila_filtros(parametrorisco.nome_campo.lower())
         if session and self._padraorisco:
             self._padraorisco.parametros.append(parametrorisco)
             session.merge(self._padraorisco)
@@ -274,6 +711,7 @@ class GerenteRisco():
             session: Sessão do banco de dados
         """
         self._riscosativos.pop(parametrorisco.nome_campo, None)
+        self._filtroscompilados.pop(parametrorisco.nome_campo, None)
         if session and self._padraorisco:
             self._padraorisco.parametros.remove(parametrorisco)
             session.merge(self._padraorisco)
@@ -286,11 +724,28 @@ class GerenteRisco():
             session: Sessão do banco de dados
         """
         self._riscosativos = {}
+        self._filtroscompilados = {}
         if session and self._padraorisco:
             self._padraorisco.parametros.clear()
             session.merge(self._padraorisco)
             session.commit()
 
+    def _compila_filtros(self, campo):
+        """Monta os FiltroCompilado do campo a partir dos riscos ativos."""
+        dict_filtros = self._riscosativos.get(campo, {})
+        self._filtroscompilados[campo] = {
+            tipo_filtro: compila_filtro(tipo_filtro, lista_filtros)
+            for tipo_filtro, lista_filtros in dict_filtros.items()
+        }
+        return self._filtroscompilados[campo]
+
+    def get_filtros_compilados(self, campo):
+        """Retorna os filtros compilados do campo, compilando se preciso."""
+        filtros = self._filtroscompilados.get(campo)
+        if filtros is None:
+            filtros = self._compila_filtros(campo)
+        return filtros
+
     def checa_depara(self, base: BaseOrigem):
         """Se tiver depara na base, adiciona aos pre_processers.
 
@@ -309,10 +764,33 @@ class GerenteRisco():
 
         Os pre_processers são usados ao recuperar headers, importar,
         aplicar_risco, entre outras ações.
+
+        Os valores já sanitizados ficam em um cache limitado
+        (:class:`CacheSanitizar`), reaproveitado por todos os arquivos
+        processados por este GerenteRisco (ex: arquivos de uma importação).
         """
-        self.pre_processers['sanitizar'] = sanitizar_lista
+        if (self._cache_sanitizar is None or
+                self._cache_sanitizar.norm_function != norm_function):
+            self._cache_sanitizar = CacheSanitizar(norm_function)
+        self.pre_processers['sanitizar'] = sanitizar_lista_cache
         self.pre_processers_params['sanitizar'] = {
-            'norm_function': norm_function}
+            'norm_function': norm_function,
+            'cache': self._cache_sanitizar}
+
+    def ativa_cache_juncao(self, diretorio=CACHE_JUNCOES_FOLDER,
+                           tamanho_maximo=TAMANHO_CACHE_JUNCOES):
+        """Grava e reutiliza os resultados de :func:`aplica_juncao`.
+
+        Ver :class:`bhadrasana.utils.cache_juncao.CacheJuncao`.
+
+        Args:
+            diretorio: onde gravar os resultados das junções
+
+            tamanho_maximo: tamanho total máximo do cache, em bytes. Os
+            resultados menos usados recentemente são descartados
+
+        """
+        self._cache_juncao = CacheJuncao(diretorio, tamanho_maximo)
 
     def load_csv(self, arquivo):
         """Carrega arquivo csv em lista."""
@@ -322,14 +800,26 @@ class GerenteRisco():
         return lista
 
     def save_csv(self, lista, arquivo):
-        """Salva lista em arquivo csv. Exclui se existir."""
+        """Salva lista em arquivo csv. Exclui se existir.
+
+        lista pode ser qualquer iterável de linhas (ex: gerador de
+        :py:func:`itera_mongo`): as linhas são gravadas uma a uma.
+
+        Returns:
+            Número de linhas gravadas
+
+        """
         try:
             os.remove(arquivo)  # Remove resultado antigo se houver
         except IOError:
             pass
+        total = 0
         with open(arquivo, 'w', encoding=ENCODE, newline='') as csv_out:
             writer = csv.writer(csv_out)
-            writer.writerows(lista)
+            for linha in lista:
+                writer.writerow(linha)
+                total += 1
+        return total
 
     def strip_lines(self, lista):
         """Retira espaços adicionais entre palavras.
@@ -346,6 +836,21 @@ class GerenteRisco():
             lista[ind] = linha_striped
         return lista
 
+    def strip_df(self, df):
+        """Retira espaços antes e depois de títulos e valores do DataFrame.
+
+        Equivalente vetorizado de :func:`strip_lines`. Valores que não são
+        texto são mantidos como estão.
+        """
+        colunas = [coluna.strip() if isinstance(coluna, str) else coluna
+                   for coluna in df.columns]
+        if df.shape[1] == 0:
+            return df.rename(columns=dict(zip(df.columns, colunas)))
+        result = pd.concat([strip_serie(df.iloc[:, ind])
+                            for ind in range(df.shape[1])], axis=1)
+        result.columns = colunas
+        return result
+
     def pre_processa(self, lista):
         """Aplica funções de processamento de texto na lista."""
         for key in self.pre_processers:
@@ -353,32 +858,121 @@ class GerenteRisco():
                                              **self.pre_processers_params[key])
         return lista
 
-    def pre_processa_arquivos(self, lista_arquivos):
+    def pre_processa_df(self, df, strip=True):
+        """Aplica strip e pre_processers em um DataFrame.
+
+        Para pre_processers com equivalente vetorizado (ver
+        pre_processers_df) é utilizada a versão DataFrame, coluna a coluna.
+        Os demais recebem listas: somente para estes o DataFrame é
+        convertido em lista e de volta.
+        """
+        if strip:
+            df = self.strip_df(df)
+        for key, pre_processer in self.pre_processers.items():
+            params = self.pre_processers_params.get(key, {})
+            pre_processer_df = pre_processers_df.get(pre_processer)
+            if pre_processer_df:
+                df = pre_processer_df(df, **params)
+            else:
+                lista = [df.columns.tolist()]
+                lista.extend(df.values.tolist())
+                lista = pre_processer(lista, **params)
+                df = pd.DataFrame(lista[1:], columns=lista[0])
+        return df
+
+    def pre_processa_arquivos(self, lista_arquivos, chunksize=TAMANHO_LOTE):
         """Carrega uma lista de arquivos e pré processa texto.
 
         Carrega a lista de arquivos aplica as funções de pré processamento
         ativas. Salva novamente no mesmo arquivo.
+
+        Os arquivos são processados em lotes de chunksize linhas, com as
+        versões vetorizadas dos pre_processers (ver :func:`pre_processa_df`).
+        Se só houver mudança de títulos (DePara), somente a primeira linha
+        de cada arquivo é reescrita (ver :func:`muda_titulos_arquivo`).
+        A cópia colunar é regravada com os metadados dos campos da cópia
+        anterior (tipos do sch), por posição: os títulos podem mudar.
         """
-        # print(lista_arquivos)
+        alista = lista_arquivos
         if len(lista_arquivos) > 0:
             if (isinstance(lista_arquivos[0], list) or
                     isinstance(lista_arquivos[0], tuple)):
                 alista = [linha[0] for linha in lista_arquivos]
-        # print(alista)
+        so_titulos = all(pre_processer == muda_titulos_lista
+                         for pre_processer in self.pre_processers.values())
         for filename in alista:
-            lista = self.load_csv(filename)
-            lista = self.pre_processa(lista)
-            self.save_csv(lista, filename)
+            if so_titulos and self._pre_processa_titulos(filename):
+                continue
+            metadados = colunar.metadados_colunar(filename)
+            try:
+                self._pre_processa_arquivo_df(filename, chunksize, metadados)
+            except (pd.errors.ParserError, pd.errors.EmptyDataError) as err:
+                # Linhas com largura diferente do cabeçalho: usar listas
+                logger.warning('Pré-processando %s como lista: %s' %
+                               (filename, err))
+                lista = self.load_csv(filename)
+                lista = self.pre_processa(lista)
+                self.save_csv(lista, filename)
+                colunar.grava_colunar(filename, metadados=metadados)
+
+    def _pre_processa_titulos(self, filename):
+        """Aplica os pre_processers de títulos só na linha de títulos.
+
+        Returns:
+            False se a linha de títulos não puder ser tratada isoladamente
+
+        """
+        colunar_atualizado = colunar.colunar_atualizado(filename)
+        titulos = None
+        for key in self.pre_processers:
+            de_para_dict = self.pre_processers_params[key]['de_para_dict']
+            titulos = muda_titulos_arquivo(filename, de_para_dict)
+            if titulos is None:
+                return False
+        if titulos is not None:
+            if colunar_atualizado:
+                colunar.renomeia_colunar(filename, titulos)
+            else:
+                colunar.grava_colunar(filename)
+        return True
 
-    def aplica_risco(self, lista=None, arquivo=None, parametros_ativos=None):
+    def _pre_processa_arquivo_df(self, filename, chunksize, metadados=None):
+        temp_filename = filename + '.tmp'
+        escritor = colunar.EscritorColunar(filename, metadados)
+        try:
+            with open(temp_filename, 'w', encoding=ENCODE,
+                      newline='') as csv_out:
+                writer = csv.writer(csv_out)
+                lotes = colunar.le_lotes(filename, chunksize)
+                for ind, lote in enumerate(lotes):
+                    lote = self.pre_processa_df(lote, strip=False)
+                    if ind == 0:
+                        writer.writerow(lote.columns.tolist())
+                    # Linhas montadas das colunas, sem o array 2D de values
+                    writer.writerows(zip(*(lote.iloc[:, ind].tolist()
+                                           for ind in range(lote.shape[1]))))
+                    escritor.escreve(lote)
+            os.replace(temp_filename, filename)
+            # Cópia colunar substituída depois do csv: fica mais nova que ele
+            escritor.fecha()
+        finally:
+            escritor.descarta()
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    def aplica_risco(self, lista=None, arquivo=None, parametros_ativos=None,
+                     df=None, deduplicar=False):
         """Método de filtragem de lista ou dados de arquivo.
 
         Compara a linha de título da lista recebida com a lista de nomes
-        de campo que possuem parâmetros de risco ativos. Após, chama para cada
-        campo encontrado a função de filtragem. Somente um dos parâmetros
+        de campo que possuem parâmetros de risco ativos. Após, aplica para
+        cada campo encontrado o filtro compilado. Somente um dos parâmetros
         precisa ser passado. Caso na lista do pipeline estejam cadastradas
         funções de pré-processamento, serão aplicadas.
 
+        A entrada é convertida **uma única vez** em DataFrame, e todos os
+        filtros são máscaras booleanas sobre este mesmo DataFrame.
+
         Args:
             lista (list): Lista a ser filtrada, primeira linha deve conter os
             nomes dos campos idênticos aos definidos no nome_campo
@@ -388,9 +982,18 @@ class GerenteRisco():
 
             arquivo (str): Arquivo csv de onde carregar a lista a ser filtrada
 
+            **OU**
+
+            df: DataFrame pandas ou Table pyarrow já carregado. Se for
+            Table e não houver pre_processers, ver :func:`filtra_tabela`
+
             parametros_ativos: subconjunto do parâmetros de risco a serem
             aplicados
 
+            deduplicar: se True, cada linha selecionada aparece uma única
+            vez, com uma coluna adicional (COLUNA_RISCOS) listando os
+            campos e valores de risco encontrados. Ver :func:`filtra_df`
+
         Returns:
             Lista contendo os campos filtrados. 1ª linha com nomes de campo
 
@@ -403,44 +1006,206 @@ class GerenteRisco():
         if arquivo:
             mensagem = 'Lista não fornecida!'
             lista = self.load_csv(arquivo)
-        if not lista:
-            raise AttributeError('Erro! ' + mensagem)
-        # Aplicar pre_processers
-        # logger.debug('Aplica risco. Lista ANTES do pre processamento')
-        # logger.debug(lista[:10])
-        lista = self.strip_lines(lista)
-        lista = self.pre_processa(lista)
-        # logger.debug('Aplica risco. Lista DEPOIS do pre processamento')
-        # logger.debug(lista[:10])
-        headers = set(lista[0])
-        # print('Ativos:', parametros_ativos)
-        if parametros_ativos:
-            riscos = set([parametro.lower()
-                          for parametro in parametros_ativos])
-        else:
-            riscos = set([key.lower() for key in self._riscosativos.keys()])
-        aplicar = headers & riscos   # INTERSECTION OF SETS
-        # logger.debug('Headers, riscos a aplicar, e intersecção: ')
-        # logger.debug(headers)
-        # logger.debug(riscos)
-        # logger.debug(aplicar)
-        result = []
-        result.append(lista[0])
-        # print(self._riscosativos)
-        for campo in aplicar:
-            dict_filtros = self._riscosativos.get(campo)
-            for tipo_filtro, lista_filtros in dict_filtros.items():
-                filter_function = filter_functions.get(tipo_filtro)
-                if filter_function is None:
-                    raise NotImplementedError('Função de filtro' +
-                                              tipo_filtro.name +
-                                              ' não implementada.')
-                result_filter = filter_function(lista, campo, lista_filtros)
-                # print('result_filter', result_filter)
-                for linha in result_filter:
-                    result.append(linha)
+        if df is None:
+            if not lista:
+                raise AttributeError('Erro! ' + mensagem)
+            df = pd.DataFrame(lista[1:], columns=lista[0])
+        elif hasattr(df, 'to_pandas'):  # pyarrow.Table
+            if not self.pre_processers:
+                # Avalia só as colunas com risco, copia só as linhas achadas
+                result_df = self.filtra_tabela(df, parametros_ativos,
+                                               deduplicar)
+                df = None
+            else:
+                df = colunar.para_pandas(df)
+        if df is not None:
+            # Aplicar pre_processers
+            df = self.pre_processa_df(df)
+            result_df = self.filtra_df(df, parametros_ativos, deduplicar)
+        result = [result_df.columns.tolist()]
+        result.extend(result_df.values.tolist())
         return result
 
+    def aplica_risco_arquivo(self, arquivo, destino, parametros_ativos=None,
+                             deduplicar=False, chunksize=TAMANHO_LOTE):
+        """Aplica risco em arquivo csv em lotes, gravando em destino.
+
+        Para extrações maiores que a memória disponível: lê arquivo em lotes
+        de chunksize linhas, aplica os filtros compilados em cada lote e
+        grava as linhas selecionadas incrementalmente no csv destino
+        (excluído antes se existir). A memória utilizada depende somente
+        de chunksize, não do tamanho do arquivo.
+
+        Args:
+            arquivo: csv de origem, 1ª linha com nomes de campo
+
+            destino: csv onde gravar o resultado
+
+            parametros_ativos: subconjunto do parâmetros de risco a serem
+            aplicados
+
+            deduplicar: ver :func:`filtra_df`. No modo padrão, as linhas
+            ficam agrupadas por filtro dentro de cada lote
+
+            chunksize: quantidade de linhas de cada lote
+
+        Returns:
+            Número de linhas gravadas, sem contar a de títulos
+
+        """
+        if not self.pre_processers and colunar.colunar_atualizado(arquivo):
+            # Cópia colunar mapeada em memória: fatias sem cópia, avaliando
+            # somente as colunas com risco
+            tabela = colunar.abre_tabela(arquivo)
+            lotes = (fatia for _, fatia in colunar.fatias(tabela, chunksize))
+            filtra = self.filtra_tabela
+        else:
+            try:
+                lotes = colunar.le_lotes(arquivo, chunksize)
+                primeiro = next(lotes, None)
+            except pd.errors.EmptyDataError:
+                raise AttributeError('Erro! Arquivo %s vazio!' % arquivo)
+            if primeiro is not None:
+                lotes = itertools.chain([primeiro], lotes)
+            filtra = self._filtra_lote
+        try:
+            os.remove(destino)  # Remove resultado antigo se houver
+        except IOError:
+            pass
+        total = 0
+        with open(destino, 'w', encoding=ENCODE, newline='') as csv_out:
+            writer = csv.writer(csv_out)
+            cabecalho = None
+            for lote in lotes:
+                result_df = filtra(lote, parametros_ativos, deduplicar)
+                if cabecalho is None:
+                    cabecalho = result_df.columns.tolist()
+                    writer.writerow(cabecalho)
+                writer.writerows(result_df.values.tolist())
+                total += len(result_df)
+        logger.debug('aplica_risco_arquivo: %s linhas gravadas em %s' %
+                     (total, destino))
+        return total
+
+    def _filtra_lote(self, lote, parametros_ativos, deduplicar):
+        lote = self.pre_processa_df(lote)
+        return self.filtra_df(lote, parametros_ativos, deduplicar)
+
+    def riscos_aplicaveis(self, headers, parametros_ativos=None):
+        """Retorna, ordenados, os campos com risco ativo presentes em headers.
+
+        Args:
+            headers: nomes de campo da base
+
+            parametros_ativos: subconjunto do parâmetros de risco a serem
+            aplicados
+        """
+        riscos = self.campos_risco(parametros_ativos)
+        return sorted(set(headers) & riscos)   # INTERSECTION OF SETS
+
+    def campos_risco(self, parametros_ativos=None):
+        """Retorna o set de campos com risco ativo.
+
+        Args:
+            parametros_ativos: subconjunto do parâmetros de risco a serem
+            aplicados
+        """
+        if parametros_ativos:
+            return set([parametro.lower()
+                        for parametro in parametros_ativos])
+        return set([key.lower() for key in self._riscosativos.keys()])
+
+    def mascaras(self, df, parametros_ativos=None):
+        """Gera as máscaras de cada filtro ativo sobre o DataFrame.
+
+        Yields:
+            tuplas (campo, tipo_filtro, filtro_compilado, mascara)
+        """
+        for campo in self.riscos_aplicaveis(df.columns, parametros_ativos):
+            dict_filtros = self.get_filtros_compilados(campo)
+            for tipo_filtro, filtro_compilado in dict_filtros.items():
+                yield (campo, tipo_filtro, filtro_compilado,
+                       filtro_compilado.mascara(df[campo]))
+
+    def seleciona(self, df, parametros_ativos=None, deduplicar=False):
+        """Retorna as posições das linhas de df que atendem aos filtros.
+
+        Basta que df tenha as colunas com risco ativo: as demais não são
+        consultadas. Ver :func:`filtra_df` para a ordem das linhas.
+
+        Returns:
+            tupla (posicoes, riscos): array numpy com as posições das
+            linhas selecionadas e, somente com deduplicar=True, lista
+            alinhada com posicoes com os textos de COLUNA_RISCOS (senão None)
+
+        """
+        if not deduplicar:
+            partes = [np.flatnonzero(mascara.values) for _, _, _, mascara
+                      in self.mascaras(df, parametros_ativos)]
+            if not partes:
+                return np.array([], dtype=np.intp), None
+            return np.concatenate(partes), None
+        df = df.reset_index(drop=True)
+        mascara_final = np.zeros(len(df), dtype=bool)
+        rotulos = []
+        for campo, _, filtro_compilado, mascara in self.mascaras(
+                df, parametros_ativos):
+            if not mascara.any():
+                continue
+            mascara_final |= mascara.values
+            encontrados = filtro_compilado.correspondencias(
+                df.loc[mascara, campo])
+            rotulos.append(campo + ': ' + encontrados.astype(str))
+        riscos = []
+        if rotulos:
+            # groupby ordena pelas posições, como np.flatnonzero
+            riscos = pd.concat(rotulos).groupby(level=0).agg(
+                SEPARADOR_RISCOS.join).tolist()
+        return np.flatnonzero(mascara_final), riscos
+
+    def filtra_df(self, df, parametros_ativos=None, deduplicar=False):
+        """Retorna DataFrame com as linhas de df que atendem aos filtros.
+
+        Por padrão mantém o comportamento histórico de :func:`aplica_risco`:
+        as linhas são agrupadas por filtro, na ordem dos campos, e uma linha
+        aparece uma vez para cada campo/tipo de filtro que a selecionou.
+
+        Com deduplicar=True, as máscaras são combinadas (OU) e cada linha
+        aparece uma única vez, na ordem original, acrescida da coluna
+        COLUNA_RISCOS no formato "campo: valor; campo: valor".
+        """
+        posicoes, riscos = self.seleciona(df, parametros_ativos, deduplicar)
+        result_df = df.iloc[posicoes]
+        if riscos is not None:
+            result_df = result_df.copy()
+            result_df.index = posicoes
+            result_df[COLUNA_RISCOS] = riscos
+        return result_df
+
+    def filtra_tabela(self, tabela, parametros_ativos=None,
+                      deduplicar=False):
+        """Equivalente de :func:`filtra_df` para Table pyarrow.
+
+        Somente as colunas com risco ativo são convertidas para pandas e
+        avaliadas. Das demais colunas, somente as linhas selecionadas são
+        copiadas (Table.take) - com tabela mapeada em memória (ver
+        :func:`bhadrasana.utils.colunar.abre_tabela`), o restante da base
+        nunca é carregado. Como em :func:`aplica_risco`, é aplicado strip
+        (:func:`strip_df`); os demais pre_processers não são aplicados.
+        """
+        tabela = tabela.rename_columns([str(coluna).strip()
+                                        for coluna in tabela.column_names])
+        campos = self.riscos_aplicaveis(tabela.column_names,
+                                        parametros_ativos)
+        df_campos = self.strip_df(colunar.para_pandas(tabela.select(campos)))
+        posicoes, riscos = self.seleciona(df_campos, parametros_ativos,
+                                          deduplicar)
+        result_df = self.strip_df(colunar.para_pandas(tabela.take(posicoes)))
+        if riscos is not None:
+            result_df.index = posicoes
+            result_df[COLUNA_RISCOS] = riscos
+        return result_df
+
     def parametro_tocsv(self, campo, path=tmpdir, dbsession=None):
         """Salva parametro em arquivo.
 
@@ -564,6 +1329,7 @@ class GerenteRisco():
                     ltipofiltro = Filtro[linha[1].strip()]
                 dict_filtros[ltipofiltro].append(linha[0])
             self._riscosativos[campo] = dict_filtros
+            self._compila_filtros(campo)
 
     def import_named_csv(self, arquivo, session=None, padraorisco=None,
                          filtro=Filtro.igual, tolist=False):
@@ -619,7 +1385,7 @@ class GerenteRisco():
                 return set()
             caminho = os.path.join(caminho, ano_mes_dia[-1])
             print(caminho)
-        for arquivo in os.listdir(caminho):
+        for arquivo in colunar.lista_arquivos_base(caminho):
             lista_csv.append(arquivo[:-4])
             with open(os.path.join(caminho, arquivo),
                       'r', encoding=ENCODE, newline='') as f:
@@ -634,11 +1400,14 @@ class GerenteRisco():
         return cabecalhos_nao_repetidos
 
     def aplica_juncao(self, visao, path=tmpdir, filtrar=False,
-                      parametros_ativos=None):
+                      parametros_ativos=None, deduplicar=False):
         """Faz junção de arquivos diversos.
 
         Lê, um a um, os csvs configurados em visao.tabelas. Carrega em
-        DataFrames e faz merge destes.
+        DataFrames e faz merge destes. As junções 'inner' e 'left' são
+        feitas pelos índices das colunas chave, gravados junto à cópia
+        colunar (ver :mod:`bhadrasana.utils.chaves`); as demais, e os
+        casos que o índice não atende, por DataFrame.merge.
 
         Args:
             visao: objeto de Banco de Dados que espeficica as configurações
@@ -651,6 +1420,8 @@ class GerenteRisco():
             parametros_ativos: subconjunto do parâmetros de risco a serem
             aplicados
 
+            deduplicar: repassado para :func:`aplica_risco`
+
         Returns:
             Lista contendo os campos filtrados. 1ª linha com nomes de campo.
 
@@ -658,34 +1429,75 @@ class GerenteRisco():
             Quando a base for constituída de arquivo único, utilizar
             :func:`aplica_risco`
 
+            Com cache ativo (ver :func:`ativa_cache_juncao`), o resultado
+            da junção é gravado, e nas chamadas seguintes somente os
+            filtros são aplicados
+
         """
-        numero_juncoes = len(visao.tabelas)
-        tabela = visao.tabelas[0]
-        print('CSV File', tabela.csv_file)
-        filename = os.path.join(path, tabela.csv_file)
-        dfpai = pd.read_csv(filename, encoding=ENCODE,
-                            dtype=str)
-        logger.debug('DataFrame criado. Tabela %s. %s linhas ' %
-                     (tabela.csv_file, len(dfpai)))
-        if hasattr(tabela, 'type'):
-            how = tabela.type
+        chave_cache = None
+        if self._cache_juncao is not None:
+            chave_cache = self._cache_juncao.chave(visao, path)
+            tabela_cache = self._cache_juncao.le(chave_cache)
+            if tabela_cache is not None:
+                logger.debug('Junção da visão %s lida do cache: %s' %
+                             (getattr(visao, 'nome', ''), chave_cache))
+                if filtrar:
+                    return self.aplica_risco(
+                        df=tabela_cache, parametros_ativos=parametros_ativos,
+                        deduplicar=deduplicar)
+                result_df = colunar.para_pandas(tabela_cache)
+                result_list = [result_df.columns.tolist()]
+                result_list.extend(result_df.values.tolist())
+                return result_list
+        campos_risco = []
+        if filtrar and chave_cache is None:
+            # Com cache, a junção é completa (sem filtros), para reutilizar
+            campos_risco = self.campos_risco(parametros_ativos)
+        plano = planeja_juncao(visao, path, campos_risco)
+        if self.pre_processers:
+            # pre_processers podem alterar os valores (ou títulos) antes
+            # dos filtros: só é possível filtrar após a junção
+            plano.etapa_filtro = None
+        logger.debug('Plano de junção da visão %s:\n%s' %
+                     (getattr(visao, 'nome', ''), plano))
+        # Colunas que só são copiadas para o resultado podem ser lidas
+        # como categorias (códigos do sch). Chaves e campos com risco
+        # continuam textos, assim como tudo se houver pre_processers
+        fixas = self.campos_risco(parametros_ativos)
+        for etapa in plano.etapas[1:]:
+            fixas.update((etapa.left_on, etapa.right_on))
+        dfs = []
+        for etapa in plano.etapas:
+            dtypes = {}
+            if not self.pre_processers:
+                dtypes = {coluna: dtype for coluna, dtype
+                          in colunar.dtypes_sch(etapa.arquivo).items()
+                          if dtype == colunar.DTYPE_CATEGORIA and
+                          coluna not in fixas}
+            df = colunar.le_tabela(etapa.arquivo, colunas=etapa.colunas,
+                                   dtypes=dtypes)
+            logger.debug('DataFrame criado. Tabela %s. %s linhas ' %
+                         (etapa.tabela.csv_file, len(df)))
+            dfs.append(df)
+        if plano.etapa_filtro is not None:
+            self._filtra_antes_juncao(plano, dfs, parametros_ativos)
+        etapa = plano.etapas[0]
+        print('CSV File', etapa.tabela.csv_file)
+        dfpai = chaves.junta(plano, dfs)
+        if dfpai is not None:
+            logger.debug('Junção pelos índices de chaves. %s linhas ' %
+                         len(dfpai))
+            juntar = []
         else:
-            how = 'inner'
-        for r in range(1, numero_juncoes):
-            primario = tabela.primario.lower()
-            if hasattr(tabela, 'type'):
-                how = tabela.type
-            else:
-                how = 'inner'
-            tabela = visao.tabelas[r]
-            estrangeiro = tabela.estrangeiro.lower()
-            filhofilename = os.path.join(path, tabela.csv_file)
-            dffilho = pd.read_csv(filhofilename, encoding=ENCODE,
-                                  dtype=str)
-            logger.debug('DataFrame criado. Tabela % s. Linhas %s ' %
-                         (tabela.csv_file, len(dffilho)))
+            dfpai = dfs[0]
+            juntar = plano.etapas[1:]
+        for ind, etapa in enumerate(juntar, 1):
+            tabela = etapa.tabela
+            primario = etapa.left_on
+            estrangeiro = etapa.right_on
+            dffilho = dfs[ind]
             try:
-                dfpai = dfpai.merge(dffilho, how=how,
+                dfpai = dfpai.merge(dffilho, how=etapa.how,
                                     left_on=primario,
                                     right_on=estrangeiro)
                 logger.debug('Merge realizado usando tabelas anteriores ' +
@@ -729,8 +1541,8 @@ class GerenteRisco():
             raise KeyError(msg)
         # print(dfpai)
         """
-        if visao.colunas:
-            colunas = [coluna.nome.lower() for coluna in visao.colunas]
+        if plano.colunas:
+            colunas = plano.colunas
             try:
                 result_df = dfpai[colunas]
             except KeyError as err:
@@ -739,24 +1551,57 @@ class GerenteRisco():
                     ', '.join(dfpai.columns)
                 logger.error(msg)
                 raise KeyError(msg)
-            result_list = [colunas]
         else:
             result_df = dfpai
-            result_list = [result_df.columns.tolist()]
-        result_list.extend(result_df.values.tolist())
-        # print(result_list)
+        if chave_cache is not None:
+            self._cache_juncao.grava(chave_cache, result_df)
         if filtrar:
-            return self.aplica_risco(result_list,
-                                     parametros_ativos=parametros_ativos)
+            return self.aplica_risco(df=result_df,
+                                     parametros_ativos=parametros_ativos,
+                                     deduplicar=deduplicar)
+        result_list = [result_df.columns.tolist()]
+        result_list.extend(result_df.values.tolist())
         return result_list
 
+    def _filtra_antes_juncao(self, plano, dfs, parametros_ativos):
+        """Filtra a tabela de plano.etapa_filtro e propaga às demais.
+
+        Mantém da tabela somente as linhas que atendem a pelo menos um
+        filtro e, por semi-junção, somente as linhas das demais tabelas que
+        ainda se juntam a elas. Os filtros são aplicados novamente após a
+        junção (:func:`aplica_juncao`), que gera o mesmo resultado, em
+        menos linhas.
+        """
+        ind = plano.etapa_filtro
+        df = dfs[ind]
+        df_campos = self.strip_df(df[plano.campos_risco])
+        posicoes, _ = self.seleciona(df_campos, parametros_ativos)
+        mascara = np.zeros(len(df), dtype=bool)
+        mascara[posicoes] = True
+        dfs[ind] = df[mascara]
+        semi_juncao(plano, dfs)
+        logger.debug('Filtros aplicados antes da junção. Linhas: %s' %
+                     ', '.join(['%s %s' % (etapa.tabela.csv_file, len(df))
+                                for etapa, df in zip(plano.etapas, dfs)]))
+
     @classmethod
-    def csv_to_mongo(cls, db, base, path=None, arquivo=None, unique=[]):
+    def csv_to_mongo(cls, db, base, path=None, arquivo=None, unique=None,
+                     tamanho_lote=TAMANHO_LOTE_MONGO):
         """Insere conteúdo do arquivo csv em coleção MongoDB.
 
         Lê um arquivo CSV e insere todo seu conteúdo em uma coleção do
         MongoDB. Cria a coleção se não existir.
 
+        O arquivo é lido em lotes (ver
+        :func:`bhadrasana.utils.colunar.le_lotes`) e cada lote inserido
+        com insert_many(ordered=False), tamanho_lote documentos por vez.
+        Documentos com chave duplicada são ignorados sem interromper o
+        restante do lote (ver :func:`insere_lote`).
+
+        Para os arquivos com chave (unique), é criado na coleção um índice
+        único com os campos da chave e os documentos são gravados por
+        upsert (ver :func:`atualiza_lote`): arquivar de novo não duplica.
+
         Args:
             db: "MongoDBClient" conexão com o banco de dados selecionado
 
@@ -769,7 +1614,16 @@ class GerenteRisco():
             arquivo: caminho e nome do arquivo csv
 
             unique: lista de campos que terão indice único (e
-            não serão reinseridos) - TODO: unique field on mongo archive
+            não serão reinseridos), ou dict nome do csv (sem extensão):
+            lista de campos. Se None, usa as chaves das Tabelas da base
+            (ver :func:`chaves_tabelas`)
+
+            tamanho_lote: documentos por chamada de insert_many
+
+        Returns:
+            dict nome da coleção: quantidade de documentos inseridos
+            (sem contar os já existentes)
+
         """
         if path is None and arquivo is None:
             raise AttributeError('Nome ou caminho do(s) arquivo(s) deve ser'
@@ -778,31 +1632,149 @@ class GerenteRisco():
             lista_arquivos = [os.path.basename(arquivo)]
             path = os.path.dirname(arquivo)
         else:
-            lista_arquivos = os.listdir(path)
+            lista_arquivos = colunar.lista_arquivos_base(path)
+        if unique is None:
+            unique = chaves_tabelas(base)
+        inseridos = {}
         for arquivo in lista_arquivos:
-            print('Lendo arquivo', arquivo)
-            df = pd.read_csv(os.path.join(path, arquivo),
-                             encoding=ENCODE, dtype=str)
-            print('Leu arquivo %s tamanho: %s' % (arquivo, len(df)))
-            print(df.head())
-            data_json = json.loads(df.to_json(orient='records'))
+            arquivo_csv = os.path.join(path, arquivo)
             collection_name = base.nome + '.' + arquivo[:-4]
-            if collection_name not in db.collection_names():
+            if collection_name not in db.list_collection_names():
                 db.create_collection(collection_name)
-            # TODO: Estudar possibilidade de evitar inserções duplicadas,
-            # em caso de evidência de inserção duplicada fazer upsert
-            # É complicado, pois é necessário ter a metadata de cada tabela,
-            # isto é, o campo que será considerado 'chave' para a inserção ou
-            # update
-            for linha in data_json:
-                try:
-                    db[collection_name].insert(linha)
-                except pymongo.errors.DuplicateKeyError:
-                    pass
+            collection = db[collection_name]
+            # Datas e números informados no sch são gravados com seus tipos
+            dtypes = {coluna: dtype for coluna, dtype
+                      in colunar.dtypes_sch(arquivo_csv).items()
+                      if dtype != colunar.DTYPE_CATEGORIA}
+            campos = unique.get(arquivo[:-4]) if isinstance(unique, dict) \
+                else unique
+            campos = cls._campos_chave(arquivo_csv, campos)
+            if campos:
+                campos = cls._cria_indice_chave(collection, campos)
+            inicio = time.time()
+            linhas = 0
+            inseridos[collection_name] = 0
+            repetidos = 0
+            for lote in colunar.le_lotes(arquivo_csv, tamanho_lote,
+                                         nulos=True, dtypes=dtypes):
+                documentos = documentos_mongo(lote)
+                linhas += len(documentos)
+                if campos:
+                    inseridos_lote, repetidos_lote = atualiza_lote(
+                        collection, documentos, campos)
+                else:
+                    inseridos_lote, repetidos_lote = insere_lote(
+                        collection, documentos)
+                inseridos[collection_name] += inseridos_lote
+                repetidos += repetidos_lote
+            tempo = max(time.time() - inicio, 1e-6)
+            logger.info('Arquivo %s arquivado em %s: %s linhas, %s %s, '
+                        '%.1fs (%.0f linhas/s)' %
+                        (arquivo, collection_name, linhas, repetidos,
+                         'já existentes' if campos else 'duplicadas',
+                         tempo, linhas / tempo))
+        return inseridos
+
+    @staticmethod
+    def _cria_indice_chave(collection, campos):
+        """Cria o índice único da chave na coleção.
+
+        Se não for possível criá-lo (ex: coleção arquivada antes da chave,
+        com documentos duplicados, ou índice conflitante já existente),
+        avisa e retorna lista vazia: o arquivo é gravado sem chave, por
+        :func:`insere_lote`.
 
-    def load_mongo(self, db, base=None, collection_name=None,
-                   parametros_ativos=None, limit=0, skip=0):
-        """Recupera da base mongodb em um lista.
+        Returns:
+            campos, ou lista vazia se o índice não foi criado
+
+        """
+        try:
+            collection.create_index(
+                [(campo, pymongo.ASCENDING) for campo in campos],
+                unique=True)
+        except pymongo.errors.OperationFailure as err:
+            logger.warning('Índice único %s não criado em %s: arquivado '
+                           'sem chave (%s)' %
+                           (', '.join(campos), collection.name, err))
+            return []
+        return campos
+
+    @staticmethod
+    def _campos_chave(arquivo_csv, campos):
+        """Retorna os campos da chave como nomes de coluna do csv.
+
+        A comparação ignora maiúsculas e espaços. Se algum campo não
+        existir no csv, avisa e retorna lista vazia (sem chave).
+        """
+        if not campos:
+            return []
+        colunas = {coluna.strip().lower(): coluna
+                   for coluna in colunar.le_cabecalho(arquivo_csv)}
+        try:
+            return [colunas[campo.strip().lower()] for campo in campos]
+        except KeyError as err:
+            logger.warning('Campo da chave %s não existe em %s: arquivado '
+                           'sem chave' % (err, arquivo_csv))
+            return []
+
+    def filtro_mongo(self, parametros_ativos=None, collection=None):
+        """Monta a consulta MongoDB dos parâmetros de risco ativos.
+
+        Cada tipo de filtro é traduzido pelo seu FiltroCompilado (ver
+        :py:func:`FiltroCompilado.consulta_mongo`): igual em $in,
+        comeca_com em expressões ^prefixo e contem em expressões com
+        alternância dos valores. O documento é selecionado se atender a
+        qualquer das condições.
+
+        Args:
+            parametros_ativos: subconjunto do parâmetros de risco a serem
+            aplicados
+
+            collection: coleção a consultar. Se informada, os valores são
+            convertidos para o tipo gravado em cada campo (ver
+            :func:`tipos_campos_mongo`); se não, são comparados como texto
+
+        Returns:
+            dict com a consulta ($or), ou dict vazio se não há filtros.
+            None se há filtros, mas nenhum pode ser aplicado aos campos
+            da coleção (nenhum documento atende)
+
+        """
+        if parametros_ativos:
+            riscos = set([parametro.lower()
+                          for parametro in parametros_ativos])
+        else:
+            riscos = set([key.lower() for key in self._riscosativos.keys()])
+        tipos = {}
+        if collection is not None:
+            tipos = tipos_campos_mongo(collection, sorted(riscos))
+        condicoes = []
+        ha_filtros = False
+        for campo in sorted(riscos):
+            filtros = self.get_filtros_compilados(campo)
+            tipo_campo = tipos.get(campo, TIPO_TEXTO)
+            for tipo_filtro in sorted(filtros, key=lambda tipo: tipo.value):
+                ha_filtros = True
+                condicoes.extend(
+                    filtros[tipo_filtro].consulta_mongo(campo, tipo_campo))
+        if not condicoes:
+            return None if ha_filtros else {}
+        return {'$or': condicoes}
+
+    def itera_mongo(self, db, base=None, collection_name=None,
+                    parametros_ativos=None, limit=0, skip=0,
+                    batch_size=TAMANHO_LOTE_MONGO):
+        """Gera as linhas das coleções mongodb, direto do cursor.
+
+        Os nomes de campo são os do primeiro documento de cada coleção
+        (csv_to_mongo grava todas as colunas do csv em todos os
+        documentos, inclusive nulos), e somente eles são pedidos ao
+        servidor (projeção fixa, sem _id). Os documentos são trazidos em
+        lotes de batch_size e convertidos em linhas um a um, sem montar o
+        resultado em memória. Os filtros são aplicados pelo servidor (ver
+        :py:func:`filtro_mongo`), com os valores convertidos para os tipos
+        gravados em cada coleção; sem parâmetros de risco ativos, gera
+        todos os documentos.
 
         Args:
             db: "MongoDBClient" conexão com o banco de dados selecionado.
@@ -816,72 +1788,96 @@ class GerenteRisco():
             parametros_ativos: subconjunto do parâmetros de risco a serem
             aplicados
 
-        Returns:
-            Lista contendo os campos filtrados. 1ª linha com nomes de campo
+            limit, skip: paginação, em cada coleção
+
+            batch_size: documentos por lote do cursor
+
+        Yields:
+            1ª linha com nomes de campo, depois uma lista por documento.
+            Nada, se nenhum documento atender aos filtros
 
         """
         if base is None and collection_name is None:
             raise AttributeError('Base Origem ou collection name devem ser'
                                  'obrigatoriamente informado')
-        logger.debug(parametros_ativos)
-        if parametros_ativos:
-            riscos = set([parametro.lower()
-                          for parametro in parametros_ativos])
-        else:
-            riscos = set([key.lower() for key in self._riscosativos.keys()])
-        filtro = {}
-        listadefiltros = []
-        for campo in riscos:
-            dict_filtros = self._riscosativos.get(campo)
-            #  TODO: $or operator, filter operator
-            for tipo_filtro, lista_filtros in dict_filtros.items():
-                filtro = {campo: {'$in': lista_filtros}}
-                listadefiltros.append(filtro)
-        if listadefiltros:
-            filtro = {'$or': listadefiltros}
-        logger.debug(filtro)
         if collection_name:
             if collection_name.find('.csv') != -1:
                 collection_name = collection_name[:-4]
             list_collections = [collection_name]
         else:
             list_collections = [name for name in
-                                db.collection_names() if base.nome in name]
-        result = OrderedDict()
+                                db.list_collection_names()
+                                if base.nome in name]
+        headers = []
         for collection_name in list_collections:
-            mongo_list = db[collection_name].find(
-                filtro).limit(limit).skip(skip)
-            if mongo_list.count() == 0:
-                filtro = {}
-                mongo_list = db[collection_name].find(filtro)
-            try:
-                headers = [[key for key in mongo_list[0].keys()]]
-                # number_of_headers = len(headers)
-            except IndexError as err:
-                logger.error('load_mongo retornou vazio. Collection name:')
-                logger.error(collection_name)
-                logger.error(err, exc_info=True)
-                return []
-            for linha in mongo_list:
-                for key, value in linha.items():
-                    if result.get(key) is None:
-                        result[key] = []
-                    result[key].append(value)
-                # result.append(valores)
-        # logger.debug('Result ')
-        # logger.debug(result)
-        headers = [key for key in result.keys()]
-        comprimento = len(result[headers[0]])
-        lista = [headers]
-        for i in range(comprimento - 1):
-            linha = []
-            for key in headers:
-                try:
-                    linha.append(result[key][i])
-                except IndexError:
-                    continue
-            lista.append(linha)
-        return lista
+            documento = db[collection_name].find_one() or {}
+            headers.extend(key for key in documento
+                           if key != '_id' and key not in headers)
+        if not headers:
+            logger.info('load_mongo não encontrou documentos em %s' %
+                        ', '.join(list_collections))
+            return
+        projecao = {key: 1 for key in headers}
+        projecao['_id'] = 0
+        linhas = 0
+        for collection_name in list_collections:
+            filtro = self.filtro_mongo(parametros_ativos,
+                                       db[collection_name])
+            logger.debug(filtro)
+            if filtro is None:
+                continue
+            cursor = db[collection_name].find(
+                filtro, projecao, batch_size=batch_size
+            ).skip(skip).limit(limit)
+            for documento in cursor:
+                if linhas == 0:
+                    yield headers
+                linhas += 1
+                yield [documento.get(key) for key in headers]
+        logger.debug('load_mongo: %s linhas de %s' %
+                     (linhas, ', '.join(list_collections)))
+
+    def load_mongo(self, db, base=None, collection_name=None,
+                   parametros_ativos=None, limit=0, skip=0, destino=None):
+        """Recupera da base mongodb em um lista.
+
+        Ver :py:func:`itera_mongo`.
+
+        Args:
+            db: "MongoDBClient" conexão com o banco de dados selecionado.
+
+            base: Base Origem
+
+            **OU**
+
+            collection_name: nome da coleção do MongoDB
+
+            parametros_ativos: subconjunto do parâmetros de risco a serem
+            aplicados
+
+            limit, skip: paginação, em cada coleção
+
+            destino: se informado, grava as linhas direto neste arquivo
+            csv, sem montar a lista em memória
+
+        Returns:
+            Lista contendo os campos filtrados. 1ª linha com nomes de campo.
+            Lista vazia se nenhum documento atender aos filtros.
+            Se passado destino, número de linhas gravadas, sem contar a de
+            títulos
+
+        """
+        linhas = self.itera_mongo(db, base=base,
+                                  collection_name=collection_name,
+                                  parametros_ativos=parametros_ativos,
+                                  limit=limit, skip=skip)
+        if destino:
+            headers = next(linhas, None)
+            if headers is None:
+                return 0
+            return self.save_csv(itertools.chain([headers], linhas),
+                                 destino) - 1
+        return list(linhas)
 
     def aplica_juncao_mongo(self, db, visao,
                             parametros_ativos=None,
@@ -949,20 +1945,38 @@ class GerenteRisco():
                 riscos = set([key.lower() for key
                               in self._riscosativos.keys()])
             print('RISCOS', riscos)
+            # Valores convertidos para o tipo gravado no campo de cada
+            # coleção, como em filtro_mongo (ver tipos_campos_mongo)
+            tipos = {tabela.csv_table: tipos_campos_mongo(
+                db[base.nome + '.' + tabela.csv_table], sorted(riscos))
+                for tabela in visao.tabelas}
+            ha_filtros = False
             for campo in riscos:
+                chaves = [(campo, tipos[painame].get(campo, TIPO_TEXTO))]
+                chaves.extend(
+                    (tabela.csv_table + '.' + campo,
+                     tipos[tabela.csv_table].get(campo, TIPO_TEXTO))
+                    for tabela in visao.tabelas)
                 dict_filtros = self._riscosativos.get(campo)
                 for tipo_filtro, lista_filtros in dict_filtros.items():
                     print(tipo_filtro, lista_filtros)
                     # filter_function = filter_functions.get(tipo_filtro)
                     for valor in lista_filtros:
-                        filtro.append({campo: valor})
-                        for tabela in visao.tabelas:
-                            filtro.append(
-                                {tabela.csv_table + '.' + campo: valor}
-                            )
+                        ha_filtros = True
+                        for chave, tipo in chaves:
+                            try:
+                                filtro.append(
+                                    {chave: converte_valor_mongo(valor,
+                                                                 tipo)})
+                            except ValueError:
+                                logger.warning('Valor %s ignorado: campo %s '
+                                               'é %s' % (valor, chave, tipo))
             if filtro:
                 print('FILTRO', filtro)
                 pipeline.append({'$match': {'$or': filtro}})
+            elif ha_filtros:
+                logger.warning('Nenhum filtro aplicável aos campos')
+                return None
         if limit:
             pipeline.append({'$limit': skip + limit})
         if skip:
@@ -1000,7 +2014,9 @@ class GerenteRisco():
                                     visaoid: int = 0,
                                     parametros_ativos: list= None,
                                     base_csv: str = None,
-                                    db=None):
+                                    db=None,
+                                    deduplicar: bool = False,
+                                    destino: str = None):
         """Escolhe o método correto de acordo com parâmetros.
 
         Chama arquivo(s) com ou sem junção e filtro,
@@ -1024,8 +2040,17 @@ class GerenteRisco():
             parametros_ativos: subconjunto do parâmetros de risco a serem
             aplicados
 
+            deduplicar: cada linha aparece uma única vez, com coluna
+            listando os riscos encontrados. Não se aplica ao MongoDB
+
+            destino: csv onde gravar o resultado. Se informado, base de
+            arquivo único é processada em lotes (ver
+            :py:func:`aplica_risco_arquivo`), sem carregar tudo em memória.
+            Se nenhuma linha for selecionada, destino não é gravado
+
         Returns:
             Lista contendo os campos filtrados. 1ª linha com nomes de campo.
+            Se destino for informado, número de linhas gravadas em destino.
 
         """
         padrao = dbsession.query(PadraoRisco).filter(
@@ -1034,26 +2059,64 @@ class GerenteRisco():
         self.set_padraorisco(padrao)
         print('PADRAO', padrao, padraoid)
         if visaoid == '0':
-            dir_content = os.listdir(base_csv)
+            dir_content = colunar.lista_arquivos_base(base_csv)
             arquivo = os.path.join(base_csv, str(dir_content[0]))
+            if destino:
+                if padrao is None:
+                    shutil.copyfile(arquivo, destino)
+                    with open(destino, 'r', encoding=ENCODE,
+                              newline='') as arq:
+                        total = sum(1 for _ in csv.reader(arq)) - 1
+                else:
+                    total = self.aplica_risco_arquivo(
+                        arquivo, destino,
+                        parametros_ativos=parametros_ativos,
+                        deduplicar=deduplicar
+                    )
+                if total <= 0:
+                    # Sem linhas: nenhum arquivo, como na junção (Visao)
+                    os.remove(destino)
+                    return 0
+                return total
+            if colunar.colunar_atualizado(arquivo):
+                tabela = colunar.abre_tabela(arquivo)
+                if padrao is None:
+                    df = tabela.to_pandas()
+                    lista_risco = [df.columns.tolist()]
+                    lista_risco.extend(df.values.tolist())
+                    return lista_risco
+                return self.aplica_risco(
+                    df=tabela,
+                    parametros_ativos=parametros_ativos,
+                    deduplicar=deduplicar
+                )
             lista_risco = self.load_csv(arquivo)
             if padrao is None:
                 return lista_risco
             return self.aplica_risco(
                 lista_risco,
-                parametros_ativos=parametros_ativos
+                parametros_ativos=parametros_ativos,
+                deduplicar=deduplicar
             )
         else:
             avisao = dbsession.query(Visao).filter(
                 Visao.id == visaoid).one()
             if db is not None:  # Usar MongoDB como fonte
-                return self.aplica_juncao_mongo(
+                lista_risco = self.aplica_juncao_mongo(
                     db, avisao,
                     filtrar=padrao is not None,
                     parametros_ativos=parametros_ativos
                 )
-            return self.aplica_juncao(
-                avisao, path=base_csv,
-                filtrar=padrao is not None,
-                parametros_ativos=parametros_ativos
-            )
+            else:
+                lista_risco = self.aplica_juncao(
+                    avisao, path=base_csv,
+                    filtrar=padrao is not None,
+                    parametros_ativos=parametros_ativos,
+                    deduplicar=deduplicar
+                )
+            if destino:
+                if not lista_risco or len(lista_risco) < 2:
+                    return 0
+                self.save_csv(lista_risco, destino)
+                return len(lista_risco) - 1
+            return lista_risco
@@ -0,0 +1,183 @@
+"""Índices MongoDB das bases arquivadas.
+
+As bases arquivadas (ver
+:py:func:`bhadrasana.utils.gerente_risco.GerenteRisco.csv_to_mongo`) ficam
+nas coleções <base>.<tabela>. São consultadas com $in nos campos dos
+parâmetros de risco (load_mongo) e com $lookup nas chaves de junção das
+Visões (aplica_juncao_mongo). Sem índice nesses campos, toda consulta lê
+a coleção inteira.
+
+:func:`garante_indices` cria os índices que faltam e informa os índices
+existentes que não são usados por essas consultas ou não foram acessados.
+
+Uso pela linha de comando::
+
+    python -m bhadrasana.utils.indices_mongo [--base NOME] [--verifica]
+
+"""
+import argparse
+from collections import OrderedDict
+
+import pymongo
+from pymongo.errors import OperationFailure
+
+from ajna_commons.flask.log import logger
+from bhadrasana.models.models import Base, BaseOrigem, MySession
+
+INDICE_ID = '_id_'
+
+
+def campos_risco_base(base):
+    """Retorna set com os campos dos parâmetros de risco da base."""
+    campos = set()
+    for padrao in getattr(base, 'padroes', None) or []:
+        for parametro in padrao.parametros:
+            if parametro.nome_campo:
+                campos.add(parametro.nome_campo.strip().lower())
+    return campos
+
+
+def chaves_juncao_base(base):
+    """Retorna dict nome da coleção: set de chaves de junção.
+
+    Para cada Visao da base, a partir da segunda tabela, o $lookup procura
+    o campo estrangeiro na coleção da tabela (ver aplica_juncao_mongo em
+    :py:class:`bhadrasana.utils.gerente_risco.GerenteRisco`).
+    """
+    chaves = {}
+    for visao in getattr(base, 'visoes', None) or []:
+        for tabela in visao.tabelas[1:]:
+            if not tabela.estrangeiro:
+                continue
+            collection_name = base.nome + '.' + tabela.csv_table
+            chaves.setdefault(collection_name, set()).add(
+                tabela.estrangeiro.strip().lower())
+    return chaves
+
+
+def colecoes_base(db, base):
+    """Retorna lista com os nomes das coleções arquivadas da base."""
+    prefixo = base.nome + '.'
+    return sorted(name for name in db.list_collection_names()
+                  if name.startswith(prefixo))
+
+
+def indices_desejados(db, base):
+    """Retorna dict nome da coleção: set de campos a indexar.
+
+    Campos de risco são indexados nas coleções que os contêm (verificado
+    em um documento da coleção); chaves de junção, nas coleções das
+    tabelas que as usam no $lookup.
+    """
+    campos_risco = campos_risco_base(base)
+    chaves = chaves_juncao_base(base)
+    desejados = {}
+    for collection_name in colecoes_base(db, base):
+        documento = db[collection_name].find_one() or {}
+        campos = set(documento.keys()) & campos_risco
+        campos |= chaves.get(collection_name, set())
+        if campos:
+            desejados[collection_name] = campos
+    return desejados
+
+
+def indices_existentes(collection):
+    """Retorna dict nome do índice: (campos, unique)."""
+    existentes = {}
+    for nome, info in collection.index_information().items():
+        campos = tuple(campo for campo, _ in info['key'])
+        existentes[nome] = (campos, info.get('unique', False))
+    return existentes
+
+
+def acessos_indices(collection):
+    """Retorna dict nome do índice: acessos desde o início do servidor.
+
+    Usa o estágio $indexStats. Retorna None se não for suportado.
+    """
+    try:
+        return {stats['name']: stats['accesses']['ops'] for stats in
+                collection.aggregate([{'$indexStats': {}}])}
+    except (OperationFailure, NotImplementedError) as err:
+        logger.debug('$indexStats indisponível: %s' % err)
+        return None
+
+
+def garante_indices(db, base, criar=True):
+    """Cria os índices que faltam nas coleções da base e informa o uso.
+
+    Um campo é considerado indexado se é o primeiro campo de algum índice
+    da coleção (ex: o índice único da chave da tabela). Nenhum índice é
+    excluído: os desnecessários somente são informados.
+
+    Args:
+        db: "MongoDBClient" conexão com o banco de dados selecionado
+
+        base: Base Origem
+
+        criar: se False, somente verifica (os índices que faltam são
+        informados em 'faltantes')
+
+    Returns:
+        dict nome da coleção: dict com as listas 'criados', 'faltantes'
+        (campos), 'nao_previstos' (índices que não começam por campo de
+        risco ou chave de junção, exceto _id e únicos) e 'sem_uso'
+        (índices sem acessos, se o servidor informar)
+
+    """
+    desejados = indices_desejados(db, base)
+    relatorio = {}
+    for collection_name in colecoes_base(db, base):
+        collection = db[collection_name]
+        campos = desejados.get(collection_name, set())
+        existentes = indices_existentes(collection)
+        indexados = set(chave[0] for chave, _ in existentes.values() if chave)
+        resultado = OrderedDict((chave, []) for chave in (
+            'criados', 'faltantes', 'nao_previstos', 'sem_uso'))
+        for campo in sorted(campos - indexados):
+            if criar:
+                collection.create_index([(campo, pymongo.ASCENDING)])
+                resultado['criados'].append(campo)
+            else:
+                resultado['faltantes'].append(campo)
+        for nome, (chave, unico) in sorted(existentes.items()):
+            if nome != INDICE_ID and not unico and chave[0] not in campos:
+                resultado['nao_previstos'].append(nome)
+        acessos = acessos_indices(collection)
+        if acessos:
+            resultado['sem_uso'] = sorted(
+                nome for nome, ops in acessos.items()
+                if ops == 0 and nome != INDICE_ID)
+        for chave, lista in resultado.items():
+            if lista:
+                logger.info('Índices %s em %s: %s' %
+                            (chave, collection_name, ', '.join(lista)))
+        relatorio[collection_name] = resultado
+    return relatorio
+
+
+def main():
+    """Garante (ou verifica) os índices das bases arquivadas."""
+    from ajna_commons.flask.conf import DATABASE, MONGODB_URI
+    parser = argparse.ArgumentParser(
+        description='Garante os índices MongoDB das bases arquivadas')
+    parser.add_argument('--base', help='nome da Base Origem (todas se '
+                        'não informado)')
+    parser.add_argument('--verifica', action='store_true',
+                        help='somente informa, sem criar índices')
+    args = parser.parse_args()
+    dbsession = MySession(Base).session
+    query = dbsession.query(BaseOrigem)
+    if args.base:
+        query = query.filter(BaseOrigem.nome == args.base)
+    db = pymongo.MongoClient(host=MONGODB_URI)[DATABASE]
+    for base in query.all():
+        relatorio = garante_indices(db, base, criar=not args.verifica)
+        for collection_name, resultado in relatorio.items():
+            print(collection_name)
+            for chave, lista in resultado.items():
+                print('    %s: %s' % (chave, ', '.join(lista) or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""Planejamento das junções (Visao) sobre as bases em arquivos csv.
+
+Uma :class:`bhadrasana.models.models.Visao` descreve uma lista de tabelas
+(csv) a juntar em sequência, e opcionalmente as colunas do resultado.
+Antes de ler os arquivos, :func:`planeja_juncao` monta um
+:class:`PlanoJuncao`, com uma :class:`EtapaJuncao` por tabela, dizendo
+quais colunas ler de cada arquivo e como juntá-lo ao resultado anterior.
+Ver :py:func:`bhadrasana.utils.gerente_risco.GerenteRisco.aplica_juncao`.
+"""
+import os
+from collections import Counter
+
+from bhadrasana.utils import colunar
+
+# Sufixos que pandas.merge acrescenta às colunas de mesmo nome
+SUFIXOS_MERGE = ('_x', '_y')
+
+
+class EtapaJuncao():
+    """Uma tabela da junção: o que ler e como juntar ao resultado anterior.
+
+    Attributes:
+        tabela: metadados da tabela (Tabela)
+
+        arquivo: caminho do csv
+
+        cabecalho: nomes de coluna do arquivo
+
+        colunas: colunas a ler (None para todas)
+
+        how, left_on, right_on: parâmetros de DataFrame.merge para juntar
+        esta tabela ao resultado das etapas anteriores (None na primeira)
+
+        linhas: quantidade estimada de linhas do arquivo (ver
+        :func:`bhadrasana.utils.colunar.estima_linhas`)
+
+    """
+
+    def __init__(self, tabela, arquivo, cabecalho,
+                 how=None, left_on=None, right_on=None):
+        """Etapa que lê todas as colunas. Ver :func:`planeja_juncao`."""
+        self.tabela = tabela
+        self.arquivo = arquivo
+        self.cabecalho = cabecalho
+        self.colunas = None
+        self.how = how
+        self.left_on = left_on
+        self.right_on = right_on
+        self.linhas = None
+
+    def __str__(self):
+        """Descrição para log."""
+        colunas = 'todas' if self.colunas is None else \
+            '%s de %s' % (len(self.colunas), len(self.cabecalho))
+        detalhes = 'colunas: %s' % colunas
+        if self.linhas is not None:
+            detalhes += ', linhas: %s' % self.linhas
+        if self.how is None:
+            return '%s (%s)' % (self.tabela.csv_file, detalhes)
+        return '%s join %s on %s = %s (%s)' % (
+            self.how, self.tabela.csv_file, self.left_on, self.right_on,
+            detalhes)
+
+
+class PlanoJuncao():
+    """Sequência de etapas de uma junção e colunas do resultado.
+
+    Attributes:
+        etapas: lista de :class:`EtapaJuncao`, na ordem de execução
+
+        colunas: colunas do resultado, na ordem da Visao (None para todas)
+
+        campos_risco: campos com risco ativo presentes no resultado
+
+        etapa_filtro: índice da etapa (tabela) que contém todos os
+        campos_risco, onde os filtros podem ser aplicados antes da junção,
+        ou None (ver :func:`planeja_filtro`)
+
+        reordenado: True se as etapas não estão na ordem de visao.tabelas
+        (ver :func:`ordena_etapas`)
+
+    """
+
+    def __init__(self, etapas, colunas=None, campos_risco=()):
+        """Guarda etapas e colunas."""
+        self.etapas = etapas
+        self.colunas = colunas
+        self.campos_risco = list(campos_risco)
+        self.etapa_filtro = None
+        self.reordenado = False
+
+    def __str__(self):
+        """Descrição para log, uma etapa por linha."""
+        linhas = [str(etapa) for etapa in self.etapas]
+        if self.reordenado:
+            linhas.append('ordem das junções alterada pelo tamanho estimado')
+        if self.etapa_filtro is not None:
+            linhas.append('filtros (%s) antes da junção em %s' % (
+                ', '.join(self.campos_risco),
+                self.etapas[self.etapa_filtro].tabela.csv_file))
+        return '\n'.join(linhas)
+
+
+def planeja_juncao(visao, path, campos_risco=(), reordenar=True):
+    """Monta o plano de junção da visao sobre os arquivos em path.
+
+    As tabelas são juntadas na ordem de visao.tabelas: cada uma pela
+    coluna estrangeiro, com a coluna primario da tabela anterior, usando o
+    atributo type da tabela anterior (se houver, senão 'inner').
+
+    Se a visao tiver colunas, cada arquivo é lido somente com as colunas
+    necessárias (ver :func:`projeta_colunas`). Com reordenar, junções
+    'inner' podem ser feitas em outra ordem (ver :func:`ordena_etapas`).
+
+    Args:
+        visao: Visao (ou objeto com tabelas e colunas)
+
+        path: diretório dos arquivos csv
+
+        campos_risco: campos com parâmetros de risco ativos. Os presentes
+        no resultado são mantidos na leitura, para que os filtros possam
+        ser avaliados, e considerados em :func:`planeja_filtro`
+
+        reordenar: se False, mantém a ordem de visao.tabelas
+
+    """
+    etapas = []
+    anterior = None
+    for tabela in visao.tabelas:
+        arquivo = os.path.join(path, tabela.csv_file)
+        etapa = EtapaJuncao(tabela, arquivo, colunar.le_cabecalho(arquivo))
+        etapa.linhas = colunar.estima_linhas(arquivo)
+        if anterior is not None:
+            if hasattr(anterior, 'type'):
+                etapa.how = anterior.type
+            else:
+                etapa.how = 'inner'
+            etapa.left_on = anterior.primario.lower()
+            etapa.right_on = tabela.estrangeiro.lower()
+        etapas.append(etapa)
+        anterior = tabela
+    colunas = None
+    if visao.colunas:
+        colunas = [coluna.nome.lower() for coluna in visao.colunas]
+        visiveis = set(colunas)
+    else:
+        visiveis = set(nome for etapa in etapas for nome in etapa.cabecalho)
+    campos_risco = sorted(visiveis & set(campos_risco))
+    if colunas is not None:
+        projeta_colunas(etapas, set(colunas) | set(campos_risco))
+    plano = PlanoJuncao(etapas, colunas, campos_risco)
+    plano.etapa_filtro = planeja_filtro(etapas, campos_risco)
+    if reordenar:
+        ordena_etapas(plano)
+    return plano
+
+
+def projeta_colunas(etapas, necessarias):
+    """Define, para cada etapa, somente as colunas a ler.
+
+    São lidas as colunas necessárias, as chaves de junção, e as colunas
+    cujo nome aparece em mais de uma tabela (ou termina com um dos
+    SUFIXOS_MERGE): assim os nomes gerados por DataFrame.merge para as
+    colunas repetidas são os mesmos da leitura completa.
+    """
+    necessarias = set(necessarias)
+    for etapa in etapas[1:]:
+        necessarias.add(etapa.left_on)
+        necessarias.add(etapa.right_on)
+    ocorrencias = Counter(nome for etapa in etapas
+                          for nome in set(etapa.cabecalho))
+    for etapa in etapas:
+        etapa.colunas = [nome for nome in etapa.cabecalho
+                         if nome in necessarias or ocorrencias[nome] > 1 or
+                         nome.endswith(SUFIXOS_MERGE)]
+
+
+def somente_inner(etapas):
+    """Retorna True se todas as junções do plano são 'inner'."""
+    return all(etapa.how == 'inner' for etapa in etapas[1:])
+
+
+def planeja_filtro(etapas, campos_risco):
+    """Retorna a etapa onde aplicar os filtros antes da junção, ou None.
+
+    Os filtros podem ser aplicados antes da junção somente se todos os
+    campos_risco pertencem a uma mesma tabela (e só a ela) e todas as
+    junções são 'inner': neste caso, toda linha do resultado filtrado vem
+    de uma linha desta tabela que atende a pelo menos um filtro.
+    """
+    if not campos_risco or not somente_inner(etapas):
+        return None
+    donas = set()
+    for campo in campos_risco:
+        donas_campo = [ind for ind, etapa in enumerate(etapas)
+                       if campo in etapa.cabecalho]
+        if len(donas_campo) != 1:
+            return None
+        donas.add(donas_campo[0])
+    if len(donas) != 1:
+        return None
+    return donas.pop()
+
+
+def ordena_etapas(plano):
+    """Reordena as junções 'inner' do plano, menores tabelas primeiro.
+
+    As tabelas de uma Visao formam uma sequência, cada uma ligada à
+    anterior. Começando pela tabela onde os filtros são aplicados antes
+    da junção (se houver) ou pela de menor quantidade estimada de linhas,
+    é juntada a cada passo a menor das tabelas vizinhas às já juntadas.
+    Assim os resultados intermediários ficam menores, e o resultado final
+    tem as mesmas linhas (em outra ordem).
+
+    Só é feito se todas as junções são 'inner' e nenhum nome de coluna se
+    repete entre as tabelas (o merge renomearia as repetidas conforme a
+    ordem), exceto as chaves de junção de mesmo nome nos dois lados (ex:
+    Container.conhecimento = Conhecimento.conhecimento), que o merge
+    reúne em uma só coluna em qualquer ordem. As colunas do resultado são
+    mantidas: se a visao não define colunas, plano.colunas passa a
+    listá-las na ordem original.
+    """
+    etapas = plano.etapas
+    if len(etapas) < 2 or not somente_inner(etapas) or \
+            any(etapa.linhas is None for etapa in etapas):
+        return plano
+    lidas = [etapa.cabecalho if etapa.colunas is None else etapa.colunas
+             for etapa in etapas]
+    nomes = [nome for colunas in lidas for nome in colunas]
+    ocorrencias = Counter(nomes)
+    for etapa in etapas[1:]:
+        if etapa.left_on == etapa.right_on:
+            ocorrencias[etapa.left_on] -= 1
+    if any(quantidade > 1 for quantidade in ocorrencias.values()):
+        return plano
+    if plano.etapa_filtro is not None:
+        inicio = plano.etapa_filtro
+    else:
+        inicio = min(range(len(etapas)), key=lambda ind: etapas[ind].linhas)
+    ordem = [inicio]
+    esquerda, direita = inicio, inicio
+    while len(ordem) < len(etapas):
+        vizinhas = []
+        if esquerda > 0:
+            vizinhas.append(esquerda - 1)
+        if direita < len(etapas) - 1:
+            vizinhas.append(direita + 1)
+        proxima = min(vizinhas, key=lambda ind: etapas[ind].linhas)
+        esquerda, direita = min(esquerda, proxima), max(direita, proxima)
+        ordem.append(proxima)
+    if ordem == list(range(len(etapas))):
+        return plano
+    novas = []
+    for ind in ordem:
+        etapa = etapas[ind]
+        nova = EtapaJuncao(etapa.tabela, etapa.arquivo, etapa.cabecalho)
+        nova.colunas = etapa.colunas
+        nova.linhas = etapa.linhas
+        if novas:
+            nova.how = 'inner'
+            if ind - 1 in ordem[:len(novas)]:
+                # Junta à anterior da sequência original, como na Visao
+                nova.left_on = etapa.left_on
+                nova.right_on = etapa.right_on
+            else:
+                # Junta à seguinte: a ligação é a mesma, com lados trocados
+                seguinte = etapas[ind + 1]
+                nova.left_on = seguinte.right_on
+                nova.right_on = seguinte.left_on
+        novas.append(nova)
+    if plano.colunas is None:
+        # Ordem do merge na ordem original: chave repetida fica na 1ª
+        plano.colunas = []
+        for nome in nomes:
+            if nome not in plano.colunas:
+                plano.colunas.append(nome)
+    if plano.etapa_filtro is not None:
+        plano.etapa_filtro = 0
+    plano.etapas = novas
+    plano.reordenado = True
+    return plano
+
+
+def semi_juncao(plano, dfs):
+    """Reduz os DataFrames de uma junção 'inner' às linhas que se juntam.
+
+    Propaga as chaves sobreviventes (ex: após filtrar uma tabela) das
+    tabelas pai para as filhas e de volta, como semi-junções
+    (Series.isin). Em uma sequência de junções 'inner' o resultado da
+    junção não se altera, e a ordem das linhas é mantida.
+
+    Args:
+        plano: :class:`PlanoJuncao` (somente 'inner')
+
+        dfs: lista de DataFrames, um por etapa. É modificada
+
+    """
+    juncoes = []
+    for ind, etapa in enumerate(plano.etapas[1:], 1):
+        if etapa.right_on not in dfs[ind].columns:
+            continue  # o erro é informado no merge
+        # Tabela anterior mais próxima que contém a chave do lado esquerdo
+        for ind_pai in range(ind - 1, -1, -1):
+            if etapa.left_on in dfs[ind_pai].columns:
+                juncoes.append((ind_pai, etapa.left_on, ind, etapa.right_on))
+                break
+    for ind_pai, left_on, ind, right_on in juncoes:
+        dfs[ind] = dfs[ind][dfs[ind][right_on].isin(dfs[ind_pai][left_on])]
+    for ind_pai, left_on, ind, right_on in reversed(juncoes):
+        dfs[ind_pai] = dfs[ind_pai][
+            dfs[ind_pai][left_on].isin(dfs[ind][right_on])]
+    return dfs
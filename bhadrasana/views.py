@@ -19,6 +19,7 @@ a aplicação de filtros/parâmetros de risco.
 """
 
 import datetime
+import itertools
 import os
 import shutil
 
@@ -430,9 +431,18 @@ def risco():
             if visaoid == '0':
                 if padrao:
                     gerente.set_padraorisco(padrao)
-                lista_risco = gerente.load_mongo(
+                # Grava direto em csv e traz só as linhas exibidas na tela
+                arquivo = os.path.join(static_path, u'Última planilha.csv')
+                total_linhas = gerente.load_mongo(
                     mongodb, base=abase,
-                    parametros_ativos=parametros_ativos)
+                    parametros_ativos=parametros_ativos,
+                    destino=arquivo)
+                if total_linhas:
+                    csv_salvo = arquivo
+                    # Títulos e 100 linhas, somando todas as coleções
+                    lista_risco = list(itertools.islice(gerente.itera_mongo(
+                        mongodb, base=abase,
+                        parametros_ativos=parametros_ativos), 101))
             else:
                 task = aplicar_risco_mongo.delay(
                     visaoid, padraoid,
@@ -440,10 +450,12 @@ def risco():
                 )
         else:
             if acao == 'aplicar':
+                gerente.ativa_cache_juncao()
                 lista_risco = gerente.aplica_risco_por_parametros(
                     dbsession, padraoid, visaoid,
                     parametros_ativos=parametros_ativos,
-                    base_csv=base_csv
+                    base_csv=base_csv,
+                    deduplicar=True
                 )
             elif acao == 'agendar':
                 task = aplicar_risco.delay(
@@ -458,7 +470,7 @@ def risco():
         flash(err)
     # Salvar resultado um arquivo para donwload
     # Limita resultados em 100 linhas na tela
-    if lista_risco:
+    if lista_risco and not csv_salvo:
         csv_salvo = os.path.join(static_path, u'Última planilha.csv')
         gerente.save_csv(lista_risco, csv_salvo)
         total_linhas = len(lista_risco) - 1
@@ -1020,6 +1032,9 @@ def adiciona_tabela():
         primario:
 
         estrangeiro:
+
+        chave: campos, separados por vírgula, que identificam uma linha
+        do CSV (opcional)
     """
     dbsession = app.config.get('dbsession')
     visaoid = request.args.get('visaoid')
@@ -1028,7 +1043,8 @@ def adiciona_tabela():
     estrangeiro = request.args.get('estrangeiro')
     pai_id = request.args.get('pai_id')
     desc = request.args.get('descricao')
-    tabela = Tabela(csv, primario, estrangeiro, pai_id, visaoid)
+    chave = request.args.get('chave') or None
+    tabela = Tabela(csv, primario, estrangeiro, pai_id, visaoid, chave)
     if desc:
         tabela.descricao = desc
     dbsession.add(tabela)
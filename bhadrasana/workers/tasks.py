@@ -15,8 +15,10 @@ from pymongo import MongoClient
 from ajna_commons.flask.conf import BACKEND, BROKER, DATABASE, MONGODB_URI
 from ajna_commons.flask.log import logger
 from ajna_commons.utils.sanitiza import ascii_sanitizar
+from bhadrasana.conf import PROCESSOS_IMPORTACAO
 from bhadrasana.models.models import Base, BaseOrigem, MySession
 from bhadrasana.utils.gerente_risco import GerenteRisco
+from bhadrasana.utils.indices_mongo import garante_indices
 
 REDIS_URL = 'redis://localhost:6379/0'
 BACKEND = REDIS_URL
@@ -61,8 +63,10 @@ def importar_base(self, csv_folder, baseid, data, filename, remove=False):
                           meta={'status': 'Processando arquivo ' +
                                 basefilename + ' na base ' + abase.nome +
                                 '. Aguarde!!!'})
+        # Pares sch/txt convertidos em paralelo (billiard.Pool no worker)
         lista_arquivos = gerente.importa_base(
-            csv_folder, baseid, data, filename, remove)
+            csv_folder, baseid, data, filename, remove,
+            workers=PROCESSOS_IMPORTACAO)
         # Sanitizar base já na importação para evitar
         # processamento repetido depois
         gerente.ativa_sanitizacao(ascii_sanitizar)
@@ -135,6 +139,7 @@ def arquiva_base_csv(self, baseid, base_csv):
         conn = MongoClient(host=MONGODB_URI)
         db = conn[DATABASE]
         GerenteRisco.csv_to_mongo(db, abase, base_csv)
+        garante_indices(db, abase)
         shutil.rmtree(base_csv)
         return {'status': 'Base arquivada com sucesso'}
     except Exception as err:
@@ -153,6 +158,7 @@ def arquiva_base_csv_sync(baseid, base_csv):
         conn = MongoClient(host=MONGODB_URI)
         db = conn[DATABASE]
         GerenteRisco.csv_to_mongo(db, abase, base_csv)
+        garante_indices(db, abase)
         shutil.rmtree(base_csv)
         return 'Base arquivada com sucesso'
     except Exception as err:
@@ -170,18 +176,24 @@ def aplicar_risco(self, base_csv: str, padraoid: int, visaoid: int,
     mysession = MySession(Base)
     dbsession = mysession.session
     gerente = GerenteRisco()
+    gerente.ativa_cache_juncao()
     try:
         self.update_state(state=states.PENDING, meta={'status': mensagem})
-        lista_risco = gerente.aplica_risco_por_parametros(
+        csv_salvo = os.path.join(dest_path,
+                                 datetime.today().strftime
+                                 ('%Y-%m-%d-%H:%M:%S') + '.csv')
+        # Grava direto em csv_salvo, em lotes, sem montar lista em memória.
+        # Sem linhas selecionadas, csv_salvo não é criado
+        total = gerente.aplica_risco_por_parametros(
             dbsession,
             padraoid=padraoid, visaoid=visaoid,
             parametros_ativos=parametros_ativos,
-            base_csv=base_csv)
-        if lista_risco:
-            csv_salvo = os.path.join(dest_path,
-                                     datetime.today().strftime
-                                     ('%Y-%m-%d-%H:%M:%S') + '.csv')
-            gerente.save_csv(lista_risco, csv_salvo)
+            base_csv=base_csv,
+            deduplicar=True,
+            destino=csv_salvo)
+        if not total:
+            return {'status': 'Nenhuma linha selecionada. '
+                              'Planilha não criada'}
         return {'status': 'Planilha criada com sucesso'}
     except Exception as err:
         logger.error(str(err), exc_info=True)
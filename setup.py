@@ -21,6 +21,7 @@ setup(
         'Flask-wtf',
         'gunicorn',
         'pandas',
+        'pyarrow',
         'pymongo',
         'raven',
         'redis',